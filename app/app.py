@@ -20,27 +20,46 @@ As you can see, this most of this file is copied from storage server. It shows t
 
 Usage:
 * `python app.py declare testdata1.txt`: read `testdata1.txt` into a ramfs-like space and declare the app has it on directory server
+* `python app.py update testdata1.txt`: like declare, but `testdata1.txt` is a new version of the file: the other copies are replaced
 * `python app.py disown testdata1.txt`: disown `testdata1.txt` on directory server
-* `python app.py show testdata1.txt`: show the content of testdata1.txt on remote server
+* `python app.py show testdata1.txt [more files...]`: show the content of testdata1.txt (and more files) on remote server
+* `python app.py save testdata1.txt`: stream testdata1.txt from remote server into testdata1.txt.download
+* `python app.py range testdata1.txt 0:4 -4:4`: show the parts of testdata1.txt at offset:length (a negative offset counts from the end)
+* `python app.py list [prefix]`: list the files (starting with prefix) on directory server, page by page
+Add `--log-level LEVEL` to any of them to change what is logged to stderr (INFO by default, see common/log.py),
+the results are printed to stdout.
 """
 import asyncio
+import logging
+import os
+import sys
 import zmq
-import json
 from dataclasses import dataclass
 from zmq import Frame
 from zmq.asyncio import Socket, Context, Poller
-from typing import List, Iterable, Dict, Tuple
-from random import choice
+from typing import List, Iterable, Dict, Tuple, Optional
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import peer, wire, log, changes
+from common.location_cache import LocationCache
+from common.pool import PeerPool
+from common.compression import CompressionCache
+
+logger = logging.getLogger("app")
+
+LIST_PAGE = 1000 # the filenames asked in one fs.list
+HEARTBEAT_INTERVAL = 10.0 # seconds, the directory server expires an address without heartbeats
 
 @dataclass
 class VirtualFile(object):
     name: str
     content: bytes
     declared_device_names: List[str]
+    digests: Optional[List[bytes]] = None # chunk digests for fs.manifest, computed when asked
 
 class StorageServerStore(object):
     def __init__(self) -> None:
         self.files: Dict[str, VirtualFile] = {}
+        self.compressed = CompressionCache()
 
 async def ping(sock: Socket, device_name: str) -> str:
     await sock.send_multipart([Frame(b"ping"), Frame(bytes(device_name, encoding='utf8'))])
@@ -55,100 +74,268 @@ async def cast_address(sock: Socket, device_name: str, addr: str) -> None:
     result: bytes = await sock.recv()
     assert result[0] == 0
 
-async def get_file_declared_devices(sock: Socket, filename: str) -> List[str]:
-    await sock.send_multipart([b"fs.get", bytes(filename, 'utf8')])
+async def send_heartbeat(sock: Socket, device_name: str, addr: str) -> bool:
+    """Return False if the address is not casted anymore."""
+    await sock.send_multipart([b"device.heartbeat", bytes(device_name, 'utf8'), bytes(addr, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    return frames[0][0] == 0
+
+async def keep_alive(sock: Socket, device_name: str, addr: str) -> None:
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        if not await send_heartbeat(sock, device_name, addr):
+            await cast_address(sock, device_name, addr)
+
+async def negotiate_encoding(sock: Socket) -> str:
+    await sock.send_multipart([b"proto.hello", bytes(",".join(wire.ENCODINGS), 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    if frames[0][0] == 0:
+        return str(frames[1], 'utf8')
+    else:
+        return wire.JSON # the server does not know proto.hello
+
+async def locate_file(sock: Socket, filename: str) -> Dict[str, List[str]]:
+    await sock.send_multipart([b"fs.locate", bytes(filename, 'utf8')])
     frames: List[bytes] = await sock.recv_multipart()
     assert(frames.pop(0)[0] == 0)
-    device_list_frame = frames.pop(0)
-    result = json.loads(device_list_frame)
-    assert(isinstance(result, list))
-    return result
+    return wire.decode_locations(frames)
 
-async def get_devices_declared_addresses(sock: Socket, device_name: str) -> List[str]:
-    await sock.send_multipart([b"device.get_addresses", bytes(device_name, 'utf8')])
+async def locate_files(sock: Socket, filenames: List[str]) -> Dict[str, Optional[Dict[str, List[str]]]]:
+    await sock.send_multipart([b"fs.locate_many"] + [bytes(filename, 'utf8') for filename in filenames])
     frames: List[bytes] = await sock.recv_multipart()
     assert(frames.pop(0)[0] == 0)
-    device_addresses_frame = frames.pop(0)
-    result = json.loads(device_addresses_frame)
-    assert(isinstance(result, list))
-    return result
+    return wire.decode_locations_many(frames)
 
-async def download_file(context: Context, dirserv_sock: Socket, filename: str) -> bytes:
-    devices = await get_file_declared_devices(dirserv_sock, filename)
+async def list_files(sock: Socket, prefix: str, after: str, limit: int) -> Tuple[int, str, List[str]]:
+    """Return the count of the files starting with `prefix`, the `after` of the next page (empty after the last one) and a page of filenames."""
+    await sock.send_multipart([b"fs.list", bytes(prefix, 'utf8'), bytes(after, 'utf8'), bytes(str(limit), 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames[0][0] == 0)
+    return (int(frames[1]), str(frames[2], 'utf8'), wire.decode_list(frames[3:]))
+
+def flatten_locations(locations: Dict[str, List[str]]) -> List[str]:
     all_declared_addresses = []
-    for dev_name in devices:
-        addresses = await get_devices_declared_addresses(dirserv_sock, dev_name)
+    for addresses in locations.values():
         all_declared_addresses += addresses
-    used_address = choice(all_declared_addresses)# we use only one connection to 'download' files here,
-    # but a complete implementation must download them from different devices to speed up the process
-    print("download_file(): using address {}".format(used_address))
-    download_sock: Socket = context.socket(zmq.REQ)
-    download_sock.connect(used_address)
-    await download_sock.send_multipart([b"fs.read_file", bytes(filename, 'utf8')])
-    frames: List[bytes] = await asyncio.wait_for(download_sock.recv_multipart(), 5)
-    # This is just a sample protocol, and it does not need complex functions to deal with big contents
-    download_sock.close()
-    if frames[0][0] == 0:
-        return frames.pop(1)
-    else:
-        return None
+    return all_declared_addresses
+
+async def get_file_addresses(dirserv_sock: Socket, filename: str, cache: LocationCache) -> List[str]:
+    # devices and their addresses in one round trip, or none if they are cached
+    return flatten_locations(await cache.locate(filename, lambda: locate_file(dirserv_sock, filename)))
+
+async def download_file(pool: PeerPool, dirserv_sock: Socket, filename: str, cache: LocationCache, all_declared_addresses: Optional[List[str]] = None) -> bytes:
+    if all_declared_addresses is None:
+        all_declared_addresses = await get_file_addresses(dirserv_sock, filename, cache)
+    # chunks are pulled from all the devices at once, see common/peer.py
+    logger.debug("download_file(): using addresses %s", all_declared_addresses)
+    return await peer.download_parallel(pool, all_declared_addresses, filename)
+
+async def download_files(pool: PeerPool, dirserv_sock: Socket, filenames: List[str], cache: LocationCache) -> Dict[str, Optional[bytes]]:
+    all_locations = {filename: cache.get(filename) for filename in filenames}
+    uncached = [filename for filename, locations in all_locations.items() if locations is None]
+    if uncached:
+        generation = cache.generation
+        located = await locate_files(dirserv_sock, uncached) # one round trip for all the files not cached
+        for filename, locations in located.items():
+            all_locations[filename] = locations
+            if (locations is not None) and (generation == cache.generation):
+                cache.put(filename, locations)
+    async def download(filename: str, locations: Optional[Dict[str, List[str]]]) -> Optional[bytes]:
+        if locations is None:
+            return None
+        return await download_file(pool, dirserv_sock, filename, cache, flatten_locations(locations))
+
+    # the files are downloaded at once, the requests to the same peer share its pooled connection
+    results = await asyncio.gather(*(download(filename, locations) for filename, locations in all_locations.items()))
+    return dict(zip(all_locations.keys(), results))
+
+async def read_file_ranges(pool: PeerPool, dirserv_sock: Socket, filename: str, ranges: List[Tuple[int, int]], cache: LocationCache) -> Optional[Tuple[int, List[bytes]]]:
+    """Return the size of `filename` and the contents of the (offset, length) ranges, the rest of the file is not transferred."""
+    all_declared_addresses = await get_file_addresses(dirserv_sock, filename, cache)
+    logger.debug("read_file_ranges(): using addresses %s", all_declared_addresses)
+    return await peer.find_ranges(pool, all_declared_addresses, filename, ranges)
+
+def parse_ranges(texts: List[str]) -> Optional[List[Tuple[int, int]]]:
+    """Return the (offset, length) of the `offset:length` arguments, or None if there are none or one is not such a pair."""
+    ranges = []
+    for text in texts:
+        numbers = text.split(':')
+        try:
+            offset, length = int(numbers[0]), int(numbers[1])
+        except (ValueError, IndexError):
+            return None
+        if len(numbers) != 2 or length < 0:
+            return None
+        ranges.append((offset, length))
+    return ranges or None
+
+async def save_file(pool: PeerPool, dirserv_sock: Socket, filename: str, path: str, cache: LocationCache) -> Optional[int]:
+    all_declared_addresses = await get_file_addresses(dirserv_sock, filename, cache)
+    logger.debug("save_file(): using addresses %s", all_declared_addresses)
+    with open(path, mode='wb') as f:
+        return await peer.stream_file(pool, all_declared_addresses, filename, f) # the file is written chunk by chunk
 
 async def declare_file(sock: Socket, filename: str, device_name: str) -> None:
     await sock.send_multipart([b"fs.declare", bytes(device_name, 'utf8'), bytes(filename, 'utf8')])
     frames: List[bytes] = await sock.recv_multipart()
     assert(frames[0][0] == 0)
 
+async def update_file(sock: Socket, filename: str, device_name: str, vfile: VirtualFile) -> Optional[int]:
+    """Make the version of this device the next version of the file, return the version or None if the file does not exist."""
+    await sock.send_multipart([b"fs.update", bytes(device_name, 'utf8'), bytes(filename, 'utf8'), bytes(str(len(vfile.content)), 'utf8'), peer.content_digest(vfile)])
+    frames: List[bytes] = await sock.recv_multipart()
+    if frames[0][0] != 0:
+        return None
+    return int(frames[1])
+
+async def get_changes_since(sock: Socket, epoch: bytes, seq: int) -> List[bytes]:
+    await sock.send_multipart([b"fs.changes_since", epoch, bytes(str(seq), 'utf8')])
+    return await sock.recv_multipart()
+
+def update_event_callback(store: StorageServerStore, argframes: List[bytes]) -> None:
+    """Stop serving a file updated by another app: every app is the "app" device, so it is still declaring the file."""
+    filename = str(argframes[0], 'utf8')
+    vfile = store.files.get(filename, None)
+    digest = argframes[4] if len(argframes) > 4 else b""
+    if vfile and digest and peer.content_digest(vfile) != digest:
+        store.files.pop(filename)
+        print("File {} is updated to version {} by another app, not serving it anymore".format(filename, str(argframes[1], 'utf8')))
+
 async def disown_file(sock: Socket, filename: str, device_name: str) -> None:
     await sock.send_multipart([b"fs.disown", bytes(device_name, 'utf8'), bytes(filename, 'utf8')])
     await sock.recv_multipart() # Eat result sliently
 
-async def read_file_handler(store: StorageServerStore, argframes: List[Frame], sock: Socket, id_frame: Frame):
+async def read_file_handler(store: StorageServerStore, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
     filename = str(argframes.pop(0).bytes, 'utf8')
-    print("Read file {}".format(filename))
+    offered = argframes.pop(0).bytes if argframes else None
+    logger.debug("Read file %s", filename)
     vfile = store.files.get(filename, None)
     if vfile:
-        sock.send_multipart([id_frame, Frame(), bytes([0]), vfile.content])
+        content = await peer.encode_content(store, vfile.content, offered, lambda: peer.content_digest(vfile))
+        await sock.send_multipart([*envelope, Frame(), bytes([0]), *content])
     else:
-        sock.send(bytes([0]))
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
 
-async def app(store: StorageServerStore, context: Context, name: str, command: str, arg: str):
-    print("Starting...")
+FILE_HANDLERS = {
+    'fs.read_file': read_file_handler,
+    'fs.stat': peer.stat_handler,
+    'fs.read_chunk': peer.read_chunk_handler,
+    'fs.read_stream': peer.read_stream_handler,
+    'fs.manifest': peer.manifest_handler,
+    'fs.read_range': peer.read_range_handler,
+    'fs.delta': peer.delta_handler,
+}
+
+async def app(store: StorageServerStore, context: Context, name: str, command: str, arg: str, more_args: List[str] = []):
+    logger.info("Starting...")
     dirserv_commands = context.socket(zmq.REQ)
     dirserv_commands.connect("tcp://127.0.0.1:5350")
-    print("App is started")
-    if command == "declare":
+    await asyncio.wait_for(negotiate_encoding(dirserv_commands), 5)
+    location_cache = LocationCache()
+    peer_pool = PeerPool(context)
+    logger.info("App is started")
+    if command in ("declare", "update"):
         self_addr = await asyncio.wait_for(ping(dirserv_commands, name), 5)
-        print("Directory server report this client is run on {}".format(self_addr))
+        logger.info("Directory server report this client is run on %s", self_addr)
         command_port: Socket = context.socket(zmq.ROUTER)
         port = command_port.bind_to_random_port("tcp://127.0.0.1")
         self_entrypoint_addr = "tcp://{}:{}".format(self_addr, port)
         await asyncio.wait_for(cast_address(dirserv_commands, name, self_entrypoint_addr), 5)
-        print("Address {} casted on directory server".format(self_entrypoint_addr))
+        logger.info("Address %s casted on directory server", self_entrypoint_addr)
         with open(arg, mode='rb') as f:
             store.files[arg] = VirtualFile(arg, f.read(), [])
-        await declare_file(dirserv_commands, arg, name)
-        print("File {} is declared, serving file...".format(arg))
+        file_changes_sub: Socket = context.socket(zmq.SUB)
+        file_changes_sub.connect("tcp://127.0.0.1:5351")
+        file_changes_sub.setsockopt(zmq.SUBSCRIBE, changes.TOPIC)
+        cursor = changes.ChangeCursor()
+        await cursor.start(lambda epoch, seq: get_changes_since(dirserv_commands, epoch, seq))
+        version = (await update_file(dirserv_commands, arg, name, store.files[arg])) if command == "update" else None
+        if version is None:
+            await declare_file(dirserv_commands, arg, name)
+            print("File {} is declared, serving file...".format(arg))
+        else:
+            print("File {} is updated to version {}, serving file...".format(arg, version))
+        heartbeats = asyncio.ensure_future(keep_alive(dirserv_commands, name, self_entrypoint_addr)) # the socket is not used by the loop below
+        background = peer.BackgroundCommands()
         poller = Poller()
         poller.register(command_port, zmq.POLLIN)
-        while True:
-            events: List[Tuple[Socket, int]] = await poller.poll()
-            for socket, mark in events:
-                frames: List[Frame] = await socket.recv_multipart(copy=False)
-                id_frame = frames.pop(0)
-                frames.pop(0)
-                command_frame = frames.pop(0)
-                command = str(command_frame.bytes, 'utf8')
-                if socket == command_port:
-                    if command == 'fs.read_file':
-                        await read_file_handler(store, frames, socket, id_frame)
+        poller.register(file_changes_sub, zmq.POLLIN)
+        try:
+            while True:
+                events: List[Tuple[Socket, int]] = await poller.poll()
+                for socket, mark in events:
+                    if socket == file_changes_sub:
+                        # the missed events are not fetched: the socket to the directory server is used by the heartbeats
+                        for event in (await cursor.receive(await socket.recv_multipart())) or []:
+                            if event[0] == b"fs.update":
+                                update_event_callback(store, event[1:])
+                        continue
+                    frames: List[Frame] = await socket.recv_multipart(copy=False)
+                    envelope, frames = peer.split_envelope(frames)
+                    command_frame = frames.pop(0)
+                    command = str(command_frame.bytes, 'utf8', 'replace')
+                    handler = FILE_HANDLERS.get(command, None)
+                    if socket == command_port and handler:
+                        serving = peer.guarded(command, handler(store, frames, socket, envelope))
+                        if command in peer.BACKGROUND_COMMANDS:
+                            await background.start(serving)
+                        else:
+                            await serving
+        finally:
+            heartbeats.cancel()
     elif command == "disown":
         await disown_file(dirserv_commands, arg, name)
         context.destroy()
         return
     elif command == "show":
-        content = await download_file(context, dirserv_commands, arg)
-        print("==== Content of '{}' ====".format(arg))
-        print(str(content, 'utf8'))
+        following = asyncio.ensure_future(location_cache.follow(context, "tcp://127.0.0.1:5351"))
+        contents = await download_files(peer_pool, dirserv_commands, [arg] + more_args, location_cache)
+        for filename, content in contents.items():
+            print("==== Content of '{}' ====".format(filename))
+            if content is None:
+                print("(could not download '{}')".format(filename))
+            else:
+                print(str(content, 'utf8'))
+        following.cancel()
+        peer_pool.close()
+        context.destroy()
+        return
+    elif command == "save":
+        following = asyncio.ensure_future(location_cache.follow(context, "tcp://127.0.0.1:5351"))
+        path = arg + ".download"
+        size = await save_file(peer_pool, dirserv_commands, arg, path, location_cache)
+        if size is None:
+            print("Could not download '{}'".format(arg))
+        else:
+            print("'{}' is saved to '{}' ({} bytes)".format(arg, path, size))
+        following.cancel()
+        peer_pool.close()
+        context.destroy()
+        return
+    elif command == "range":
+        ranges = parse_ranges(more_args) or [] # checked by main()
+        following = asyncio.ensure_future(location_cache.follow(context, "tcp://127.0.0.1:5351"))
+        result = await read_file_ranges(peer_pool, dirserv_commands, arg, ranges, location_cache)
+        if result is None:
+            print("Could not read '{}'".format(arg))
+        else:
+            size, contents = result
+            print("==== '{}' ({} bytes) ====".format(arg, size))
+            for (offset, length), content in zip(ranges, contents):
+                print("[{}:{}] {!r}".format(offset, length, content))
+        following.cancel()
+        peer_pool.close()
+        context.destroy()
+        return
+    elif command == "list":
+        after = ""
+        while True:
+            count, after, filenames = await list_files(dirserv_commands, arg, after, LIST_PAGE)
+            for filename in filenames:
+                print(filename)
+            if not after:
+                break
+        print("==== {} files ====".format(count))
         context.destroy()
         return
     else:
@@ -160,12 +347,17 @@ async def app(store: StorageServerStore, context: Context, name: str, command: s
 
 def main():
     import sys
-    command = sys.argv[1]
-    arg = sys.argv[2]
+    args = sys.argv[1:]
+    log.setup(log.pop_level(args))
+    command = args[0]
+    arg = args[1] if len(args) > 1 else ""
+    if command == "range" and parse_ranges(args[2:]) is None:
+        print("Usage: python app.py range <filename> <offset>:<length>... (a negative offset counts from the end)", file=sys.stderr)
+        sys.exit(2)
     store = StorageServerStore()
     context = Context()
     try:
-        asyncio.run(app(store, context, "app", command, arg))
+        asyncio.run(app(store, context, "app", command, arg, args[2:]))
     except KeyboardInterrupt:
         context.destroy()
         print('')
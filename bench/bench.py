@@ -0,0 +1,381 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The benchmark of the whole network on localhost.
+It starts a directory server, N storage servers and M simulated apps (each one a process), then runs three phases,
+all the apps at once, each app one request at a time:
+* declare: each app declares F files of SIZE bytes, it serves them like app.py does
+* get: each app asks the devices of F files declared by the other apps (fs.get)
+* transfer: after the storage servers replicated the files, each app downloads F files declared by the other apps,
+  from every device keeping them (see common/peer.py), and checks their contents
+It reports the ops/sec of declare and get, the MB/s of transfer and the p50 and p99 latencies of each phase, which are
+exact (the latencies of every request are kept). The contents are random from --seed, so two runs with the same options
+do the same requests. With --stats, the `stats` of the directory server and the storage servers are reported as well.
+Usage: `python bench/bench.py [--storages N] [--apps M] [--files F] [--size BYTES] [--workers W] [--seed S] [--port P] [--stats] [--json]`
+The ports of the directory server (5350 and 5351) must be free, the storage servers listen on P and the ports after it.
+--workers is given to the directory server. With --json, the results are printed as one JSON object, to be kept
+and compared with the next runs.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import zmq
+from dataclasses import dataclass
+from zmq import Frame
+from zmq.asyncio import Socket, Context
+from typing import List, Dict, Tuple, Optional, Any
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+from common import peer, wire, placement
+from common.compression import CompressionCache
+from common.pool import PeerPool
+
+DIRSERV_ADDRESS = "tcp://127.0.0.1:5350"
+STARTUP_TIMEOUT = 10.0 # seconds for the servers to answer
+REPLICATION_TIMEOUT = 120.0 # seconds for the storage servers to keep every file
+REQUEST_TIMEOUT = 5.0
+PHASE_TIMEOUT = 600.0 # seconds for the slowest app to finish a phase
+HEARTBEAT_INTERVAL = 10.0 # seconds, the directory server expires an address without heartbeats
+
+@dataclass
+class Options(object):
+    storages: int = 2
+    apps: int = 4
+    files: int = 50
+    size: int = 256 * 1024
+    workers: int = 0
+    seed: int = 0
+    port: int = 6400
+    stats: bool = False
+    json: bool = False
+
+@dataclass
+class VirtualFile(object):
+    name: str
+    content: bytes
+    declared_device_names: List[str]
+    digests: Optional[List[bytes]] = None # for fs.manifest, computed when asked
+
+class BenchStore(object):
+    def __init__(self) -> None:
+        self.files: Dict[str, VirtualFile] = {}
+        self.compressed = CompressionCache()
+
+def filename_of(app_index: int, number: int) -> str:
+    return "bench/app{}/{}".format(app_index, number)
+
+def content_of(options: Options, app_index: int, number: int) -> bytes:
+    """The content of a file, the same for the same seed."""
+    rng = random.Random("{}/{}/{}".format(options.seed, app_index, number))
+    return rng.getrandbits(8 * options.size).to_bytes(options.size, 'little')
+
+def targets_of(options: Options, app_index: int) -> List[Tuple[int, int]]:
+    """The (app, number) of the files read by an app in the get and transfer phases, declared by the other apps."""
+    rng = random.Random("{}/targets/{}".format(options.seed, app_index))
+    owners = [index for index in range(options.apps) if index != app_index] or [app_index]
+    return [(rng.choice(owners), rng.randrange(options.files)) for _ in range(options.files)]
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Return the `fraction` percentile of the sorted `samples` (nearest rank)."""
+    if not samples:
+        return 0.0
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+def summary(latencies: List[float], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "seconds": round(elapsed, 3),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+# The client side of the simulated apps, like app.py
+
+async def negotiate_encoding(sock: Socket) -> str:
+    await sock.send_multipart([b"proto.hello", bytes(",".join(wire.ENCODINGS), 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    return str(frames[1], 'utf8') if frames[0][0] == 0 else wire.JSON
+
+async def ping(sock: Socket, device_name: str) -> str:
+    await sock.send_multipart([b"ping", bytes(device_name, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames[0] == b"pong")
+    return str(frames[1], 'utf8')
+
+async def cast_address(sock: Socket, device_name: str, addr: str) -> None:
+    await sock.send_multipart([b"device.cast_address", bytes(device_name, 'utf8'), bytes(addr, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames[0][0] == 0)
+
+async def send_heartbeat(sock: Socket, device_name: str, addr: str) -> bool:
+    """Return False if the address is not casted anymore."""
+    await sock.send_multipart([b"device.heartbeat", bytes(device_name, 'utf8'), bytes(addr, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    return frames[0][0] == 0
+
+async def keep_alive(sock: Socket, device_name: str, addr: str) -> None:
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        if not await send_heartbeat(sock, device_name, addr):
+            await cast_address(sock, device_name, addr)
+
+async def declare_file(sock: Socket, filename: str, device_name: str) -> None:
+    await sock.send_multipart([b"fs.declare", bytes(device_name, 'utf8'), bytes(filename, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames[0][0] == 0)
+
+async def get_file_declared_devices(sock: Socket, filename: str) -> List[str]:
+    await sock.send_multipart([b"fs.get", bytes(filename, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames.pop(0)[0] == 0)
+    return wire.decode_list(frames)
+
+async def locate_file(sock: Socket, filename: str) -> Dict[str, List[str]]:
+    await sock.send_multipart([b"fs.locate", bytes(filename, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames.pop(0)[0] == 0)
+    return wire.decode_locations(frames)
+
+async def serve_files(store: BenchStore, command_port: Socket) -> None:
+    handlers = {
+        'fs.stat': peer.stat_handler,
+        'fs.read_chunk': peer.read_chunk_handler,
+        'fs.read_stream': peer.read_stream_handler,
+        'fs.manifest': peer.manifest_handler,
+        'fs.read_range': peer.read_range_handler,
+    }
+    while True:
+        frames: List[Frame] = await command_port.recv_multipart(copy=False)
+        envelope, frames = peer.split_envelope(frames)
+        command = str(frames.pop(0).bytes, 'utf8', 'replace')
+        handler = handlers.get(command, None)
+        if handler:
+            await peer.guarded(command, handler(store, frames, command_port, envelope))
+
+async def phase(barrier) -> None:
+    """Wait for the other apps and the benchmark, the files are served meanwhile."""
+    await asyncio.get_event_loop().run_in_executor(None, barrier.wait)
+
+async def simulated_app(options: Options, app_index: int, barrier, results) -> None:
+    context = Context()
+    name = "bench-app{}".format(app_index)
+    sock: Socket = context.socket(zmq.REQ)
+    sock.connect(DIRSERV_ADDRESS)
+    await negotiate_encoding(sock)
+    self_addr = await ping(sock, name)
+    command_port: Socket = context.socket(zmq.ROUTER)
+    port = command_port.bind_to_random_port("tcp://127.0.0.1")
+    address = "tcp://{}:{}".format(self_addr, port)
+    await cast_address(sock, name, address)
+    heartbeat_sock: Socket = context.socket(zmq.REQ) # `sock` is busy with the requests of the phases
+    heartbeat_sock.connect(DIRSERV_ADDRESS)
+    heartbeats = asyncio.ensure_future(keep_alive(heartbeat_sock, name, address))
+    store = BenchStore()
+    serving = asyncio.ensure_future(serve_files(store, command_port))
+    pool = PeerPool(context)
+    targets = [filename_of(owner, number) for owner, number in targets_of(options, app_index)]
+    result: Dict[str, Any] = {"declare": [], "get": [], "transfer": [], "bytes": 0, "errors": 0}
+    try:
+        contents = [content_of(options, app_index, number) for number in range(options.files)]
+        await phase(barrier) # declare
+        for number, content in enumerate(contents):
+            filename = filename_of(app_index, number)
+            store.files[filename] = VirtualFile(filename, content, [])
+            start = time.perf_counter()
+            await declare_file(sock, filename, name)
+            result["declare"].append(time.perf_counter() - start)
+        await phase(barrier)
+        await phase(barrier) # get
+        for filename in targets:
+            start = time.perf_counter()
+            await get_file_declared_devices(sock, filename)
+            result["get"].append(time.perf_counter() - start)
+        await phase(barrier)
+        await phase(barrier) # transfer, the storage servers keep every file now
+        for (owner, number), filename in zip(targets_of(options, app_index), targets):
+            start = time.perf_counter()
+            locations = await locate_file(sock, filename)
+            addresses = [address for addresses in locations.values() for address in addresses]
+            content = await peer.download_parallel(pool, addresses, filename)
+            result["transfer"].append(time.perf_counter() - start)
+            if content == content_of(options, owner, number):
+                result["bytes"] += len(content)
+            else:
+                result["errors"] += 1
+        await phase(barrier)
+    finally:
+        results.put(result)
+        heartbeats.cancel()
+        serving.cancel()
+        pool.close()
+        context.destroy(linger=0)
+
+def run_app(options: Options, app_index: int, barrier, results) -> None:
+    """Entry of an app process."""
+    asyncio.run(simulated_app(options, app_index, barrier, results))
+
+# The benchmark itself, with blocking sockets
+
+def request(context: zmq.Context, address: str, frames: List[bytes], timeout: float = REQUEST_TIMEOUT) -> Optional[List[bytes]]:
+    """Send one request on a new REQ socket, return the reply or None if it did not come in `timeout` seconds."""
+    sock = context.socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    sock.connect(address)
+    try:
+        sock.send_multipart(frames)
+        return sock.recv_multipart()
+    except zmq.Again:
+        return None
+    finally:
+        sock.close()
+
+def get_stats(context: zmq.Context, address: str) -> Optional[Dict[str, Any]]:
+    reply = request(context, address, [b"stats"])
+    if (reply is None) or reply[0][0] != 0:
+        return None
+    return json.loads(reply[1])
+
+def wait_until(condition, timeout: float, what: str) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError("timed out waiting for {}".format(what))
+        time.sleep(0.2)
+
+def storage_address(options: Options, index: int) -> str:
+    return "tcp://127.0.0.1:{}".format(options.port + index)
+
+def replicated(context: zmq.Context, options: Options) -> bool:
+    """Return if every file is kept by all its owners among the storage servers."""
+    copies = min(placement.REPLICAS, options.storages)
+    filenames = [bytes(filename_of(app_index, number), 'utf8') for app_index in range(options.apps) for number in range(options.files)]
+    reply = request(context, DIRSERV_ADDRESS, [b"fs.locate_many"] + filenames)
+    if (reply is None) or reply[0][0] != 0:
+        return False
+    located = wire.decode_locations_many(reply[1:])
+    return all(locations is not None and sum(device.startswith("storage+") for device in locations) >= copies for locations in located.values())
+
+def start_network(options: Options, processes: List[subprocess.Popen]) -> None:
+    python = sys.executable
+    server = [python, os.path.join(ROOT, "server", "server.py"), "--log-level", "warning"]
+    if options.workers:
+        server += ["--workers", str(options.workers)]
+    processes.append(subprocess.Popen(server, stdout=subprocess.DEVNULL)) # the report is the only output, the logs go to stderr
+    context = zmq.Context.instance()
+    wait_until(lambda: get_stats(context, DIRSERV_ADDRESS) is not None, STARTUP_TIMEOUT, "the directory server")
+    for index in range(options.storages):
+        processes.append(subprocess.Popen([python, os.path.join(ROOT, "storage", "storage.py"), "bench{}".format(index), "--port", str(options.port + index), "--log-level", "warning"], stdout=subprocess.DEVNULL))
+    for index in range(options.storages):
+        wait_until(lambda: get_stats(context, storage_address(options, index)) is not None, STARTUP_TIMEOUT, "storage server {}".format(index))
+
+def run(options: Options) -> Dict[str, Any]:
+    processes: List[subprocess.Popen] = []
+    apps = []
+    try:
+        start_network(options, processes)
+        context = zmq.Context.instance()
+        spawn = multiprocessing.get_context("spawn") # no zmq context is shared with the apps
+        barrier = spawn.Barrier(options.apps + 1)
+        results = spawn.Queue()
+        apps = [spawn.Process(target=run_app, args=(options, index, barrier, results), daemon=True) for index in range(options.apps)]
+        for app in apps:
+            app.start()
+        times = []
+        for number in range(6): # the start and the end of each phase
+            if number == 4:
+                wait_until(lambda: replicated(context, options), REPLICATION_TIMEOUT, "the replication")
+            barrier.wait(PHASE_TIMEOUT) # an app failing breaks the barrier for all
+            times.append(time.perf_counter())
+        app_results = [results.get(timeout=REQUEST_TIMEOUT) for _ in apps]
+        report: Dict[str, Any] = {"options": options.__dict__}
+        for index, phase_name in enumerate(("declare", "get", "transfer")):
+            report[phase_name] = summary([latency for result in app_results for latency in result[phase_name]], times[2 * index + 1] - times[2 * index])
+        transferred = sum(result["bytes"] for result in app_results)
+        report["transfer"]["mb_per_sec"] = round(transferred / (1024 * 1024) / report["transfer"]["seconds"], 2)
+        report["transfer"]["errors"] = sum(result["errors"] for result in app_results)
+        if options.stats:
+            report["stats"] = {
+                "server": get_stats(context, DIRSERV_ADDRESS),
+                "storages": [get_stats(context, storage_address(options, index)) for index in range(options.storages)],
+            }
+        return report
+    finally:
+        for app in apps:
+            app.join(timeout=REQUEST_TIMEOUT)
+        # the storage servers first, they drop their devices on the directory server when they stop
+        for group in (processes[1:], processes[:1]):
+            for process in group:
+                process.send_signal(signal.SIGINT) # stops the shards of the directory server too
+            for process in group:
+                try:
+                    process.wait(REQUEST_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+def print_report(report: Dict[str, Any]) -> None:
+    options = report["options"]
+    print("{} storage servers, {} apps, {} files of {} bytes per app, {} workers".format(options["storages"], options["apps"], options["files"], options["size"], options["workers"] or "no"))
+    for phase_name in ("declare", "get"):
+        result = report[phase_name]
+        print("{:<9} {:>10.1f} ops/s   p50 {:>8.3f} ms   p99 {:>8.3f} ms   ({} ops)".format(phase_name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"], result["ops"]))
+    result = report["transfer"]
+    print("{:<9} {:>10.2f} MB/s    p50 {:>8.3f} ms   p99 {:>8.3f} ms   ({} files, {} errors)".format("transfer", result["mb_per_sec"], result["p50_ms"], result["p99_ms"], result["ops"], result["errors"]))
+    if "stats" in report:
+        print_stats("directory server", report["stats"]["server"])
+        for index, stats in enumerate(report["stats"]["storages"]):
+            print_stats("storage server {}".format(index), stats)
+
+def print_stats(name: str, stats: Optional[Dict[str, Any]]) -> None:
+    print("==== {} ====".format(name))
+    if stats is None:
+        print("(no stats)")
+        return
+    for command, counters in stats["commands"].items():
+        latency = counters["latency_us"]
+        print("{:<20} {:>8} calls   p50 < {:>8} us   p99 < {:>8} us   {:>12} bytes out".format(command, counters["count"], latency["p50"], latency["p99"], counters["bytes_out"]))
+    print("queues: {}".format(json.dumps(stats["queues"])))
+    print("store: {}".format(json.dumps(stats["store"])))
+
+def main():
+    options = Options()
+    args = sys.argv[1:]
+    for flag in ("stats", "json"):
+        if "--" + flag in args:
+            args.remove("--" + flag)
+            setattr(options, flag, True)
+    while args:
+        name = args.pop(0)[2:]
+        if name not in Options.__dataclass_fields__:
+            raise SystemExit("unknown option --{}".format(name))
+        setattr(options, name, int(args.pop(0)))
+    report = run(options)
+    if options.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
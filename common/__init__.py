@@ -0,0 +1,21 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Code shared by the app and the storage server.
+As said in app.py, the storage server is actually a client, so the most of the client side is the same.
+The scripts add the project root into sys.path before importing this package.
+"""
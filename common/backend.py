@@ -0,0 +1,122 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Storage backends keep the contents of the files a device holds.
+A content is written through the object returned by `create()`, then `commit()` returns a buffer
+which is put into `VirtualFile.content` and served as it is (the handlers send it with copy=False).
+`get()` returns the buffer of a content already committed, `size()` its length and `names()` lists them.
+* MemoryBackend: contents are `bytes` in the heap, nothing is kept after restart.
+* DiskBackend: contents are files under a directory and served from read-only memory maps,
+  `names()` rebuilds the index from the directory after restart.
+"""
+import io
+import mmap
+import os
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from typing import Iterable, Dict, BinaryIO, Union
+
+Buffer = Union[bytes, mmap.mmap]
+
+class MemoryBackend(object):
+    def __init__(self) -> None:
+        self.contents: Dict[str, Buffer] = {}
+
+    def create(self, name: str) -> BinaryIO:
+        return io.BytesIO()
+
+    def commit(self, name: str, f: BinaryIO) -> Buffer:
+        return self.put(name, f.getvalue())
+
+    def discard(self, name: str, f: BinaryIO) -> None:
+        f.close()
+
+    def put(self, name: str, content: bytes) -> Buffer:
+        self.contents[name] = content
+        return content
+
+    def get(self, name: str) -> Buffer:
+        return self.contents[name]
+
+    def size(self, name: str) -> int:
+        return len(self.contents[name])
+
+    def remove(self, name: str) -> None:
+        self.contents.pop(name, None)
+
+    def names(self) -> Iterable[str]:
+        return list(self.contents.keys())
+
+class DiskBackend(object):
+    def __init__(self, path: str) -> None:
+        self.files_path = os.path.join(path, "files")
+        self.tmp_path = os.path.join(path, "tmp")
+        os.makedirs(self.files_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        for tmp_name in os.listdir(self.tmp_path): # unfinished downloads
+            os.unlink(os.path.join(self.tmp_path, tmp_name))
+
+    @staticmethod
+    def encode_name(name: str) -> str:
+        return str(urlsafe_b64encode(bytes(name, 'utf8')), 'ascii')
+
+    @staticmethod
+    def decode_name(encoded: str) -> str:
+        return str(urlsafe_b64decode(encoded), 'utf8')
+
+    def create(self, name: str) -> BinaryIO:
+        return open(os.path.join(self.tmp_path, self.encode_name(name)), mode='w+b')
+
+    def commit(self, name: str, f: BinaryIO) -> Buffer:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        path = os.path.join(self.files_path, self.encode_name(name))
+        os.replace(f.name, path) # the file is visible only when it is complete
+        return self._map(path)
+
+    def discard(self, name: str, f: BinaryIO) -> None:
+        f.close()
+        os.unlink(f.name)
+
+    def put(self, name: str, content: bytes) -> Buffer:
+        f = self.create(name)
+        f.write(content)
+        return self.commit(name, f)
+
+    def remove(self, name: str) -> None:
+        # Mappings already handed out stay valid until they are released, so the frames in flight are not affected
+        try:
+            os.unlink(os.path.join(self.files_path, self.encode_name(name)))
+        except FileNotFoundError:
+            pass
+
+    def get(self, name: str) -> Buffer:
+        return self._map(os.path.join(self.files_path, self.encode_name(name)))
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(os.path.join(self.files_path, self.encode_name(name)))
+
+    def names(self) -> Iterable[str]:
+        for encoded in os.listdir(self.files_path):
+            yield self.decode_name(encoded)
+
+    @staticmethod
+    def _map(path: str) -> Buffer:
+        with open(path, mode='rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b"" # an empty file could not be mapped
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
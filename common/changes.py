@@ -0,0 +1,85 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The change feed of the directory server, as seen by the subscribers.
+Each event gets a sequence number, increasing by one from 1, and the server keeps the last events in a ring.
+The events are published in batches: `changes | epoch: bytes | first_seq: str | event...`, one frame for each event
+(the frames of the event, each one prefixed by its length, see `pack_event()`). The events of the commands handled
+together are published together, so a burst of commands is a few messages instead of one message for each event.
+The epoch is random for each run of the directory server, the sequence numbers of another run are not comparable.
+
+A subscriber keeps its position (the epoch and the last sequence number it applied) in a ChangeCursor.
+A batch starting after the next sequence number means events are missed (a slow joiner, a reconnection,
+the high-water mark of the PUB socket), they are asked by
+`fs.changes_since | epoch: bytes | seq: str -> 0 | epoch | first_seq: str | event... (the events after seq)`,
+which replies `1 | epoch | last_seq: str` when the events are not in the ring anymore, or the epoch is another one.
+The subscriber cannot catch up then, it resyncs its state by the commands and continues after last_seq.
+"""
+import struct
+from typing import List, Optional, Callable, Awaitable
+
+TOPIC = b"changes"
+LENGTH = struct.Struct("!I")
+RING_CAPACITY = 16384 # the events kept for fs.changes_since
+MAX_BATCH = 256 # the events in one published message
+
+Event = List[bytes]
+Fetch = Callable[[bytes, int], Awaitable[List[bytes]]] # epoch, seq -> the reply of fs.changes_since
+
+def pack_event(frames: List) -> bytes:
+    return b"".join(LENGTH.pack(len(frame)) + bytes(frame) for frame in frames)
+
+def unpack_event(packed) -> Event:
+    packed = bytes(packed)
+    frames = []
+    offset = 0
+    while offset < len(packed):
+        (length,) = LENGTH.unpack_from(packed, offset)
+        offset += LENGTH.size
+        frames.append(packed[offset:offset+length])
+        offset += length
+    return frames
+
+class ChangeCursor(object):
+    def __init__(self) -> None:
+        self.epoch: Optional[bytes] = None
+        self.last_seq = 0
+
+    async def start(self, fetch: Fetch) -> None:
+        """Take the current position of the feed, before the subscriber syncs its state by the commands."""
+        reply = await fetch(b"", 0) # no epoch: 1 | epoch | last_seq
+        self.epoch = bytes(reply[1])
+        self.last_seq = int(bytes(reply[2]))
+
+    async def receive(self, frames: List, fetch: Optional[Fetch] = None) -> Optional[List[Event]]:
+        """Return the events to apply for a published batch, the missed events before it fetched by `fetch` included.
+        Return None if the missed events could not be fetched: the subscriber resyncs its state."""
+        epoch = bytes(frames[1])
+        first_seq = int(bytes(frames[2]))
+        packed = list(frames[3:])
+        if epoch != self.epoch or first_seq > self.last_seq + 1:
+            reply = (await fetch(epoch, self.last_seq)) if (fetch and epoch == self.epoch) else None
+            if (reply is None) or reply[0][0] != 0:
+                self.epoch = bytes(reply[1]) if reply else epoch
+                self.last_seq = int(bytes(reply[2])) if reply else first_seq + len(packed) - 1
+                return None
+            # the reply has every event after the position, this batch included
+            first_seq = int(bytes(reply[2]))
+            packed = list(reply[3:])
+        skipped = max(self.last_seq + 1 - first_seq, 0) # applied already, by a reply
+        self.last_seq = max(self.last_seq, first_seq + len(packed) - 1)
+        return [unpack_event(event) for event in packed[skipped:]]
@@ -0,0 +1,254 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Content-addressed chunks.
+A file is split into fixed-size chunks (the same size used to transfer them, so a chunk can be fetched by fs.read_chunk),
+each chunk is named by its sha256 digest and the file is described by its manifest: the size and the list of digests.
+ChunkStore keeps one copy of each unique chunk in a backend (see backend.py), counts the files referencing it
+and writes the manifests beside, so identical parts of files are stored (and downloaded) once.
+The content of a file in a ChunkStore is a ChunkedContent, use `view()` and `as_buffer()` to read both kinds of contents.
+A download in progress pins the chunks of its manifest, so a chunk another download (or a released file) left unreferenced
+is not collected under it.
+The store counts the bytes of the chunks it keeps. With a budget, `reclaim` is called when a new chunk takes it over the
+budget, the owner of the store releases some files there (see StorageServerStore in storage.py).
+A file evicted that way keeps its manifest as "evicted.<filename>", so it is known after a restart (`load()` returns
+it without a content) and only downloaded again when it is read.
+"""
+import struct
+from collections import OrderedDict
+from hashlib import sha256
+from typing import List, Dict, Tuple, Iterable, Union, Optional, Callable, Set
+from .backend import Buffer
+
+CHUNK_SIZE = 256 * 1024
+DIGEST_SIZE = 32
+MAPPED_CHUNKS = 256 # each mapped chunk holds a file descriptor in the disk backend
+PIECES_MAPPED = 64 # the chunks of one content held mapped at once by pieces(), past that they are copied
+MANIFEST_HEADER = struct.Struct("!QI") # size, chunk_size
+
+def digest_of(chunk) -> bytes:
+    return sha256(chunk).digest()
+
+def digests_of(content, chunk_size: int = CHUNK_SIZE) -> List[bytes]:
+    view = memoryview(content)
+    return [digest_of(view[i:i+chunk_size]) for i in range(0, len(view), chunk_size)]
+
+def file_digest(digests: List[bytes]) -> bytes:
+    """The digest of a whole file: the digest of its manifest, so a manifest is checked without its chunks."""
+    return digest_of(b"".join(digests))
+
+def split_digests(digests_bytes: bytes) -> List[bytes]:
+    return [digests_bytes[i:i+DIGEST_SIZE] for i in range(0, len(digests_bytes), DIGEST_SIZE)]
+
+class ChunkedContent(object):
+    __slots__ = ('store', 'size', 'chunk_size', 'digests')
+
+    def __init__(self, store: "ChunkStore", size: int, chunk_size: int, digests: List[bytes]) -> None:
+        self.store = store
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = digests
+
+    def __len__(self) -> int:
+        return self.size
+
+    def slice(self, start: int, stop: int) -> Union[memoryview, bytes, bytearray]:
+        """Return the content in [start, stop). It is a view without copying when the range is in one chunk,
+        otherwise the chunks are copied one by one, so only one of them is mapped by the range at a time."""
+        stop = min(stop, self.size)
+        if start >= stop:
+            return b""
+        index = start // self.chunk_size
+        chunk_start = index * self.chunk_size
+        if stop <= chunk_start + self.chunk_size:
+            return memoryview(self.store.get(self.digests[index]))[start-chunk_start:stop-chunk_start]
+        out = bytearray()
+        while start < stop:
+            chunk_start = index * self.chunk_size
+            chunk = memoryview(self.store.get(self.digests[index]))
+            out += chunk[start-chunk_start:min(stop, chunk_start + self.chunk_size)-chunk_start]
+            chunk.release()
+            start = chunk_start + self.chunk_size
+            index += 1
+        return out
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.slice(0, self.size))
+
+def view(content, start: int, stop: int):
+    if isinstance(content, ChunkedContent):
+        return content.slice(start, stop)
+    return memoryview(content)[start:stop]
+
+def pieces(content) -> List:
+    """Return the buffers making `content`, the chunks of a ChunkedContent as they are kept (without joining them).
+    A view holds its map (a file descriptor in the disk backend) until the frame is sent, so the chunks of a content
+    longer than PIECES_MAPPED chunks are copied instead, each one released before the next is mapped."""
+    if isinstance(content, ChunkedContent):
+        if len(content.digests) <= PIECES_MAPPED:
+            return [memoryview(content.store.get(digest)) for digest in content.digests]
+        return [bytes(content.store.get(digest)) for digest in content.digests]
+    return [content]
+
+def as_buffer(content):
+    if isinstance(content, ChunkedContent):
+        return bytes(content)
+    return content
+
+def manifest_of(vfile) -> Tuple[int, List[bytes]]:
+    """Return (chunk_size, digests) of a VirtualFile, the digests of a plain content are computed once and kept in `vfile.digests`."""
+    if isinstance(vfile.content, ChunkedContent):
+        return (vfile.content.chunk_size, vfile.content.digests)
+    if getattr(vfile, 'digests', None) is None:
+        vfile.digests = digests_of(vfile.content)
+    return (CHUNK_SIZE, vfile.digests)
+
+class ChunkStore(object):
+    """Keep the chunks in `backend` as "chunk.<hex digest>" and the manifests as "manifest.<filename>",
+    or "evicted.<filename>" when the file is evicted."""
+    def __init__(self, backend, budget: Optional[int] = None) -> None:
+        self.backend = backend
+        self.refcounts: Dict[bytes, int] = {}
+        self.pins: Dict[bytes, int] = {}
+        self.mapped: "OrderedDict[bytes, Buffer]" = OrderedDict()
+        self.sizes: Dict[bytes, int] = {}
+        self.stored_bytes = 0
+        self.budget = budget
+        self.reclaim: Optional[Callable[[int], None]] = None # called with the bytes over the budget
+        self.evicted: Set[str] = set() # the files having an "evicted." manifest
+
+    @staticmethod
+    def chunk_name(digest: bytes) -> str:
+        return "chunk." + digest.hex()
+
+    def has(self, digest: bytes) -> bool:
+        return digest in self.refcounts
+
+    def get(self, digest: bytes) -> Buffer:
+        chunk = self.mapped.get(digest, None)
+        if chunk is None:
+            chunk = self.backend.get(self.chunk_name(digest))
+            self.mapped[digest] = chunk
+            if len(self.mapped) > MAPPED_CHUNKS:
+                self.mapped.popitem(last=False)
+        else:
+            self.mapped.move_to_end(digest)
+        return chunk
+
+    def put_chunk(self, digest: bytes, chunk: bytes) -> None:
+        """Keep a chunk which is not referenced yet, call `collect()` to drop it if `add()` will not be called."""
+        if digest not in self.refcounts:
+            self.backend.put(self.chunk_name(digest), chunk)
+            self.refcounts[digest] = 0
+            self.sizes[digest] = len(chunk)
+            self.stored_bytes += len(chunk)
+            if (self.budget is not None) and self.stored_bytes > self.budget and self.reclaim:
+                self.reclaim(self.stored_bytes - self.budget)
+
+    def add(self, filename: str, size: int, chunk_size: int, digests: List[bytes]) -> ChunkedContent:
+        self.backend.put("manifest." + filename, MANIFEST_HEADER.pack(size, chunk_size) + b"".join(digests))
+        self.forget(filename)
+        return self._reference(size, chunk_size, digests)
+
+    def _reference(self, size: int, chunk_size: int, digests: List[bytes]) -> ChunkedContent:
+        for digest in digests:
+            self.refcounts[digest] += 1
+        return ChunkedContent(self, size, chunk_size, digests)
+
+    def put(self, filename: str, content: bytes, chunk_size: int = CHUNK_SIZE) -> ChunkedContent:
+        view = memoryview(content)
+        digests = digests_of(view, chunk_size)
+        # pinned until referenced: a chunk put may reclaim a file sharing the chunks put before it
+        self.pin(digests)
+        added: Optional[ChunkedContent] = None
+        try:
+            for index, digest in enumerate(digests):
+                self.put_chunk(digest, bytes(view[index*chunk_size:(index+1)*chunk_size]))
+            added = self.add(filename, len(view), chunk_size, digests)
+            return added
+        finally:
+            self.unpin(digests)
+            if added is None:
+                self.collect(digests)
+
+    def pin(self, digests: Iterable[bytes]) -> None:
+        for digest in digests:
+            self.pins[digest] = self.pins.get(digest, 0) + 1
+
+    def unpin(self, digests: Iterable[bytes]) -> None:
+        for digest in digests:
+            self.pins[digest] -= 1
+            if self.pins[digest] == 0:
+                self.pins.pop(digest)
+
+    def release(self, filename: str, content: ChunkedContent) -> None:
+        self.backend.remove("manifest." + filename)
+        self.unreference(content)
+
+    def unreference(self, content: ChunkedContent) -> None:
+        """Drop the references of a content, without its manifest. Used when a new version replaced it under the same filename."""
+        for digest in content.digests:
+            self.refcounts[digest] -= 1
+        self.collect(content.digests)
+
+    def evict(self, filename: str, content: ChunkedContent) -> None:
+        """Release the content of a file but keep its manifest, flagged evicted."""
+        self.backend.put("evicted." + filename, MANIFEST_HEADER.pack(content.size, content.chunk_size) + b"".join(content.digests))
+        self.evicted.add(filename)
+        self.release(filename, content)
+
+    def forget(self, filename: str) -> None:
+        """Drop the manifest of an evicted file."""
+        if filename in self.evicted:
+            self.evicted.discard(filename)
+            self.backend.remove("evicted." + filename)
+
+    def collect(self, digests: Iterable[bytes]) -> None:
+        for digest in set(digests):
+            if self.refcounts.get(digest, None) == 0 and digest not in self.pins:
+                self.refcounts.pop(digest)
+                self.mapped.pop(digest, None)
+                self.stored_bytes -= self.sizes.pop(digest)
+                self.backend.remove(self.chunk_name(digest))
+
+    def load(self) -> Iterable[Tuple[str, Optional[ChunkedContent]]]:
+        """Rebuild the refcounts from the manifests kept by the backend, the chunks no manifest references are dropped.
+        The evicted files are returned without a content."""
+        names = list(self.backend.names())
+        for name in names:
+            if name.startswith("chunk."):
+                digest = bytes.fromhex(name[len("chunk."):])
+                self.refcounts[digest] = 0
+                self.sizes[digest] = self.backend.size(name)
+                self.stored_bytes += self.sizes[digest]
+            elif name.startswith("evicted."):
+                self.evicted.add(name[len("evicted."):])
+        files: List[Tuple[str, Optional[ChunkedContent]]] = []
+        for name in names:
+            if name.startswith("manifest."):
+                manifest = bytes(self.backend.get(name))
+                size, chunk_size = MANIFEST_HEADER.unpack_from(manifest)
+                digests = split_digests(manifest[MANIFEST_HEADER.size:])
+                if all(self.has(digest) for digest in digests):
+                    filename = name[len("manifest."):]
+                    self.forget(filename) # stopped while it was downloaded again
+                    files.append((filename, self._reference(size, chunk_size, digests)))
+                else:
+                    self.backend.remove(name)
+        files += [(filename, None) for filename in self.evicted]
+        self.collect(list(self.refcounts.keys()))
+        return files
@@ -0,0 +1,139 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Compression of the contents sent between peers, negotiated for each transfer.
+The reader offers codecs in its request, preferred first, each one with an optional level: "zlib:9,lzma,bz2".
+The serving peer compresses with the first codec it knows and replies the codec used, or "identity" when the content
+is not worth it: it is small, it starts like a compressed format (gzip, zip, png, jpeg, xz...), or a fast compression
+of a sample of it saves almost nothing. The result of a full compression which saves almost nothing is remembered too.
+The compressed contents are kept in a CompressionCache by the digest of the content, the codec and the level,
+so a hot chunk is compressed once for all its readers. The compression runs in the default executor (the codecs
+release the GIL), the readers asking for a content being compressed wait for the same result.
+"""
+import asyncio
+import bz2
+import lzma
+import zlib
+from collections import OrderedDict
+from typing import Dict, Tuple, Optional, Callable
+
+IDENTITY = "identity"
+CODECS: Dict[str, Tuple[Callable[[bytes, int], bytes], Callable[[bytes], bytes], int]] = {
+    # name -> (compress, decompress, default level)
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress, 6),
+    "bz2": (lambda data, level: bz2.compress(data, level), bz2.decompress, 9),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6),
+}
+LEVELS = {"zlib": (0, 9), "bz2": (1, 9), "lzma": (0, 9)}
+DEFAULT_OFFER = "zlib"
+
+MIN_SIZE = 512 # smaller contents are sent as they are
+SAMPLE_SIZE = 4096
+WORTH_RATIO = 0.9 # compress only if the sample shrinks below this ratio
+CACHE_CAPACITY = 64 * 1024 * 1024 # bytes of compressed contents
+ENTRY_OVERHEAD = 128 # counted for each entry, so the entries of the contents not worth compressing are bounded too
+COMPRESSED_MAGICS = (
+    b"\x1f\x8b", # gzip
+    b"PK\x03\x04", # zip, jar, docx...
+    b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"RIFF", # images, webp, wav
+    b"\xfd7zXZ\x00", b"BZh", b"\x28\xb5\x2f\xfd", b"7z\xbc\xaf", b"Rar!", # xz, bz2, zstd, 7z, rar
+    b"OggS", b"fLaC", b"ID3", b"\x1aE\xdf\xa3", # ogg, flac, mp3, matroska
+)
+
+def choose_codec(offered: str) -> Tuple[str, int]:
+    """Return the first codec of `offered` known here and its level, or (IDENTITY, 0)."""
+    for item in offered.split(','):
+        name, _, level = item.strip().partition(':')
+        if name in CODECS:
+            low, high = LEVELS[name]
+            return (name, min(max(int(level), low), high) if level else CODECS[name][2])
+    return (IDENTITY, 0)
+
+def worth_compressing(data) -> bool:
+    if len(data) < MIN_SIZE:
+        return False
+    head = bytes(data[:8])
+    if any(head.startswith(magic) for magic in COMPRESSED_MAGICS) or head[4:8] == b"ftyp": # mp4, mov
+        return False
+    middle = len(data) // 2
+    sample = bytes(data[max(middle - SAMPLE_SIZE // 2, 0):middle + SAMPLE_SIZE // 2])
+    return len(zlib.compress(sample, 1)) < len(sample) * WORTH_RATIO
+
+def compress(data, codec: str, level: int) -> Optional[bytes]:
+    """Return the compressed data, or None if it is not worth it."""
+    if codec == IDENTITY or not worth_compressing(data):
+        return None
+    compressed = CODECS[codec][0](bytes(data), level)
+    if len(compressed) >= len(data) * WORTH_RATIO:
+        return None
+    return compressed
+
+def decompress(data: bytes, codec: str) -> Optional[bytes]:
+    """Return `data` decompressed by `codec`, or None if the codec is unknown or `data` was not made by it."""
+    if codec == IDENTITY:
+        return data
+    if codec not in CODECS:
+        return None
+    try:
+        return CODECS[codec][1](data)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError):
+        return None
+
+class CompressionCache(object):
+    def __init__(self, capacity: int = CACHE_CAPACITY) -> None:
+        self.capacity = capacity
+        self.size = 0
+        self.entries: "OrderedDict[Tuple[bytes, str, int], Optional[bytes]]" = OrderedDict() # None: not worth compressing
+        self.compressing: Dict[Tuple[bytes, str, int], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    async def compress(self, key: bytes, data, codec: str, level: int) -> Tuple[str, object]:
+        """Return the codec used and the content to send for `data`, whose digest is `key`."""
+        if codec == IDENTITY:
+            return (IDENTITY, data)
+        entry_key = (key, codec, level)
+        if entry_key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(entry_key)
+            compressed = self.entries[entry_key]
+        else:
+            future = self.compressing.get(entry_key, None)
+            if future is None:
+                self.misses += 1
+                future = self.compressing[entry_key] = asyncio.get_event_loop().run_in_executor(None, compress, bytes(data), codec, level)
+                future.add_done_callback(lambda done: self._compressed(entry_key, done))
+            else:
+                self.hits += 1
+            compressed = await asyncio.shield(future) # a reader going away does not lose the result for the others
+        if compressed is None:
+            self.skipped += 1
+            return (IDENTITY, data)
+        return (codec, compressed)
+
+    def _compressed(self, entry_key: Tuple[bytes, str, int], future: asyncio.Future) -> None:
+        self.compressing.pop(entry_key, None)
+        if (not future.cancelled()) and future.exception() is None:
+            self._put(entry_key, future.result())
+
+    def _put(self, entry_key: Tuple[bytes, str, int], compressed: Optional[bytes]) -> None:
+        self.entries[entry_key] = compressed
+        self.size += (len(compressed) if compressed else 0) + ENTRY_OVERHEAD
+        while self.size > self.capacity:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= (len(evicted) if evicted else 0) + ENTRY_OVERHEAD
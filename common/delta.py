@@ -0,0 +1,131 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Delta transfer of a changed file, the way rsync does it.
+The reader holding the previous version splits it into blocks and sends their signatures:
+a weak checksum (adler32, which can be rolled one byte at a time) and a strong one (md5).
+The peer holding the new version slides a window over it, a window whose weak and strong checksums match a block
+is sent as a reference to that block and the window jumps over it, the bytes between the matches are sent as they are.
+So the matching costs one adler32 and one lookup per block where the file did not change, and rolls byte by byte
+only through the changed parts. When more than a quarter of the new version would be sent as it is, or more than
+MAX_ROLLED bytes (rolling costs about a microsecond a byte here, so the scan stays within seconds whatever the size
+is), the delta is given up (`make_delta()` returns None) and the reader downloads the file in full instead.
+A delta is a sequence of instructions: `1 (!B) | first block (!I) | block count (!I)` copies blocks of the previous
+version, `2 (!B) | length (!I) | bytes` inserts bytes.
+"""
+import hashlib
+import math
+import struct
+import zlib
+from typing import Dict, List, Optional
+
+MIN_BLOCK = 1024
+MAX_BLOCK = 64 * 1024
+MOD = 65521 # of adler32
+SIGNATURE = struct.Struct("!I16s") # weak, strong
+COPY = struct.Struct("!BII")
+LITERAL = struct.Struct("!BI")
+OP_COPY = 1
+OP_LITERAL = 2
+MAX_LITERAL_RATIO = 0.25
+MAX_ROLLED = 8 * 1024 * 1024 # bytes
+
+def block_size_for(size: int) -> int:
+    """About the square root of the size, so the signatures and the bytes resent around a change stay balanced."""
+    return max(MIN_BLOCK, min(MAX_BLOCK, int(math.sqrt(size)) // 256 * 256))
+
+def strong_checksum(block) -> bytes:
+    return hashlib.md5(block).digest()
+
+def signatures(content: bytes, block_size: int) -> bytes:
+    """Return the signatures of the full blocks of `content`, the bytes after the last full block are not matched."""
+    view = memoryview(content)
+    return b"".join(
+        SIGNATURE.pack(zlib.adler32(view[offset:offset+block_size]), strong_checksum(view[offset:offset+block_size]))
+        for offset in range(0, len(view) - block_size + 1, block_size)
+    )
+
+def make_delta(content: bytes, block_size: int, signatures_bytes: bytes, max_rolled: int = MAX_ROLLED) -> Optional[bytes]:
+    """Return the instructions rebuilding `content` from the blocks signed by `signatures_bytes`, or None if it is not worth it."""
+    table: Dict[int, Dict[bytes, int]] = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures_bytes)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    view = memoryview(content)
+    size = len(content)
+    max_literal = min(size * MAX_LITERAL_RATIO, max_rolled) # the bytes sent as they are were rolled through
+    out: List[bytes] = []
+    literal_bytes = 0
+    literal_start = 0
+    copy_first = copy_count = 0
+
+    def flush(end: int) -> None:
+        nonlocal copy_count, literal_bytes
+        if copy_count:
+            out.append(COPY.pack(OP_COPY, copy_first, copy_count))
+            copy_count = 0
+        if end > literal_start:
+            out.append(LITERAL.pack(OP_LITERAL, end - literal_start))
+            out.append(bytes(view[literal_start:end]))
+            literal_bytes += end - literal_start
+
+    position = 0
+    weak: Optional[int] = None
+    while position + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(view[position:position+block_size])
+        strongs = table.get(weak, None)
+        if strongs:
+            index = strongs.get(strong_checksum(view[position:position+block_size]), None)
+            if index is not None:
+                if position > literal_start or (copy_count and copy_first + copy_count != index):
+                    flush(position)
+                if copy_count == 0:
+                    copy_first = index
+                copy_count += 1
+                position += block_size
+                literal_start = position
+                weak = None
+                continue
+        if position - literal_start + literal_bytes > max_literal:
+            return None
+        if position + block_size < size: # roll the window one byte forward
+            leaving = content[position]
+            entering = content[position + block_size]
+            a = ((weak & 0xffff) - leaving + entering) % MOD
+            b = ((weak >> 16) - block_size * leaving + a - 1) % MOD
+            weak = (b << 16) | a
+        position += 1
+    flush(size)
+    if literal_bytes > max_literal:
+        return None
+    return b"".join(out)
+
+def apply_delta(previous: bytes, block_size: int, delta: bytes) -> bytes:
+    view = memoryview(previous)
+    parts = []
+    offset = 0
+    while offset < len(delta):
+        if delta[offset] == OP_COPY:
+            _, first, count = COPY.unpack_from(delta, offset)
+            parts.append(view[first*block_size:(first+count)*block_size])
+            offset += COPY.size
+        else:
+            _, length = LITERAL.unpack_from(delta, offset)
+            offset += LITERAL.size
+            parts.append(delta[offset:offset+length])
+            offset += length
+    return b"".join(parts)
@@ -0,0 +1,194 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Write-ahead log with snapshots, which keeps the state of an in-memory store across restarts.
+A record is an operation code and a few byte strings: `length (!I) | crc32 (!I) | op (!B) | (field length (!H) | field)...`.
+The records are appended to "log.<generation>" by `append()` and made durable by `sync()`, the caller batches
+the mutations of many requests and syncs once before replying them (group commit).
+`snapshot()` writes the whole state, encoded by the caller, into "snapshot" and starts a new generation of log,
+the older logs are removed. The snapshot is one blob rather than records, so the caller could decode it in bulk.
+`snapshot_in_background()` starts the new generation at once and forks a child process to encode and write the
+snapshot: the child has the state as it was at the fork (the pages are copied on write), so the caller goes on
+serving meanwhile. The older logs are removed by the child once the snapshot is written, until then the previous
+snapshot and the logs after it still rebuild the state. Without os.fork() the snapshot is written in place.
+`load()` returns the snapshot and the records of the logs after it,
+a torn record at the end of the last log (the server stopped while writing it) is cut off.
+"""
+import os
+import struct
+import zlib
+from typing import Callable, Iterable, List, Tuple, BinaryIO, Optional
+
+RECORD_HEADER = struct.Struct("!II") # length of the body, crc32 of the body
+FIELD_LENGTH = struct.Struct("!H")
+SNAPSHOT_HEADER = struct.Struct("!QI") # the generation of the first log after the snapshot, crc32 of the content
+
+Record = Tuple[int, List[bytes]]
+
+def encode_record(op: int, fields: Iterable[bytes]) -> bytes:
+    parts = [bytes([op])]
+    for field in fields:
+        parts.append(FIELD_LENGTH.pack(len(field)))
+        parts.append(field)
+    body = b"".join(parts)
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+def decode_records(content: bytes) -> Tuple[List[Record], int]:
+    """Return the complete records in `content` and the offset after the last one."""
+    # It runs for each record of millions at startup, so the lookups are kept in locals and the field lengths are read inline
+    records: List[Record] = []
+    append = records.append
+    unpack_header = RECORD_HEADER.unpack_from
+    header_size = RECORD_HEADER.size
+    crc32 = zlib.crc32
+    offset = 0
+    end = len(content)
+    while offset + header_size <= end:
+        length, crc = unpack_header(content, offset)
+        start = offset + header_size
+        stop = start + length
+        if stop > end or crc32(content[start:stop]) != crc:
+            break
+        fields: List[bytes] = []
+        position = start + 1
+        while position < stop:
+            field_stop = position + 2 + ((content[position] << 8) | content[position+1])
+            fields.append(content[position+2:field_stop])
+            position = field_stop
+        append((content[start], fields))
+        offset = stop
+    return (records, offset)
+
+class Journal(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.generation = 0
+        self.log: Optional[BinaryIO] = None
+        self.dirty = False
+        self.records_since_snapshot = 0
+        self.snapshotting: Optional[int] = None # the pid of the child writing a snapshot
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.path, "log.{}".format(generation))
+
+    def _log_generations(self) -> List[int]:
+        return sorted(int(name[len("log."):]) for name in os.listdir(self.path) if name.startswith("log."))
+
+    def load(self) -> Tuple[Optional[bytes], List[Record]]:
+        """Return the snapshot (None if there is not one) and the records logged after it,
+        then open the log to append the next records. Call it once before `append()`."""
+        snapshot: Optional[bytes] = None
+        snapshot_path = os.path.join(self.path, "snapshot")
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, mode='rb') as f:
+                content = f.read()
+            self.generation, crc = SNAPSHOT_HEADER.unpack_from(content)
+            snapshot = content[SNAPSHOT_HEADER.size:]
+            if zlib.crc32(snapshot) != crc:
+                raise ValueError("the snapshot in {} is corrupted".format(self.path))
+        records: List[Record] = []
+        for generation in self._log_generations():
+            if generation < self.generation:
+                os.unlink(self._log_path(generation)) # already in the snapshot
+                continue
+            with open(self._log_path(generation), mode='rb') as f:
+                content = f.read()
+            log_records, good_length = decode_records(content)
+            if good_length < len(content):
+                with open(self._log_path(generation), mode='r+b') as f:
+                    f.truncate(good_length)
+            records += log_records
+            self.generation = generation
+        self.records_since_snapshot = len(records)
+        self.log = open(self._log_path(self.generation), mode='ab')
+        return (snapshot, records)
+
+    def append(self, op: int, *fields: bytes) -> None:
+        self.log.write(encode_record(op, fields))
+        self.dirty = True
+        self.records_since_snapshot += 1
+
+    def sync(self) -> None:
+        if self.dirty:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.dirty = False
+        if self.snapshotting is not None:
+            self.snapshot_done()
+
+    def _rotate(self) -> int:
+        """Start a new generation of log, return it: the next snapshot is the state before it."""
+        self.sync()
+        self.log.close()
+        self.generation += 1
+        self.log = open(self._log_path(self.generation), mode='ab')
+        self.records_since_snapshot = 0
+        return self.generation
+
+    def _write_snapshot(self, generation: int, content: bytes) -> None:
+        snapshot_path = os.path.join(self.path, "snapshot")
+        with open(snapshot_path + ".tmp", mode='wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(generation, zlib.crc32(content)))
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        for older in self._log_generations():
+            if older < generation:
+                os.unlink(self._log_path(older))
+
+    def snapshot(self, content: bytes) -> None:
+        """Replace the snapshot and the logs by `content`, which must rebuild the current state."""
+        self._write_snapshot(self._rotate(), content)
+
+    def snapshot_in_background(self, encode: Callable[[], bytes]) -> bool:
+        """Write the state encoded by `encode()` as the snapshot, from a child process.
+        Return False if the previous snapshot is still being written, nothing is done then."""
+        if not self.snapshot_done():
+            return False
+        generation = self._rotate()
+        if not hasattr(os, 'fork'):
+            self._write_snapshot(generation, encode())
+            return True
+        pid = os.fork()
+        if pid == 0: # the child: no cleanup of the parent's objects, the sockets and the log are the parent's
+            status = 1
+            try:
+                self._write_snapshot(generation, encode())
+                status = 0
+            finally:
+                os._exit(status)
+        self.snapshotting = pid
+        return True
+
+    def snapshot_done(self, wait: bool = False) -> bool:
+        """Return if no snapshot is being written, reap the child which wrote the last one."""
+        if self.snapshotting is None:
+            return True
+        pid, _ = os.waitpid(self.snapshotting, 0 if wait else os.WNOHANG)
+        if pid == 0:
+            return False
+        self.snapshotting = None # if it failed, the logs it did not remove still rebuild the state
+        return True
+
+    def close(self) -> None:
+        self.snapshot_done(wait=True)
+        if self.log:
+            self.sync()
+            self.log.close()
+            self.log = None
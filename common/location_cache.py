@@ -0,0 +1,146 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Client-side cache of file locations (the replies of fs.locate).
+Entries expire after `ttl` seconds and the least recently used ones are evicted beyond `capacity`.
+The cache is kept coherent by the events published by the directory server on the PUB port:
+* fs.new_file | filename, fs.delete_file | filename, fs.declare_file | filename | device_name, fs.update | filename...: the entry is dropped
+* fs.disown_file | filename | device_name: the device is removed from the entry
+* device.new_address | device_name | address: the address is added to the entries having the device
+* device.expire_address | device_name | address: the address is removed from the entries having the device
+Pass every event to `handle_event()` and call `clear()` when events are missed (see common/changes.py),
+or run `follow()` to subscribe with a socket of its own.
+"""
+import time
+import zmq
+from collections import OrderedDict
+from zmq.asyncio import Socket, Context
+from typing import List, Dict, Set, Tuple, Optional, Callable, Awaitable
+from common import changes
+
+TTL = 30.0
+CAPACITY = 4096
+EVENT_TOPICS = (changes.TOPIC,)
+
+Locations = Dict[str, List[str]]
+
+class LocationCache(object):
+    def __init__(self, ttl: float = TTL, capacity: int = CAPACITY) -> None:
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries: "OrderedDict[str, Tuple[float, Locations]]" = OrderedDict()
+        self.device_files: Dict[str, Set[str]] = {} # device name -> the cached filenames it declared
+        self.generation = 0 # increased by each event, a reply fetched across an event is not cached
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename: str) -> Optional[Locations]:
+        entry = self.entries.get(filename, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        expire_time, locations = entry
+        if expire_time < time.monotonic():
+            self.invalidate(filename)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(filename)
+        self.hits += 1
+        return locations
+
+    def put(self, filename: str, locations: Locations) -> None:
+        self.invalidate(filename)
+        self.entries[filename] = (time.monotonic() + self.ttl, locations)
+        for device_name in locations:
+            self.device_files.setdefault(device_name, set()).add(filename)
+        while len(self.entries) > self.capacity:
+            self.invalidate(next(iter(self.entries)))
+
+    def invalidate(self, filename: str) -> None:
+        entry = self.entries.pop(filename, None)
+        if entry is None:
+            return
+        for device_name in entry[1]:
+            filenames = self.device_files.get(device_name, None)
+            if filenames is not None:
+                filenames.discard(filename)
+                if not filenames:
+                    self.device_files.pop(device_name)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.entries.clear()
+        self.device_files.clear()
+
+    async def locate(self, filename: str, fetch: Callable[[], Awaitable[Locations]]) -> Locations:
+        """Return the cached locations of `filename`, or await `fetch()` and cache the result."""
+        locations = self.get(filename)
+        if locations is None:
+            generation = self.generation
+            locations = await fetch()
+            if generation == self.generation:
+                self.put(filename, locations)
+        return locations
+
+    def handle_event(self, frames: List[bytes]) -> None:
+        self.generation += 1
+        event = bytes(frames[0])
+        if event in (b"fs.new_file", b"fs.delete_file", b"fs.declare_file", b"fs.update"):
+            self.invalidate(str(frames[1], 'utf8'))
+        elif event == b"fs.disown_file":
+            filename = str(frames[1], 'utf8')
+            device_name = str(frames[2], 'utf8')
+            entry = self.entries.get(filename, None)
+            if entry and (device_name in entry[1]):
+                entry[1].pop(device_name)
+                filenames = self.device_files[device_name]
+                filenames.discard(filename)
+                if not filenames:
+                    self.device_files.pop(device_name)
+        elif event == b"device.new_address":
+            device_name = str(frames[1], 'utf8')
+            address = str(frames[2], 'utf8')
+            for filename in self.device_files.get(device_name, ()):
+                addresses = self.entries[filename][1][device_name]
+                if address not in addresses:
+                    addresses.append(address)
+        elif event == b"device.expire_address":
+            device_name = str(frames[1], 'utf8')
+            address = str(frames[2], 'utf8')
+            for filename in self.device_files.get(device_name, ()):
+                addresses = self.entries[filename][1][device_name]
+                if address in addresses:
+                    addresses.remove(address)
+
+    async def follow(self, context: Context, address: str) -> None:
+        """Subscribe the events on `address` and apply them until cancelled. The missed events are not fetched,
+        the cache is cleared instead."""
+        sub: Socket = context.socket(zmq.SUB)
+        sub.connect(address)
+        for topic in EVENT_TOPICS:
+            sub.setsockopt(zmq.SUBSCRIBE, topic)
+        cursor = changes.ChangeCursor()
+        try:
+            while True:
+                events = await cursor.receive(await sub.recv_multipart())
+                if events is None:
+                    self.clear()
+                    continue
+                for event in events:
+                    self.handle_event(event)
+        finally:
+            sub.close(linger=0)
@@ -0,0 +1,74 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Leveled and rate-limited logging, through the standard logging module, to stderr.
+The levels: DEBUG for each command and event handled, INFO for the changes of the network (devices, addresses,
+placement) and the lifecycle of the process, WARNING for the failures. The level is given by `--log-level`, INFO by
+default. The messages are formatted lazily (`log.debug("... %s", arg)`), so a disabled level costs one check.
+Each message, by its logger and its format string, is let through at most RATE times per second after a burst of BURST,
+the messages dropped meanwhile are counted and told by the next one let through. A burst of commands logs a few lines
+instead of one line each.
+"""
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+LEVEL_OPTION = "--log-level"
+DEFAULT_LEVEL = "info"
+RATE = 10.0 # messages per second, for each format string
+BURST = 20
+
+class RateLimit(logging.Filter):
+    def __init__(self, rate: float = RATE, burst: int = BURST) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[Tuple[str, str], List[float]] = {} # (logger, format) -> [tokens, updated at, dropped]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        key = (record.name, str(record.msg))
+        bucket = self.buckets.get(key, None)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now, 0]
+        bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1.0
+        if bucket[2]:
+            record.msg = "{} ({} similar messages dropped)".format(record.msg, int(bucket[2]))
+            bucket[2] = 0
+        return True
+
+def setup(level: Optional[str] = None) -> None:
+    handler = logging.StreamHandler()
+    handler.addFilter(RateLimit())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel((level or DEFAULT_LEVEL).upper())
+
+def pop_level(args: List[str]) -> Optional[str]:
+    """Remove `--log-level LEVEL` from the arguments, return LEVEL or None."""
+    if LEVEL_OPTION not in args:
+        return None
+    index = args.index(LEVEL_OPTION)
+    level = args[index + 1]
+    del args[index:index+2]
+    return level
@@ -0,0 +1,134 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The counters of the commands served by a process, reported by its `stats` command as JSON:
+`{"uptime": seconds, "commands": {command: {"count", "bytes_in", "bytes_out", "latency_us": {...}}}, ...}`
+(the directory server and the storage servers add their queues and the sizes of their stores).
+The latencies are kept in a histogram of BUCKETS buckets: bucket i counts the latencies from 2**(i-1) to 2**i
+microseconds, so observing a latency is a bit_length() and an increment, the histogram stays a few dozen integers
+whatever the traffic is, and the histograms of many processes are merged by adding them (see `merge_commands()`).
+The percentiles reported are the upper bounds of their buckets, within a factor of 2 of the exact ones.
+"""
+import time
+from typing import Any, Awaitable, Dict, Hashable, Iterable, List
+
+BUCKETS = 32 # the last one takes the latencies over 2**30 microseconds
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+def frames_size(frames: Iterable) -> int:
+    return sum(len(frame) for frame in frames)
+
+def percentile(histogram: List[int], fraction: float) -> int:
+    """Return the upper bound (in microseconds) of the bucket holding the `fraction` percentile, 0 if it is empty."""
+    total = sum(histogram)
+    if total == 0:
+        return 0
+    rank = fraction * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            return 1 << index
+    return 1 << (len(histogram) - 1)
+
+class CommandStats(object):
+    __slots__ = ('count', 'bytes_in', 'bytes_out', 'histogram', 'max')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.histogram = [0] * BUCKETS
+        self.max = 0 # microseconds
+
+    def observe(self, elapsed: float, bytes_in: int, bytes_out: int) -> None:
+        micros = int(elapsed * 1000000)
+        self.count += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.histogram[min(micros.bit_length(), BUCKETS - 1)] += 1
+        if micros > self.max:
+            self.max = micros
+
+    def add(self, report: Dict[str, Any]) -> None:
+        """Add the counters of another report of the same command."""
+        self.count += report["count"]
+        self.bytes_in += report["bytes_in"]
+        self.bytes_out += report["bytes_out"]
+        latency = report["latency_us"]
+        for index, count in enumerate(latency["histogram"]):
+            self.histogram[index] += count
+        self.max = max(self.max, latency["max"])
+
+    def report(self) -> Dict[str, Any]:
+        used = len(self.histogram)
+        while used and not self.histogram[used - 1]:
+            used -= 1
+        latency: Dict[str, Any] = {name: percentile(self.histogram, fraction) for name, fraction in PERCENTILES}
+        latency["max"] = self.max
+        latency["histogram"] = self.histogram[:used] # trailing empty buckets are cut
+        return {"count": self.count, "bytes_in": self.bytes_in, "bytes_out": self.bytes_out, "latency_us": latency}
+
+def merge_commands(reports: Iterable[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Merge the "commands" of a few reports, the counters and the histograms of a command are added."""
+    merged: Dict[str, CommandStats] = {}
+    for commands in reports:
+        for command, report in commands.items():
+            merged.setdefault(command, CommandStats()).add(report)
+    return {command: stats.report() for command, stats in sorted(merged.items())}
+
+class Metrics(object):
+    def __init__(self) -> None:
+        self.commands: Dict[Hashable, CommandStats] = {} # keyed by the command frame as received, decoded in report()
+        self.started = time.monotonic()
+
+    def observe(self, command: Hashable, elapsed: float, bytes_in: int = 0, bytes_out: int = 0) -> None:
+        stats = self.commands.get(command, None)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.observe(elapsed, bytes_in, bytes_out)
+
+    async def measure(self, command: Hashable, bytes_in: int, reply: "CountingSocket", serving: Awaitable) -> None:
+        """Await `serving`, a handler replying on `reply`, and observe it."""
+        start = time.perf_counter()
+        try:
+            await serving
+        finally:
+            self.observe(command, time.perf_counter() - start, bytes_in, reply.sent)
+
+    def report(self) -> Dict[str, Any]:
+        commands = {}
+        for command, stats in sorted(self.commands.items()):
+            name = str(command, 'utf8', 'replace') if isinstance(command, bytes) else str(command)
+            commands[name] = stats.report()
+        return {"uptime": round(time.monotonic() - self.started, 3), "commands": commands}
+
+class CountingSocket(object):
+    """Count the bytes sent through `sock` by a handler, the rest goes to `sock` as it is."""
+    __slots__ = ('sock', 'sent')
+
+    def __init__(self, sock) -> None:
+        self.sock = sock
+        self.sent = 0
+
+    def send_multipart(self, frames: List, *args, **kwargs):
+        self.sent += frames_size(frames)
+        return self.sock.send_multipart(frames, *args, **kwargs)
+
+    def send(self, data, *args, **kwargs):
+        self.sent += len(data)
+        return self.sock.send(data, *args, **kwargs)
@@ -0,0 +1,147 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The filenames of the directory server in order, for fs.list.
+The names are kept in sorted blocks of BLOCK to 2 * BLOCK names, with the last name of each block in `lasts`:
+finding a name is a bisect on `lasts` then a bisect in its block, and adding or removing one moves the names of
+its block only, not all the names after it as a single sorted list would.
+A page of names is read from the blocks where it starts, so its cost depends on the page size and not on the number
+of names. Counting the names with a prefix takes the names before both ends of the prefix range, from a Fenwick
+tree of the block sizes: a sum over log(blocks) nodes, updated the same way when a name is added or removed, and
+built again when a block is split or removed (once in BLOCK additions at most).
+"""
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Optional, Tuple
+
+BLOCK = 1024
+MAX_CHAR = chr(0x10ffff)
+
+def prefix_end(prefix: str) -> Optional[str]:
+    """Return the first string after all the strings starting with `prefix`, or None if there is none."""
+    stripped = prefix.rstrip(MAX_CHAR)
+    if not stripped:
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+class Namespace(object):
+    def __init__(self, names: Iterable[str] = ()) -> None:
+        ordered = sorted(set(names))
+        self.blocks: List[List[str]] = [ordered[start:start+BLOCK] for start in range(0, len(ordered), BLOCK)]
+        self.lasts: List[str] = [block[-1] for block in self.blocks]
+        self.size = len(ordered)
+        self._build()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _build(self) -> None:
+        """Build the Fenwick tree of the block sizes, after the blocks are split or removed."""
+        tree = [0] * (len(self.blocks) + 1)
+        for node, block in enumerate(self.blocks, 1):
+            tree[node] += len(block)
+            parent = node + (node & -node)
+            if parent < len(tree):
+                tree[parent] += tree[node]
+        self.tree = tree
+
+    def _resize(self, index: int, delta: int) -> None:
+        node = index + 1
+        while node < len(self.tree):
+            self.tree[node] += delta
+            node += node & -node
+
+    def _before(self, index: int) -> int:
+        """Return the number of names in the blocks before `index`."""
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def add(self, name: str) -> None:
+        if not self.blocks:
+            self.blocks.append([name])
+            self.lasts.append(name)
+            self.size += 1
+            self._build()
+            return
+        index = min(bisect_left(self.lasts, name), len(self.blocks) - 1)
+        block = self.blocks[index]
+        position = bisect_left(block, name)
+        if position < len(block) and block[position] == name:
+            return
+        block.insert(position, name)
+        self.lasts[index] = block[-1]
+        self.size += 1
+        if len(block) > 2 * BLOCK:
+            self.blocks[index:index+1] = [block[:BLOCK], block[BLOCK:]]
+            self.lasts[index:index+1] = [block[BLOCK-1], block[-1]]
+            self._build()
+        else:
+            self._resize(index, 1)
+
+    def discard(self, name: str) -> None:
+        index = bisect_left(self.lasts, name)
+        if index == len(self.blocks):
+            return
+        block = self.blocks[index]
+        position = bisect_left(block, name)
+        if position == len(block) or block[position] != name:
+            return
+        del block[position]
+        self.size -= 1
+        if block:
+            self.lasts[index] = block[-1]
+            self._resize(index, -1)
+        else:
+            del self.blocks[index]
+            del self.lasts[index]
+            self._build()
+
+    def rank(self, name: str) -> int:
+        """Return the number of names before `name`."""
+        index = bisect_left(self.lasts, name)
+        before = self._before(index)
+        if index == len(self.blocks):
+            return before
+        return before + bisect_left(self.blocks[index], name)
+
+    def count(self, prefix: str = "") -> int:
+        if not prefix:
+            return self.size
+        end = prefix_end(prefix)
+        return (self.rank(end) if end is not None else self.size) - self.rank(prefix)
+
+    def page(self, prefix: str = "", after: str = "", limit: int = BLOCK) -> Tuple[List[str], bool]:
+        """Return the first `limit` names starting with `prefix` and sorted after `after`, and if there are more."""
+        if after >= prefix:
+            index = bisect_right(self.lasts, after)
+            position = bisect_right(self.blocks[index], after) if index < len(self.blocks) else 0
+        else:
+            index = bisect_left(self.lasts, prefix)
+            position = bisect_left(self.blocks[index], prefix) if index < len(self.blocks) else 0
+        names: List[str] = []
+        while index < len(self.blocks):
+            for name in self.blocks[index][position:position + limit + 1 - len(names)]:
+                if not name.startswith(prefix):
+                    return (names, False)
+                if len(names) == limit:
+                    return (names, True)
+                names.append(name)
+            index += 1
+            position = 0
+        return (names, False)
@@ -0,0 +1,537 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The file protocol between peers (the apps and the storage servers).
+Every peer serving files answers these commands on its command port:
+* fs.stat | filename: str -> 0 | size: str (decimal)
+* fs.read_chunk | filename: str | offset: str (decimal) | length: str (decimal) | codecs: str (optional) -> 0 | content: bytes | codec: str (if codecs are offered)
+* fs.read_stream | filename: str | offset: str | credit: str | chunk_size: str -> (0 | offset: str | size: str | content: bytes) * credit
+* fs.manifest | filename: str -> 0 | size: str | chunk_size: str | digests: bytes (sha256 digests of the chunks, concatenated)
+* fs.read_range | filename: str | (offset: str | length: str)... -> 0 | size: str | content: bytes (one frame for each range)
+* fs.delta | filename: str | block_size: str | signatures: bytes | codecs: str (optional) -> 0 | size: str | digest: bytes (see chunks.file_digest()) | delta: bytes | codec: str (if codecs are offered)
+A failed command replies 1, a missing or malformed argument too.
+The reader of fs.read_chunk (and fs.read_file) may offer compression codecs, the content is then sent compressed
+by the codec replied, or "identity" (see compression.py). The downloads here offer `compression.DEFAULT_OFFER`.
+fs.read_range reads a few parts of a file in one round trip, a negative offset counts from the end of the file
+and a range past the end is cut there. An offset without its length fails the whole command. Only the chunks under the ranges are read (see ChunkedContent.slice()),
+so a header or an index block of a large file is read without the rest of it.
+fs.delta sends a new version of a file to a reader holding the previous one, as the blocks changed (see delta.py),
+it replies 1 if the versions differ too much, or the file is over MAX_DELTA_SIZE, and the reader should download
+the file instead.
+With the first two commands, a file can be downloaded from every device declared it at once:
+the file is split into fixed-size chunks and each device pulls the next chunk from a shared queue,
+so fast devices take more chunks than slow ones.
+fs.read_stream must be sent from a DEALER socket, since it has one reply for each granted chunk
+(until the end of file). The receiver grants more credit when it consumed the chunks,
+so there are never more than `window` chunks in flight and the memory used is bounded by window * chunk_size,
+instead of the size of the file.
+With fs.manifest, a device keeping a ChunkStore (see chunks.py) can download only the chunks it does not have.
+The handlers reply to the whole envelope of the request (every frame before the empty delimiter), which is the
+identity of a REQ client, or the identity and the request id of a pooled DEALER connection (see pool.py).
+The clients here send their requests through a PeerPool, to the fastest healthy peers first (see `PeerPool.ranked()`).
+The one-reply requests (fs.stat, fs.manifest, fs.read_range) are hedged by `first_reply()`: when the first peer does not
+reply in a few times its usual time, the request is sent to the next peer too and the first reply is taken,
+so a dead or overloaded peer costs a fraction of a second instead of the whole timeout.
+The commands which may wait on the executor (the scan of fs.delta, a compression) are served in their own tasks
+by BackgroundCommands, up to BACKGROUND_TASKS at once, so the command port serves the other commands meanwhile.
+"""
+import asyncio
+import inspect
+import io
+import logging
+from collections import deque
+from zmq import Frame
+from zmq.asyncio import Socket
+from typing import List, Dict, Deque, Optional, AsyncIterator, Callable, Any, BinaryIO, Iterable, Tuple, Set, Awaitable, TypeVar
+from . import chunks, compression, delta
+from .chunks import CHUNK_SIZE
+from .pool import PeerPool, PeerConnection
+CHUNK_TIMEOUT = 5
+DELTA_TIMEOUT = 30 # the peer scans the whole file before replying
+MAX_DELTA_SIZE = 256 * 1024 * 1024 # larger files are downloaded in full, their scan alone would take most of DELTA_TIMEOUT
+ENDGAME_DUPLICATES = 2
+T = TypeVar('T')
+STREAM_WINDOW = 8
+PIPELINE_DEPTH = 4 # chunk requests in flight to each peer
+logger = logging.getLogger("peer")
+BACKGROUND_COMMANDS = {'fs.delta', 'fs.read_file', 'fs.read_chunk'} # may wait on the executor
+BACKGROUND_TASKS = 16
+
+def split_envelope(frames: List[Frame]) -> Tuple[List[Frame], List[Frame]]:
+    """Split the frames received by a ROUTER into the envelope and the request after the empty delimiter."""
+    for index, frame in enumerate(frames):
+        if len(frame) == 0:
+            return (frames[:index], frames[index+1:])
+    return (frames[:1], frames[1:])
+
+async def guarded(command: str, serving: Awaitable) -> None:
+    """Await a handler, its failure is logged instead of ending the loop (or the task) serving the commands."""
+    try:
+        await serving
+    except Exception:
+        logger.exception("Command %s failed", command)
+
+class BackgroundCommands(object):
+    """Serve the commands in BACKGROUND_COMMANDS in their own tasks, at most `limit` of them at once."""
+    def __init__(self, limit: int = BACKGROUND_TASKS) -> None:
+        self.slots = asyncio.Semaphore(limit)
+        self.running: Set[asyncio.Task] = set()
+
+    async def start(self, serving: Awaitable) -> None:
+        """Run `serving` in a task, after waiting for a slot if `limit` of them are running."""
+        await self.slots.acquire()
+        task = asyncio.ensure_future(serving)
+        self.running.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self.running.discard(task)
+        self.slots.release()
+
+async def stat_handler(store, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    filename = str(argframes.pop(0).bytes, 'utf8')
+    vfile = store.files.get(filename, None)
+    if vfile and (vfile.content is not None):
+        await sock.send_multipart([*envelope, Frame(), bytes([0]), bytes(str(len(vfile.content)), 'utf8')])
+    else:
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+
+def range_digest(vfile, data, offset: int) -> bytes:
+    """Return the digest of `data` read at `offset`, which is known without hashing it when it is a whole chunk."""
+    if isinstance(vfile.content, chunks.ChunkedContent):
+        chunk_size, digests = vfile.content.chunk_size, vfile.content.digests
+    else:
+        chunk_size, digests = CHUNK_SIZE, getattr(vfile, 'digests', None)
+    if digests and offset % chunk_size == 0 and offset + len(data) == min(offset + chunk_size, len(vfile.content)):
+        return digests[offset // chunk_size]
+    return chunks.digest_of(data)
+
+def content_digest(vfile) -> bytes:
+    """Return a digest of the whole content of `vfile`, made of the digests of its chunks."""
+    _, digests = chunks.manifest_of(vfile)
+    return chunks.file_digest(digests)
+
+async def encode_content(store, data, offered: Optional[bytes], key: Callable[[], bytes]) -> List:
+    """Return the frames of `data` in a reply: the content, then the codec if the reader offered codecs."""
+    if offered is None:
+        return [data]
+    codec, level = compression.choose_codec(str(offered, 'utf8'))
+    if codec == compression.IDENTITY:
+        return [data, bytes(codec, 'utf8')]
+    codec, content = await store.compressed.compress(key(), data, codec, level)
+    return [content, bytes(codec, 'utf8')]
+
+def decode_content(frames: List[bytes]) -> Optional[bytes]:
+    """Return the content in the frames of a reply, decompressed if it has a codec,
+    or None if the codec is unknown here or the content does not decompress: the reply is taken as failed."""
+    if len(frames) > 1:
+        return compression.decompress(frames[0], str(frames[1], 'utf8', 'replace'))
+    return frames[0]
+
+async def read_chunk_handler(store, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    try:
+        filename = str(argframes.pop(0).bytes, 'utf8')
+        offset = int(argframes.pop(0).bytes)
+        length = int(argframes.pop(0).bytes)
+    except (ValueError, IndexError):
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    offered = argframes.pop(0).bytes if argframes else None
+    vfile = store.files.get(filename, None)
+    if vfile and (vfile.content is not None) and offset >= 0 and length >= 0:
+        chunk = chunks.view(vfile.content, offset, offset+length)
+        content = await encode_content(store, chunk, offered, lambda: range_digest(vfile, chunk, offset))
+        await sock.send_multipart([*envelope, Frame(), bytes([0]), *content], copy=False)
+    else:
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+
+async def read_stream_handler(store, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    try:
+        filename = str(argframes.pop(0).bytes, 'utf8')
+        offset = int(argframes.pop(0).bytes)
+        credit = int(argframes.pop(0).bytes)
+        chunk_size = int(argframes.pop(0).bytes)
+    except (ValueError, IndexError):
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    vfile = store.files.get(filename, None)
+    if (not vfile) or (vfile.content is None) or offset < 0 or credit <= 0 or chunk_size <= 0:
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    content = vfile.content
+    size = bytes(str(len(content)), 'utf8')
+    for _ in range(credit):
+        chunk = chunks.view(content, offset, offset+chunk_size)
+        await sock.send_multipart([*envelope, Frame(), bytes([0]), bytes(str(offset), 'utf8'), size, chunk], copy=False)
+        offset += len(chunk)
+        if offset >= len(content):
+            break
+
+async def manifest_handler(store, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    filename = str(argframes.pop(0).bytes, 'utf8')
+    vfile = store.files.get(filename, None)
+    if vfile and (vfile.content is not None):
+        chunk_size, digests = chunks.manifest_of(vfile)
+        await sock.send_multipart([*envelope, Frame(), bytes([0]), bytes(str(len(vfile.content)), 'utf8'), bytes(str(chunk_size), 'utf8'), b"".join(digests)])
+    else:
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+
+async def read_range_handler(store, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    try:
+        filename = str(argframes.pop(0).bytes, 'utf8')
+        ranges = [(int(argframes[i].bytes), int(argframes[i+1].bytes)) for i in range(0, len(argframes) - 1, 2)]
+    except (ValueError, IndexError):
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    vfile = store.files.get(filename, None)
+    if (not vfile) or (vfile.content is None) or (not ranges) or len(argframes) % 2 or any(length < 0 for _, length in ranges):
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    content = vfile.content
+    size = len(content)
+    pieces = []
+    for offset, length in ranges:
+        start = offset if offset >= 0 else max(size + offset, 0)
+        pieces.append(chunks.view(content, start, start + length))
+    await sock.send_multipart([*envelope, Frame(), bytes([0]), bytes(str(size), 'utf8'), *pieces], copy=False)
+
+async def delta_handler(store, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    try:
+        filename = str(argframes.pop(0).bytes, 'utf8')
+        block_size = int(argframes.pop(0).bytes)
+        signatures = argframes.pop(0).bytes
+    except (ValueError, IndexError):
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    offered = argframes.pop(0).bytes if argframes else None
+    vfile = store.files.get(filename, None)
+    if (not vfile) or (vfile.content is None) or block_size <= 0 or len(vfile.content) > MAX_DELTA_SIZE:
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    content = bytes(chunks.as_buffer(vfile.content))
+    # the scan runs in the executor and this handler in a task of BackgroundCommands, the other commands are served meanwhile
+    instructions = await asyncio.get_event_loop().run_in_executor(None, delta.make_delta, content, block_size, signatures)
+    if instructions is None:
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+        return
+    encoded = await encode_content(store, instructions, offered, lambda: chunks.digest_of(instructions))
+    await sock.send_multipart([*envelope, Frame(), bytes([0]), bytes(str(len(content)), 'utf8'), content_digest(vfile), *encoded], copy=False)
+
+async def stat_file(connection: PeerConnection, filename: str, timeout: float = CHUNK_TIMEOUT) -> Optional[int]:
+    frames = await connection.request([b"fs.stat", bytes(filename, 'utf8')], timeout)
+    if frames[0][0] == 0:
+        return int(frames[1])
+    else:
+        return None
+
+async def read_chunk(connection: PeerConnection, filename: str, offset: int, length: int, timeout: float = CHUNK_TIMEOUT, offer: Optional[str] = None) -> Optional[bytes]:
+    request = [b"fs.read_chunk", bytes(filename, 'utf8'), bytes(str(offset), 'utf8'), bytes(str(length), 'utf8')]
+    if offer:
+        request.append(bytes(offer, 'utf8'))
+    frames = await connection.request(request, timeout)
+    if frames[0][0] == 0:
+        return decode_content(frames[1:]) # a peer not knowing the codecs replies the content only
+    else:
+        return None
+
+async def get_manifest(connection: PeerConnection, filename: str, timeout: float = CHUNK_TIMEOUT, digest: Optional[bytes] = None) -> Optional[Tuple[int, int, List[bytes]]]:
+    """Return the manifest of `filename` on the peer, or None if it does not have it (or not the version of `digest`)."""
+    frames = await connection.request([b"fs.manifest", bytes(filename, 'utf8')], timeout)
+    if frames[0][0] != 0:
+        return None
+    digests = chunks.split_digests(frames[3])
+    if (digest is not None) and chunks.file_digest(digests) != digest:
+        return None # another version of the file
+    return (int(frames[1]), int(frames[2]), digests)
+
+async def read_ranges(connection: PeerConnection, filename: str, ranges: List[Tuple[int, int]], timeout: float = CHUNK_TIMEOUT) -> Optional[Tuple[int, List[bytes]]]:
+    """Return the size of `filename` and the contents of the (offset, length) ranges, or None if the peer does not have it."""
+    request = [b"fs.read_range", bytes(filename, 'utf8')]
+    for offset, length in ranges:
+        request += [bytes(str(offset), 'utf8'), bytes(str(length), 'utf8')]
+    frames = await connection.request(request, timeout)
+    if frames[0][0] == 0:
+        return (int(frames[1]), frames[2:])
+    else:
+        return None
+
+async def first_reply(pool: PeerPool, addresses: Iterable[str], request: Callable[[PeerConnection], Awaitable[Optional[T]]], size: int = 0) -> Optional[T]:
+    """Send `request` to the peers, the fastest first, and return its first result which is not None.
+    A peer which fails or times out is replaced by the next one at once. A peer not replying in
+    `pool.hedge_delay()` (for a reply of `size` bytes) is not waited for alone: the next peer is asked too."""
+    candidates = deque(pool.ranked(addresses, size))
+    running: Set[asyncio.Future] = set()
+    try:
+        while candidates or running:
+            delay: Optional[float] = None
+            if candidates:
+                address = candidates.popleft()
+                running.add(asyncio.ensure_future(request(pool.connection(address))))
+                if candidates:
+                    delay = pool.hedge_delay(address, size)
+            done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                running.discard(task)
+                try:
+                    result = task.result()
+                except asyncio.TimeoutError:
+                    result = None
+                if result is not None:
+                    return result
+    finally:
+        for task in running:
+            task.cancel() # the pooled connection drops their replies
+    return None
+
+async def find_ranges(pool: PeerPool, addresses: List[str], filename: str, ranges: List[Tuple[int, int]], timeout: float = CHUNK_TIMEOUT) -> Optional[Tuple[int, List[bytes]]]:
+    size = sum(length for _, length in ranges)
+    return await first_reply(pool, addresses, lambda connection: read_ranges(connection, filename, ranges, timeout), size)
+
+async def get_delta(connection: PeerConnection, filename: str, previous: bytes, timeout: float = DELTA_TIMEOUT, offer: Optional[str] = compression.DEFAULT_OFFER, digest: Optional[bytes] = None) -> Optional[bytes]:
+    """Return the version of `filename` on the peer, rebuilt from `previous` and the blocks changed,
+    or None if the peer declined or has another version than the one of `digest`."""
+    block_size = delta.block_size_for(len(previous))
+    request = [b"fs.delta", bytes(filename, 'utf8'), bytes(str(block_size), 'utf8'), delta.signatures(previous, block_size)]
+    if offer:
+        request.append(bytes(offer, 'utf8'))
+    frames = await connection.request(request, timeout)
+    if frames[0][0] != 0 or ((digest is not None) and frames[2] != digest):
+        return None
+    instructions = decode_content(frames[3:])
+    if instructions is None:
+        return None
+    content = delta.apply_delta(previous, block_size, instructions)
+    if len(content) != int(frames[1]) or chunks.file_digest(chunks.digests_of(content)) != frames[2]:
+        return None
+    return content
+
+async def serving_address(connection: PeerConnection, filename: str) -> Optional[str]:
+    """Return the address of the peer if it answers fs.stat for `filename`."""
+    return connection.address if (await stat_file(connection, filename)) is not None else None
+
+async def find_delta(pool: PeerPool, addresses: List[str], filename: str, previous: bytes, timeout: float = DELTA_TIMEOUT, digest: Optional[bytes] = None) -> Optional[bytes]:
+    # fs.delta is not hedged: the peer scans the whole file for a delta, asking two peers would double the work.
+    # The peer is chosen by a hedged fs.stat, so a dead one costs a fraction of a second instead of `timeout`.
+    remaining = list(addresses)
+    while remaining:
+        address = await first_reply(pool, remaining, lambda connection: serving_address(connection, filename))
+        if address is None:
+            return None
+        remaining.remove(address)
+        try:
+            content = await get_delta(pool.connection(address), filename, previous, timeout, digest=digest)
+        except asyncio.TimeoutError:
+            content = None
+        if content is not None:
+            return content
+    return None
+
+async def find_manifest(pool: PeerPool, addresses: List[str], filename: str, timeout: float = CHUNK_TIMEOUT, digest: Optional[bytes] = None) -> Optional[Tuple[int, int, List[bytes]]]:
+    return await first_reply(pool, addresses, lambda connection: get_manifest(connection, filename, timeout, digest))
+
+async def find_file_size(pool: PeerPool, addresses: List[str], filename: str, timeout: float = CHUNK_TIMEOUT) -> Optional[int]:
+    return await first_reply(pool, addresses, lambda connection: stat_file(connection, filename, timeout))
+
+async def download_parallel(pool: PeerPool, addresses: List[str], filename: str, chunk_size: int = CHUNK_SIZE, timeout: float = CHUNK_TIMEOUT, offer: Optional[str] = compression.DEFAULT_OFFER) -> Optional[bytes]:
+    """Download `filename` from all `addresses` at once. Return None if it could not be completed."""
+    f = io.BytesIO()
+    size = await download_parallel_into(pool, addresses, filename, f, chunk_size, timeout, offer)
+    if size is None:
+        return None
+    return f.getvalue()
+
+async def download_parallel_into(pool: PeerPool, addresses: List[str], filename: str, f: BinaryIO, chunk_size: int = CHUNK_SIZE, timeout: float = CHUNK_TIMEOUT, offer: Optional[str] = compression.DEFAULT_OFFER) -> Optional[int]:
+    """Download `filename` from all `addresses` at once into the seekable `f`, return the size or None if it could not be completed.
+    Each chunk is written at its offset as soon as it arrives.
+    """
+    addresses = pool.ranked(addresses)
+    size = await find_file_size(pool, addresses, filename, timeout)
+    if size is None:
+        return None
+
+    def write(index: int, data: bytes) -> bool:
+        f.seek(index * chunk_size)
+        f.write(data)
+        return True
+
+    if not await fetch_chunks(pool, addresses, filename, range((size + chunk_size - 1) // chunk_size), write, chunk_size, timeout, offer=offer):
+        return None
+    f.truncate(size)
+    return size
+
+async def download_chunks(pool: PeerPool, addresses: List[str], filename: str, store: chunks.ChunkStore, timeout: float = CHUNK_TIMEOUT, offer: Optional[str] = compression.DEFAULT_OFFER, digest: Optional[bytes] = None) -> Optional[Tuple[int, int, List[bytes]]]:
+    """Download the chunks of `filename` which `store` does not have yet, return the manifest or None if it could not be completed.
+    With `digest` (see chunks.file_digest()), only a manifest of that version is taken, the peers having another one are skipped.
+    The chunks are put into `store` unreferenced and pinned until this returns, the caller should `add()` the manifest
+    before awaiting anything else. If the download fails or is cancelled, the unreferenced chunks are collected.
+    """
+    addresses = pool.ranked(addresses)
+    manifest = await find_manifest(pool, addresses, filename, timeout, digest)
+    if manifest is None:
+        return None
+    size, chunk_size, digests = manifest
+    missing: Dict[bytes, int] = {}
+    for index, chunk_digest in enumerate(digests):
+        if (not store.has(chunk_digest)) and (chunk_digest not in missing):
+            missing[chunk_digest] = index
+
+    def put(index: int, data: bytes) -> bool:
+        if chunks.digest_of(data) != digests[index]:
+            return False
+        store.put_chunk(digests[index], data)
+        return True
+
+    completed = False
+    store.pin(digests)
+    try:
+        completed = await fetch_chunks(pool, addresses, filename, missing.values(), put, chunk_size, timeout, offer=offer)
+    finally:
+        store.unpin(digests)
+        if not completed:
+            store.collect(digests)
+    return manifest if completed else None
+
+async def fetch_chunks(pool: PeerPool, addresses: List[str], filename: str, indexes: Iterable[int], accept: Callable[[int, bytes], bool], chunk_size: int = CHUNK_SIZE, timeout: float = CHUNK_TIMEOUT, depth: int = PIPELINE_DEPTH, offer: Optional[str] = compression.DEFAULT_OFFER) -> bool:
+    """Fetch the chunks at `indexes` from all `addresses` at once and pass each one to `accept` as soon as it arrives.
+    Each peer has up to `depth` chunk requests in flight on its pooled connection.
+    A peer which failed or timed out on a chunk (or whose chunk is not accepted) is dropped and the chunk goes back to the queue.
+    When the queue is empty, idle peers also request the chunks still in flight (the "endgame"),
+    so one slow peer does not hold up the whole download: the requests left are cancelled once every chunk arrived.
+    """
+    done: Dict[int, bool] = {index: False for index in indexes}
+    remaining = len(done)
+    pending: Deque[int] = deque(done.keys())
+    in_flight: Dict[int, List[str]] = {} # index -> the peers requesting it
+    healthy: List[str] = list(addresses)
+
+    def next_index(address: str) -> Optional[int]:
+        while pending:
+            index = pending.popleft()
+            if not done[index]:
+                return index
+        # a duplicate goes to another peer, the same one would not be faster
+        candidates = [i for i, peers in in_flight.items() if (not done[i]) and len(peers) < ENDGAME_DUPLICATES and (address not in peers)]
+        if candidates:
+            return min(candidates, key=lambda i: len(in_flight[i]))
+        return None
+
+    async def worker(address: str) -> None:
+        nonlocal remaining
+        connection = pool.connection(address)
+        while address in healthy:
+            index = next_index(address)
+            if index is None:
+                return
+            in_flight.setdefault(index, []).append(address)
+            try:
+                data = await read_chunk(connection, filename, index * chunk_size, chunk_size, timeout, offer)
+            except asyncio.TimeoutError:
+                data = None
+            finally:
+                in_flight[index].remove(address)
+                if not in_flight[index]:
+                    in_flight.pop(index)
+            if (data is not None) and (not done[index]):
+                if not accept(index, data):
+                    data = None
+                else:
+                    done[index] = True
+                    remaining -= 1
+            if data is None:
+                if not done[index]:
+                    pending.append(index)
+                if address in healthy:
+                    healthy.remove(address) # the other workers of this peer stop after their current chunk
+                return
+
+    while remaining and healthy:
+        workers = [asyncio.ensure_future(worker(address)) for address in list(healthy) for _ in range(depth)]
+        try:
+            while workers and remaining:
+                finished, running = await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    task.result()
+                workers = list(running)
+        finally:
+            for task in workers:
+                task.cancel()
+    return remaining == 0
+
+async def iter_stream(pool: PeerPool, address: str, filename: str, offset: int = 0, window: int = STREAM_WINDOW, chunk_size: int = CHUNK_SIZE, timeout: float = CHUNK_TIMEOUT, first_timeout: Optional[float] = None) -> AsyncIterator[bytes]:
+    """Yield the content of `filename` from `offset`, chunk by chunk.
+    Raise FileNotFoundError if the peer does not have the file and asyncio.TimeoutError if it stopped sending,
+    or if it did not start in `first_timeout` seconds (`timeout` by default).
+    """
+    channel = pool.connection(address).channel() # every grant of the stream is sent with the same request id
+    filename_bytes = bytes(filename, 'utf8')
+    chunk_size_bytes = bytes(str(chunk_size), 'utf8')
+
+    async def grant(credit: int, from_offset: int) -> None:
+        await channel.send([b"fs.read_stream", filename_bytes, bytes(str(from_offset), 'utf8'), bytes(str(credit), 'utf8'), chunk_size_bytes])
+
+    with channel:
+        granted_offset = offset + window * chunk_size
+        in_flight = window
+        await grant(window, offset)
+        next_timeout = first_timeout or timeout
+        while True:
+            frames = await channel.recv(next_timeout)
+            next_timeout = timeout
+            if frames[0][0] != 0:
+                raise FileNotFoundError(filename)
+            size = int(frames[2])
+            content = frames[3]
+            in_flight -= 1
+            offset = int(frames[1]) + len(content)
+            if content:
+                yield content
+            if offset >= size:
+                return
+            if in_flight <= window // 2 and granted_offset < size: # grant the consumed credit back in one message
+                credit = window - in_flight
+                await grant(credit, granted_offset)
+                granted_offset += credit * chunk_size
+                in_flight += credit
+
+def _sink_writer(sink: Any) -> Callable[[bytes], Any]:
+    if hasattr(sink, 'write'):
+        return sink.write
+    if inspect.isgenerator(sink):
+        if inspect.getgeneratorstate(sink) == inspect.GEN_CREATED:
+            next(sink)
+        return sink.send
+    return sink
+
+async def stream_file(pool: PeerPool, addresses: List[str], filename: str, sink: Any, window: int = STREAM_WINDOW, chunk_size: int = CHUNK_SIZE, timeout: float = CHUNK_TIMEOUT) -> Optional[int]:
+    """Stream `filename` into `sink`: a file-like object, a (started or not) generator or a callable.
+    If a peer fails, the stream is resumed from the next address at the offset already written.
+    A peer not starting in `pool.hedge_delay()` is given up for the next one, unless it is the last one.
+    Return the bytes written, or None if no peer could complete it.
+    """
+    write = _sink_writer(sink)
+    written = 0
+    addresses = pool.ranked(addresses)
+    for position, address in enumerate(addresses):
+        first_timeout = min(pool.hedge_delay(address), timeout) if position < len(addresses) - 1 else timeout
+        try:
+            async for chunk in iter_stream(pool, address, filename, written, window, chunk_size, timeout, first_timeout):
+                write(chunk)
+                written += len(chunk)
+            return written
+        except (FileNotFoundError, asyncio.TimeoutError):
+            continue
+    return None
@@ -0,0 +1,70 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Placement of the files on the storage servers by consistent hashing.
+Each storage server is put on a ring of 64-bit points at `vnodes` points (hashes of its name), a file is owned by
+the first `replicas` distinct servers met clockwise from the point of its name.
+Adding or removing a server only moves the files on the arcs next to its points, about 1/N of the files,
+and the virtual nodes spread those files over all the other servers instead of one neighbour.
+A Ring is not changed after it is built: the directory server builds a new one when a storage server joins or leaves
+and compares the owners in both to find the files to move.
+"""
+import hashlib
+from bisect import bisect_left
+from typing import Iterable, List, Tuple
+
+VNODES = 64
+REPLICAS = 2
+
+Owners = Tuple[bytes, ...]
+
+def point(key: bytes) -> int:
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+class Ring(object):
+    def __init__(self, nodes: Iterable[bytes] = (), replicas: int = REPLICAS, vnodes: int = VNODES) -> None:
+        self.nodes = frozenset(nodes)
+        self.replicas = replicas
+        self.vnodes = vnodes
+        points = sorted((point(node + b"#" + bytes(str(index), 'ascii')), node) for node in self.nodes for index in range(vnodes))
+        self.points = [position for position, _ in points]
+        # the owners of the keys in (points[i-1], points[i]], computed once here so a lookup is one bisect
+        self.arcs: List[Owners] = []
+        wanted = min(replicas, len(self.nodes))
+        for start in range(len(points)):
+            owners: List[bytes] = []
+            index = start
+            while len(owners) < wanted:
+                node = points[index % len(points)][1]
+                if node not in owners:
+                    owners.append(node)
+                index += 1
+            self.arcs.append(tuple(owners))
+
+    def owners_at(self, position: int) -> Owners:
+        if not self.points:
+            return ()
+        return self.arcs[bisect_left(self.points, position) % len(self.points)]
+
+    def owners(self, key: bytes) -> Owners:
+        return self.owners_at(point(key))
+
+    def with_node(self, node: bytes) -> "Ring":
+        return Ring(self.nodes | {node}, self.replicas, self.vnodes)
+
+    def without_node(self, node: bytes) -> "Ring":
+        return Ring(self.nodes - {node}, self.replicas, self.vnodes)
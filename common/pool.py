@@ -0,0 +1,197 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Persistent connections to the peers.
+PeerPool keeps one DEALER socket for each peer address and reuses it for every request to that peer,
+so there is one TCP handshake per peer instead of one per request.
+A request is sent as `request id | (empty) | command | args...`, the handlers reply to the whole envelope
+(see `peer.split_envelope()`), so the reply comes back with the same request id and many requests could be
+in flight on one socket at once. A reply arriving after its request gave up is dropped, the socket is never stuck
+like a REQ socket would be.
+A channel keeps its request id for more than one message, for the commands having many replies (fs.read_stream).
+The pool counts the failures of each peer, a peer failed `MAX_FAILURES` times in a row is skipped by `healthy()`
+for `RETRY_AFTER` seconds. The connections idle for `IDLE_TIMEOUT` seconds are closed.
+Each connection also measures its requests: the round trip time of the small replies and the throughput of the large
+ones, as moving averages. `ranked()` orders the healthy peers by the time they are expected to take for a chunk,
+the peers not measured yet count INITIAL_RTT, and `hedge_delay()` is how long a request to a peer is waited for
+alone before it is sent to another peer too (see `peer.first_reply()`).
+"""
+import asyncio
+import time
+import zmq
+from zmq.asyncio import Socket, Context
+from typing import List, Dict, Optional, Iterable, Any
+from .chunks import CHUNK_SIZE
+
+IDLE_TIMEOUT = 60.0
+MAX_FAILURES = 3
+RETRY_AFTER = 10.0
+INITIAL_RTT = 0.1 # seconds, expected of a peer not measured yet
+SMALL_REPLY = 4096 # bytes, a smaller reply measures the round trip time, a larger one the throughput
+EWMA_WEIGHT = 0.2
+HEDGE_FACTOR = 3 # a request is hedged after this many times the expected time of the peer
+HEDGE_MIN = 0.02
+
+class Channel(object):
+    def __init__(self, connection: "PeerConnection", request_id: bytes) -> None:
+        self.connection = connection
+        self.request_id = request_id
+        self.replies: "asyncio.Queue[List[bytes]]" = asyncio.Queue()
+
+    async def send(self, frames: List[bytes]) -> None:
+        self.connection.last_used = time.monotonic()
+        await self.connection.sock.send_multipart([self.request_id, b""] + frames)
+
+    async def recv(self, timeout: float) -> List[bytes]:
+        """Return the next reply, without the envelope. Raise asyncio.TimeoutError if it did not arrive in `timeout` seconds."""
+        try:
+            reply = await asyncio.wait_for(self.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            self.connection.failed()
+            raise
+        self.connection.succeeded()
+        return reply
+
+    def close(self) -> None:
+        self.connection.channels.pop(self.request_id, None)
+
+    def __enter__(self) -> "Channel":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class PeerConnection(object):
+    def __init__(self, context: Context, address: str) -> None:
+        self.address = address
+        self.sock: Socket = context.socket(zmq.DEALER)
+        self.sock.connect(address)
+        self.channels: Dict[bytes, Channel] = {}
+        self.next_request_id = 0
+        self.last_used = time.monotonic()
+        self.failures = 0 # in a row
+        self.failed_at = 0.0
+        self.rtt: Optional[float] = None # seconds, moving average
+        self.throughput: Optional[float] = None # bytes per second, moving average
+        self.requests = 0
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def _read(self) -> None:
+        while True:
+            frames: List[bytes] = await self.sock.recv_multipart()
+            channel = self.channels.get(frames[0], None)
+            if channel:
+                channel.replies.put_nowait(frames[2:])
+
+    def channel(self) -> Channel:
+        self.next_request_id += 1
+        request_id = self.next_request_id.to_bytes(4, 'big')
+        channel = self.channels[request_id] = Channel(self, request_id)
+        return channel
+
+    async def request(self, frames: List[bytes], timeout: float) -> List[bytes]:
+        """Send one command and return its reply. Raise asyncio.TimeoutError if the peer did not reply in `timeout` seconds."""
+        with self.channel() as channel:
+            start = time.monotonic()
+            await channel.send(frames)
+            reply = await channel.recv(timeout)
+            self.measure(time.monotonic() - start, sum(len(frame) for frame in reply))
+            return reply
+
+    def measure(self, elapsed: float, size: int) -> None:
+        self.requests += 1
+        if size < SMALL_REPLY:
+            self.rtt = elapsed if self.rtt is None else self.rtt + EWMA_WEIGHT * (elapsed - self.rtt)
+        else:
+            rate = size / max(elapsed, 1e-6)
+            self.throughput = rate if self.throughput is None else self.throughput + EWMA_WEIGHT * (rate - self.throughput)
+
+    def expected(self, size: int = CHUNK_SIZE) -> float:
+        """Return the seconds a request replying `size` bytes is expected to take."""
+        rtt = self.rtt if self.rtt is not None else INITIAL_RTT
+        return rtt + (size / self.throughput if self.throughput else 0.0)
+
+    def failed(self) -> None:
+        self.failures += 1
+        self.failed_at = time.monotonic()
+
+    def succeeded(self) -> None:
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.failures < MAX_FAILURES or time.monotonic() - self.failed_at > RETRY_AFTER
+
+    def close(self) -> None:
+        self.reader.cancel()
+        self.sock.close(linger=0)
+
+class PeerPool(object):
+    def __init__(self, context: Context, idle_timeout: float = IDLE_TIMEOUT) -> None:
+        self.context = context
+        self.idle_timeout = idle_timeout
+        self.connections: Dict[str, PeerConnection] = {}
+        self.checked_at = time.monotonic()
+
+    def connection(self, address: str) -> PeerConnection:
+        self.evict_idle()
+        connection = self.connections.get(address, None)
+        if connection is None:
+            connection = self.connections[address] = PeerConnection(self.context, address)
+        return connection
+
+    def healthy(self, addresses: Iterable[str]) -> List[str]:
+        """Return the addresses without the peers failing recently, or all of them if every peer is failing."""
+        addresses = list(addresses)
+        result = [address for address in addresses if (address not in self.connections) or self.connections[address].healthy]
+        return result or addresses
+
+    def expected(self, address: str, size: int = CHUNK_SIZE) -> float:
+        connection = self.connections.get(address, None)
+        return connection.expected(size) if connection else INITIAL_RTT
+
+    def ranked(self, addresses: Iterable[str], size: int = CHUNK_SIZE) -> List[str]:
+        """Return the healthy addresses (see `healthy()`) without duplicates, the fastest first."""
+        return sorted(self.healthy(dict.fromkeys(addresses)), key=lambda address: self.expected(address, size))
+
+    def hedge_delay(self, address: str, size: int = CHUNK_SIZE) -> float:
+        return max(HEDGE_FACTOR * self.expected(address, size), HEDGE_MIN)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """The measures of each connection, for the stats of the storage server."""
+        return {address: {
+            "rtt_ms": round(connection.rtt * 1000, 3) if connection.rtt is not None else None,
+            "throughput": int(connection.throughput) if connection.throughput else None, # bytes per second
+            "requests": connection.requests,
+            "in_flight": len(connection.channels),
+            "failures": connection.failures,
+        } for address, connection in self.connections.items()}
+
+    def evict_idle(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < self.idle_timeout / 2:
+            return
+        self.checked_at = now
+        for address, connection in list(self.connections.items()):
+            if (not connection.channels) and now - connection.last_used > self.idle_timeout:
+                connection.close()
+                self.connections.pop(address)
+
+    def close(self) -> None:
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
@@ -0,0 +1,151 @@
+"""
+    this file is part of tractor-prototype0
+    Copyright (C) 2020 thisLight
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+     any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Encodings of the list-valued replies of the directory server.
+A client chooses one with `proto.hello | encodings: str (comma separated, preferred first) -> 0 | encoding: str`,
+the server keeps it for the connection while it can (the least recently used connections are forgotten).
+Without proto.hello, the replies are JSON as before.
+The replies describe themselves, a client decodes them without knowing what the server remembers:
+a server restarted, or a connection it forgot, gets JSON again.
+* json: the value is one frame of JSON.
+* binary: the value starts with the frame `binary`, which is never JSON.
+  Frames are already length-prefixed, so a list of strings is one frame for each string.
+  A mapping from name to list (the locations of a file) is `name | count (!i) | item...` for each entry,
+  fs.locate_many is `filename | count (!i, -1 if the file does not exist) | locations entries...` for each file.
+  The server keeps the names and addresses as bytes, so it does not encode anything per request.
+"""
+import json
+import struct
+from typing import List, Dict, Iterable, Tuple, Optional
+
+JSON = "json"
+BINARY = "binary"
+ENCODINGS = (BINARY, JSON)
+COUNT = struct.Struct("!i")
+BINARY_MARKER = bytes(BINARY, 'utf8')
+
+Locations = Dict[str, List[str]]
+EncodedLocations = Iterable[Tuple[bytes, List[bytes]]]
+
+def choose_encoding(offered: str) -> Optional[str]:
+    for encoding in offered.split(','):
+        if encoding in ENCODINGS:
+            return encoding
+    return None
+
+def encoding_of(frames: List[bytes]) -> str:
+    return BINARY if frames and bytes(frames[0]) == BINARY_MARKER else JSON
+
+def _load_json(frames: List[bytes], kind: type):
+    """Raise ValueError if the value is not one frame of JSON of `kind`."""
+    if len(frames) != 1:
+        raise ValueError("expected one frame of JSON, got {}".format(len(frames)))
+    result = json.loads(bytes(frames[0]))
+    if not isinstance(result, kind):
+        raise ValueError("expected a JSON {}".format(kind.__name__))
+    return result
+
+def _count(frames: List[bytes], index: int) -> int:
+    if index >= len(frames) or len(frames[index]) != COUNT.size:
+        raise ValueError("missing count at frame {}".format(index))
+    return COUNT.unpack(bytes(frames[index]))[0]
+
+def encode_list(items: List[bytes], encoding: str) -> List[bytes]:
+    if encoding == BINARY:
+        return [BINARY_MARKER, *items]
+    return [bytes(json.dumps([str(item, 'utf8') for item in items]), 'utf8')]
+
+def decode_list(frames: List[bytes]) -> List[str]:
+    if encoding_of(frames) == BINARY:
+        return [str(frame, 'utf8') for frame in frames[1:]]
+    return _load_json(frames, list)
+
+def _encode_locations_binary(locations: EncodedLocations, out: List[bytes]) -> int:
+    count = 0
+    for name, items in locations:
+        out.append(name)
+        out.append(COUNT.pack(len(items)))
+        out.extend(items)
+        count += 1
+    return count
+
+def _decode_locations_binary(frames: List[bytes], index: int, count: int, locations: Locations) -> int:
+    """Decode `count` entries from `frames[index]` into `locations`, return the index after them."""
+    for _ in range(count):
+        if index >= len(frames):
+            raise ValueError("truncated locations")
+        name = str(frames[index], 'utf8')
+        item_count = _count(frames, index + 1)
+        index += 2
+        if item_count < 0 or index + item_count > len(frames):
+            raise ValueError("truncated locations of {}".format(name))
+        locations[name] = [str(frame, 'utf8') for frame in frames[index:index + item_count]]
+        index += item_count
+    return index
+
+def _locations_to_json(locations: EncodedLocations) -> Locations:
+    return {str(name, 'utf8'): [str(item, 'utf8') for item in items] for name, items in locations}
+
+def encode_locations(locations: EncodedLocations, encoding: str) -> List[bytes]:
+    if encoding == BINARY:
+        out: List[bytes] = [BINARY_MARKER]
+        _encode_locations_binary(locations, out)
+        return out
+    return [bytes(json.dumps(_locations_to_json(locations)), 'utf8')]
+
+def decode_locations(frames: List[bytes]) -> Locations:
+    """Raise ValueError if the frames are not locations."""
+    if encoding_of(frames) == BINARY:
+        locations: Locations = {}
+        index = 1
+        while index < len(frames):
+            index = _decode_locations_binary(frames, index, 1, locations)
+        return locations
+    return _load_json(frames, dict)
+
+def encode_locations_many(files: Iterable[Tuple[bytes, Optional[EncodedLocations]]], encoding: str) -> List[bytes]:
+    if encoding == BINARY:
+        out: List[bytes] = [BINARY_MARKER]
+        for filename, locations in files:
+            out.append(filename)
+            if locations is None:
+                out.append(COUNT.pack(-1))
+            else:
+                count_index = len(out)
+                out.append(b"")
+                out[count_index] = COUNT.pack(_encode_locations_binary(locations, out))
+        return out
+    result = {str(filename, 'utf8'): (None if locations is None else _locations_to_json(locations)) for filename, locations in files}
+    return [bytes(json.dumps(result), 'utf8')]
+
+def decode_locations_many(frames: List[bytes]) -> Dict[str, Optional[Locations]]:
+    """Raise ValueError if the frames are not the reply of fs.locate_many."""
+    if encoding_of(frames) == BINARY:
+        result: Dict[str, Optional[Locations]] = {}
+        index = 1
+        while index < len(frames):
+            filename = str(frames[index], 'utf8')
+            count = _count(frames, index + 1)
+            if count < 0:
+                result[filename] = None
+                index += 2
+            else:
+                locations: Locations = {}
+                index = _decode_locations_binary(frames, index + 2, count, locations)
+                result[filename] = locations
+        return result
+    return _load_json(frames, dict)
@@ -22,168 +22,1009 @@ This prototype uses ZeroMQ.
 We have two ports opened for apps:
 * ROUTER 5350: command port
 * PUB 5351: file changes
+These are the events published on PUB 5351, in batches numbered for fs.changes_since (see common/changes.py):
+fs.new_file | filename: str | owners: str... (the storage servers the file is placed on)
+fs.place | filename: str | owners: str... (the owners changed because a storage server joined or left)
+fs.update | filename: str | version: str | device_name: str (the device having the new version) | size: str | digest: bytes | owners: str...
+fs.delete_file | filename: str
+fs.declare_file | filename: str | device_name: str
+fs.disown_file | filename: str | device_name: str
+device.new_address | device_name: str | address: str
+device.expire_address | device_name: str | address: str (no heartbeat came for the address, see below)
 These are commands used by apps:
+proto.hello | encodings: str (comma separated, preferred first) -> 0 | encoding: str
 device.cast_address | name: str | address: str -> 0
-device.get_addresses | name -> 0 | addresses: str (json list of str)
-ping | device_name: str -> "pong" | peer_address: str
-fs.list -> 0 | file_list: str (json list of str)
-fs.declare | device_name: str | filename: str -> 0
+device.get_addresses | name -> 0 | addresses: list of str
+device.heartbeat | name: str | address: str -> 0, or 1 if the address is not casted (anymore), cast it again
+ping | device_name: str | role: str (optional, "app" or "storage", "app" by default) -> "pong" | peer_address: str
+fs.list | prefix: str (optional) | after: str (optional) | limit: str (optional) -> 0 | count: str | next: str | file_list: list of str
+fs.declare | device_name: str | filename: str | version: str (optional) -> 0, or 2 if the file has another version now
+fs.update | device_name: str | filename: str | size: str | digest: bytes (see common/chunks.py file_digest()) -> 0 | version: str (the device has a new version of the file)
 fs.disown | device_name: str | filename: str -> 0
-fs.get | filename: str -> 0 | devices: str (json list of str)
+fs.get | filename: str -> 0 | devices: list of str
+fs.locate | filename: str -> 0 | locations: device name -> list of cast addresses
+fs.locate_many | filename: str | filename: str ... -> 0 | locations: filename -> locations, or null if the file does not exist
+device.drop | device_name: str -> 0 (disown all the files of the device and forget it)
+fs.owners | filename: str -> 0 | devices: list of str (the storage servers the file is placed on)
+fs.placed | device_name: str -> 0 | file_list: list of str (the files placed on the storage server)
+fs.changes_since | epoch: bytes | seq: str -> 0 | epoch | first_seq: str | event..., or 1 | epoch | last_seq: str if the events are not kept anymore
+stats -> 0 | stats: JSON object (see below)
+The lists and mappings in the replies are JSON in one frame, unless the client chose the binary encoding by proto.hello (see common/wire.py).
+The encodings are kept for the last MAX_ENCODINGS connections, a connection forgotten (or a server restarted) gets JSON again.
+Commands are dispatched by a table keyed on the command frame, an unknown command replies 1.
+fs.list replies one page of the filenames starting with `prefix` and sorted after `after`, up to `limit` (LIST_PAGE by
+default, MAX_LIST_PAGE at most), with the count of the filenames starting with `prefix` and the `after` of the next page,
+empty after the last page. The filenames are kept in order by common/namespace.py, a page costs its size.
+
+The devices serving files send device.heartbeat for their casted address every 10 seconds. An address without
+a heartbeat for ADDRESS_TTL seconds is removed from its device and published in device.expire_address, so the readers
+stop trying the addresses of the devices gone (an app restarting casts a new address each time).
+The addresses loaded from the journal after a restart get a whole ADDRESS_TTL to send their heartbeat.
+A storage server whose last address expired is down: it is taken out of the placement and its files are placed on
+the others (fs.place), it keeps its declarations. It is placed again when it casts an address. A storage server
+stopping sends device.drop.
+
+A device is created by its first ping, with the role given there. The files declared by the apps are counted,
+a file is deleted when no app declares it. The copies on the storage servers are not counted.
+Each file is placed on `--replicas` storage servers (2 by default) by consistent hashing over the storage devices
+(see common/placement.py), a storage server only downloads the files it owns. When a storage server joins or
+is dropped, the files whose owners changed (about 1/N of them) are published in fs.place events.
+Each file has a version, starting at 1. fs.update makes the version of the updating device the next one: the other
+devices are disowned (fs.disown_file) since they have the previous version, and the owners are told by fs.update.
+An owner having the previous version pulls only the changed blocks from the updating device (fs.delta, see common/delta.py).
+The size and the digest of the new version are passed along in the event, the owners only take a content matching them:
+the other addresses of the updating device (the apps share the "app" device) may still serve the previous version.
+They are empty when the updating device did not send them.
+
+stats reports, as JSON whatever the encoding is, the count, the bytes received and sent and the latency histogram of
+each command (see common/metrics.py), the events waiting to be published and kept for fs.changes_since, the size of the
+last batch of commands, and the numbers of devices, addresses and files. The latency of a command is the time in its
+handler, the group commit of its batch is "(sync)". With --workers, the front-end reports the commands as the clients
+see them (from the request to the reply), the files of all the shards, the commands of the shards merged under
+"shard_commands" (the time in the handlers, all the shards added) and the report of each shard under "shards".
+The server logs to stderr at the level given by --log-level (see common/log.py), each command is logged at DEBUG only.
+
+Usage: `python server.py [--workers N] [--data DIR] [--replicas N] [--log-level LEVEL]`
+With --workers, the store is split into N shards, each one is served by a worker process.
+The front-end process keeps the ports above, forwards each command about a file to the shard owning the filename (by crc32),
+broadcasts the commands about devices to every shard (each shard keeps all the devices, they are much fewer than the files),
+and merges the replies of fs.list, fs.placed and fs.locate_many. The events of the shards are numbered and published
+by the front-end, which answers fs.changes_since itself.
+With --data, the mutations of the store (new devices, casted addresses, declaring, disowning and dropping devices) are
+appended to a write-ahead log in DIR before their replies are sent, the commands received together share one fsync.
+The log is compacted into a snapshot periodically, written by a forked child process while the server goes on serving
+(see common/journal.py). The server loads the snapshot and replays the log after it on startup,
+so the devices do not need to declare their files again after the server restarts.
+Each shard keeps its log in DIR/shard.<index>, so restart it with the same number of workers.
 """
-import zmq
+import os
+import sys
+import gc
 import json
-from dataclasses import dataclass
+import logging
+import time
+import zlib
+import multiprocessing
+import zmq
+from collections import deque, OrderedDict
+from itertools import islice
 from zmq import Socket, Context, Poller, Frame
-from typing import List, Iterable, Dict, Tuple
+from typing import List, Iterable, Dict, Tuple, Optional, Set, Callable, Deque
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import wire, placement, changes, log
+from common.journal import Journal
+from common.metrics import Metrics, merge_commands, frames_size
+from common.namespace import Namespace
+
+logger = logging.getLogger("server")
+
+# The records use __slots__ and the store keeps indexes in both directions, so declaring, disowning and dropping
+# a device cost only the entries involved, whatever the numbers of files and devices are.
+
+ROLE_APP = "app"
+ROLE_STORAGE = "storage"
 
-@dataclass
 class Device(object):
-    name: str
-    cast_addresses: List[str]
+    __slots__ = ('name', 'name_bytes', 'role', 'cast_addresses', 'cast_address_frames', 'seen', 'files')
+
+    def __init__(self, name: str, role: str = ROLE_APP) -> None:
+        self.name = name
+        self.role = role # given by the first ping, the storage servers hold the files placed on them
+        self.name_bytes = bytes(name, 'utf8') # kept encoded to build the replies without encoding them again
+        self.cast_addresses: List[str] = []
+        self.cast_address_frames: List[bytes] = []
+        self.seen: Dict[str, float] = {} # address -> time of its last heartbeat (or cast)
+        self.files: Set[str] = set() # names of the files this device declared
+
+    @property
+    def counted(self) -> bool:
+        """If declaring a file by this device keeps the file alive. The copies on storage servers do not."""
+        return self.role != ROLE_STORAGE
+
+    def add_address(self, address: str) -> bool:
+        self.seen[address] = time.monotonic()
+        if address in self.cast_addresses:
+            return False
+        self.cast_addresses.append(address)
+        self.cast_address_frames.append(bytes(address, 'utf8'))
+        return True
+
+    def remove_address(self, address: str) -> bool:
+        if address not in self.cast_addresses:
+            return False
+        index = self.cast_addresses.index(address)
+        del self.cast_addresses[index]
+        del self.cast_address_frames[index]
+        self.seen.pop(address, None)
+        return True
+
+    def __repr__(self) -> str:
+        return "Device({!r}, {!r}, {!r})".format(self.name, self.role, self.cast_addresses)
 
-@dataclass
 class VirtualFile(object):
-    name: str
-    declared_devices: List[Device]
-    refcount: int
+    __slots__ = ('name', 'declared_devices', 'refcount', 'version')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.declared_devices: Dict[str, Device] = {} # device name -> device, in the order of declaring
+        self.refcount = 0
+        self.version = 1 # increased by fs.update
+
+    def __repr__(self) -> str:
+        return "VirtualFile({!r}, {!r}, {}, v{})".format(self.name, list(self.declared_devices), self.refcount, self.version)
+
+# The operations in the journal (see common/journal.py), each one is the mutation of a store method
+OP_DEVICE = 1 # device_name | role
+OP_CAST_ADDRESS = 2 # device_name | address
+OP_DECLARE = 3 # device_name | filename
+OP_DISOWN = 4 # device_name | filename
+OP_DROP_DEVICE = 5 # device_name
+OP_UPDATE = 6 # device_name | filename
+OP_REMOVE_ADDRESS = 7 # device_name | address
+
+ADDRESS_TTL = 30.0 # seconds without a heartbeat before an address expires
+EXPIRE_INTERVAL = 5.0 # seconds between two checks
+
+SNAPSHOT_RECORDS = 500000 # take a snapshot when the log has more records
 
 class DirectoryServerStore(object):
-    def __init__(self):
+    def __init__(self, replicas: int = placement.REPLICAS):
         self.devices: Dict[str, Device] = {}
         self.files: Dict[str, VirtualFile] = {}
+        self.names = Namespace() # the filenames in order, for fs.list
+        self.journal: Optional[Journal] = None # the mutations are appended to it if it is set
+        self.ring = placement.Ring(replicas=replicas) # the storage servers
+        self.placed_ring = self.ring # the ring the files were placed by, until rebalance()
+
+    def open_journal(self, journal: Journal) -> None:
+        """Rebuild the store from `journal` and append the next mutations to it."""
+        replayers: Dict[int, Callable] = {
+            OP_DEVICE: self.add_device,
+            OP_CAST_ADDRESS: self.cast_address,
+            OP_DECLARE: self.declare,
+            OP_DISOWN: self.disown,
+            OP_DROP_DEVICE: self.drop_device,
+            OP_UPDATE: self.update,
+            OP_REMOVE_ADDRESS: self.remove_address,
+        }
+        # Millions of records live until the server stops, the collector scanning them again and again would
+        # take most of the loading time. They are moved out of its sight (gc.freeze) when they are loaded.
+        gc.disable()
+        try:
+            snapshot, records = journal.load()
+            if snapshot is not None:
+                self.restore(snapshot)
+            for op, fields in records:
+                replayers[op](*[field.decode('utf8') for field in fields])
+        finally:
+            gc.freeze()
+            gc.enable()
+        for device in self.devices.values():
+            if device.role == ROLE_STORAGE and not device.cast_addresses: # down before the restart
+                self.ring = self.ring.without_node(device.name_bytes)
+        self.placed_ring = self.ring # the storage servers were told the placement before the restart
+        self.journal = journal
+        logger.info("Snapshot and %d records loaded, %d devices and %d files", len(records), len(self.devices), len(self.files))
+
+    def snapshot(self) -> bytes:
+        """Encode the whole store as JSON, the files refer the devices by index to keep it compact."""
+        device_indexes: Dict[str, int] = {}
+        devices = []
+        for device in self.devices.values():
+            device_indexes[device.name] = len(devices)
+            devices.append([device.name, device.cast_addresses, device.role])
+        files = [[vfile.name, [device_indexes[device_name] for device_name in vfile.declared_devices], vfile.version] for vfile in self.files.values()]
+        return bytes(json.dumps({"devices": devices, "files": files}), 'utf8')
+
+    def restore(self, snapshot: bytes) -> None:
+        state = json.loads(snapshot)
+        devices: List[Tuple[Device, bool]] = []
+        for device_name, addresses, *role in state["devices"]:
+            device, _ = self.add_device(device_name, *role)
+            for address in addresses:
+                device.add_address(address)
+            devices.append((device, device.counted))
+        files = self.files
+        for filename, device_indexes, *version in state["files"]:
+            vfile = files[filename] = VirtualFile(filename)
+            if version:
+                vfile.version = version[0]
+            declared_devices = vfile.declared_devices
+            for index in device_indexes:
+                device, counted = devices[index]
+                declared_devices[device.name] = device
+                device.files.add(filename)
+                if counted:
+                    vfile.refcount += 1
+        self.names = Namespace(files)
+
+    def sync(self) -> None:
+        """Make the mutations durable, and take a snapshot in the background if the log is long."""
+        if self.journal:
+            if self.journal.records_since_snapshot > SNAPSHOT_RECORDS and self.journal.snapshot_in_background(self.snapshot):
+                return # the log is synced before the snapshot starts
+            self.journal.sync()
+
+    def _log(self, op: int, *fields: str) -> None:
+        if self.journal:
+            self.journal.append(op, *(bytes(field, 'utf8') for field in fields))
+
+    def add_device(self, device_name: str, role: Optional[str] = None) -> Tuple[Device, bool]:
+        """Return the device and if it is created. An existing device keeps its role."""
+        device = self.devices.get(device_name, None)
+        if device:
+            return (device, False)
+        device = self.devices[device_name] = Device(device_name, role or ROLE_APP)
+        self._log(OP_DEVICE, device_name, device.role)
+        if device.role == ROLE_STORAGE:
+            self.ring = self.ring.with_node(device.name_bytes)
+        return (device, True)
 
-def ping_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+    def owners(self, filename: str) -> placement.Owners:
+        """Return the names of the storage servers the file is placed on."""
+        return self.ring.owners(bytes(filename, 'utf8'))
+
+    def placed_files(self, device_name: str) -> List[str]:
+        device_name_bytes = bytes(device_name, 'utf8')
+        if device_name_bytes not in self.ring.nodes:
+            return []
+        ring = self.ring
+        return [filename for filename in self.files if device_name_bytes in ring.owners(bytes(filename, 'utf8'))]
+
+    def rebalance(self) -> List[Tuple[str, placement.Owners]]:
+        """Return the files whose owners changed since the last call, with their new owners."""
+        old, new = self.placed_ring, self.ring
+        self.placed_ring = new
+        if old.nodes == new.nodes:
+            return []
+        moved = []
+        for filename in self.files:
+            position = placement.point(bytes(filename, 'utf8'))
+            owners = new.owners_at(position)
+            if owners != old.owners_at(position):
+                moved.append((filename, owners))
+        return moved
+
+    def cast_address(self, device_name: str, address: str) -> bool:
+        """Return if the address is new for the device."""
+        device, _ = self.add_device(device_name)
+        if device.add_address(address):
+            self._log(OP_CAST_ADDRESS, device_name, address)
+            if device.role == ROLE_STORAGE and device.name_bytes not in self.ring.nodes:
+                self.ring = self.ring.with_node(device.name_bytes) # placed again, it was down
+            return True
+        return False
+
+    def remove_address(self, device_name: str, address: str) -> bool:
+        device = self.devices.get(device_name, None)
+        if (not device) or (not device.remove_address(address)):
+            return False
+        self._log(OP_REMOVE_ADDRESS, device_name, address)
+        return True
+
+    def heartbeat(self, device_name: str, address: str) -> bool:
+        """Return False if the address is not casted by the device."""
+        device = self.devices.get(device_name, None)
+        if (not device) or (address not in device.seen):
+            return False
+        device.seen[address] = time.monotonic()
+        return True
+
+    def expire_addresses(self, ttl: float = ADDRESS_TTL) -> Tuple[List[Tuple[Device, str]], List[Device]]:
+        """Remove the addresses without a heartbeat for `ttl` seconds, return them with their devices,
+        and the storage servers taken out of the placement since they have no address left."""
+        deadline = time.monotonic() - ttl
+        expired = []
+        down = []
+        for device in self.devices.values():
+            for address, seen in list(device.seen.items()):
+                if seen < deadline:
+                    self.remove_address(device.name, address)
+                    expired.append((device, address))
+            if device.role == ROLE_STORAGE and (not device.cast_addresses) and device.name_bytes in self.ring.nodes:
+                self.ring = self.ring.without_node(device.name_bytes)
+                down.append(device)
+        return (expired, down)
+
+    def declare(self, device_name: str, filename: str) -> Tuple[bool, bool]:
+        """Return if the file is created and if the device is added to the file."""
+        vfile = self.files.get(filename, None)
+        new_file_flag = vfile is None
+        if new_file_flag:
+            vfile = self.files[filename] = VirtualFile(filename)
+            self.names.add(filename)
+        device = self.devices.get(device_name, None)
+        if (not device) or (device_name in vfile.declared_devices):
+            if new_file_flag:
+                self._log(OP_DECLARE, device_name, filename) # replaying it creates the file as well
+            return (new_file_flag, False)
+        vfile.declared_devices[device_name] = device
+        device.files.add(filename)
+        if device.counted:
+            vfile.refcount += 1
+        self._log(OP_DECLARE, device_name, filename)
+        return (new_file_flag, True)
+
+    def disown(self, device_name: str, filename: str) -> Optional[Tuple[bool, bool]]:
+        """Return if the device is removed from the file and if the file is deleted, or None if the file or the device does not exist."""
+        vfile = self.files.get(filename, None)
+        device = self.devices.get(device_name, None)
+        if (not vfile) or (not device):
+            return None
+        disowned_flag = vfile.declared_devices.pop(device_name, None) is not None
+        if disowned_flag:
+            device.files.discard(filename)
+            if device.counted:
+                vfile.refcount -= 1
+        deleted_flag = vfile.refcount == 0
+        if deleted_flag:
+            self.delete_file(filename)
+        if disowned_flag or deleted_flag:
+            self._log(OP_DISOWN, device_name, filename)
+        return (disowned_flag, deleted_flag)
+
+    def update(self, device_name: str, filename: str) -> Optional[Tuple[int, List[str], bool]]:
+        """Make the version of the device the next version of the file, the other devices having the previous version are disowned.
+        Return the new version, the disowned devices and if the file is deleted, or None if the file or the device does not exist."""
+        vfile = self.files.get(filename, None)
+        device = self.devices.get(device_name, None)
+        if (not vfile) or (not device):
+            return None
+        self._log(OP_UPDATE, device_name, filename)
+        vfile.version += 1
+        disowned = [name for name in vfile.declared_devices if name != device_name]
+        for name in disowned:
+            holder = vfile.declared_devices.pop(name)
+            holder.files.discard(filename)
+            if holder.counted:
+                vfile.refcount -= 1
+        if device_name not in vfile.declared_devices:
+            vfile.declared_devices[device_name] = device
+            device.files.add(filename)
+            if device.counted:
+                vfile.refcount += 1
+        deleted_flag = vfile.refcount == 0
+        if deleted_flag:
+            self.delete_file(filename)
+        return (vfile.version, disowned, deleted_flag)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "devices": len(self.devices),
+            "storage_servers": len(self.ring.nodes),
+            "addresses": sum(len(device.cast_addresses) for device in self.devices.values()),
+            "files": len(self.files),
+            "journal_records": self.journal.records_since_snapshot if self.journal else 0,
+        }
+
+    def delete_file(self, filename: str) -> None:
+        vfile = self.files.pop(filename)
+        self.names.discard(filename)
+        for device in vfile.declared_devices.values():
+            device.files.discard(filename)
+
+    def drop_device(self, device_name: str) -> Tuple[List[str], List[str]]:
+        """Disown all the files of the device and forget it. Return the disowned files and the deleted files."""
+        device = self.devices.pop(device_name, None)
+        if not device:
+            return ([], [])
+        self._log(OP_DROP_DEVICE, device_name)
+        if device.role == ROLE_STORAGE:
+            self.ring = self.ring.without_node(device.name_bytes)
+        disowned = list(device.files)
+        deleted = []
+        for filename in disowned:
+            vfile = self.files[filename]
+            vfile.declared_devices.pop(device_name)
+            if device.counted:
+                vfile.refcount -= 1
+            if vfile.refcount == 0:
+                self.delete_file(filename)
+                deleted.append(filename)
+        device.files.clear()
+        return (disowned, deleted)
+
+def publish_moves(store: DirectoryServerStore, changes_pub: Socket) -> None:
+    moved = store.rebalance()
+    for filename, owners in moved:
+        changes_pub.send_multipart([b"fs.place", bytes(filename, 'utf8'), *owners])
+    if moved:
+        logger.info("%d files are placed again on %d storage servers", len(moved), len(store.ring.nodes))
+
+def ping_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, changes_pub: Socket, peer_addr: Optional[str] = None) -> None:
     device_name_frame = argframes.pop(0)
     device_name = str(device_name_frame.bytes, encoding='utf8')
-    peer_addr = device_name_frame.get("Peer-Address")
-    print("Ping from {}".format(peer_addr))
+    role = str(argframes.pop(0).bytes, encoding='utf8') if argframes else None
+    if peer_addr is None:
+        peer_addr = device_name_frame.get("Peer-Address")
+    logger.debug("Ping from %s", peer_addr)
     reply = [id_frame, Frame(), Frame(b"pong"), Frame(bytes(peer_addr, encoding='utf8'))]
     sock.send_multipart(reply)
-    if device_name not in store.devices:
-        store.devices[device_name] = Device(device_name, [])
-        print("New device {} is created".format(device_name))
+    device, new_device_flag = store.add_device(device_name, role)
+    if new_device_flag:
+        logger.info("New device %s (%s) is created", device_name, device.role)
+        publish_moves(store, changes_pub)
+    elif role and role != device.role:
+        logger.warning("Device %s is kept as %s, not %s", device_name, device.role, role)
 
-def casting_address_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+def casting_address_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, changes_pub: Socket) -> None:
     device_name = str(argframes.pop(0).bytes, encoding='utf8')
     address = str(argframes.pop(0).bytes, encoding='utf8')
-    if device_name not in store.devices:
-        store.devices[device_name] = Device(device_name, [])
-    device = store.devices[device_name]
-    if address not in device.cast_addresses:
-        device.cast_addresses.append(address)
-        print("Device {} casted entry point {}".format(device_name, address))
+    if store.cast_address(device_name, address):
+        logger.info("Device %s casted entry point %s", device_name, address)
+        changes_pub.send_multipart([b"device.new_address", bytes(device_name, 'utf8'), bytes(address, 'utf8')])
+        publish_moves(store, changes_pub) # a storage server down is back
     reply = [id_frame, Frame(), Frame(bytes([0]))]
     sock.send_multipart(reply)
 
-def get_addresses_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+def heartbeat_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+    device_name = str(argframes.pop(0).bytes, encoding='utf8')
+    address = str(argframes.pop(0).bytes, encoding='utf8')
+    status = 0 if store.heartbeat(device_name, address) else 1
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([status]))])
+
+def expire_addresses(store: DirectoryServerStore, changes_pub: Socket) -> None:
+    expired, down = store.expire_addresses()
+    for device, address in expired:
+        logger.info("Address %s of device %s is expired", address, device.name)
+        changes_pub.send_multipart([b"device.expire_address", device.name_bytes, bytes(address, 'utf8')])
+    for device in down:
+        logger.warning("Storage server %s is down, its files are placed on the others", device.name)
+    if down:
+        publish_moves(store, changes_pub)
+
+def get_addresses_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
     device_name = str(argframes.pop(0).bytes, encoding='utf8')
     if device_name in store.devices:
         device = store.devices[device_name]
-        playload = json.dumps(device.cast_addresses)
-        reply = [id_frame, Frame(), Frame(bytes([0])), Frame(bytes(playload, 'utf8'))]
+        reply = [id_frame, Frame(), Frame(bytes([0]))] + wire.encode_list(device.cast_address_frames, encoding)
         sock.send_multipart(reply)
     else:
-        reply = [id_frame, Frame(), Frame(1)]
+        reply = [id_frame, Frame(), Frame(bytes([1]))]
         sock.send_multipart(reply)
 
-def file_list_handler(store: DirectoryServerStore, sock: Socket, id_frame: Frame) -> None:
-    file_list = store.files.keys()
-    reply = [id_frame, Frame(), Frame(0), Frame(json.dumps(file_list))]
+LIST_PAGE = 1000
+MAX_LIST_PAGE = 10000
+
+def list_arguments(argframes: List[Frame]) -> Tuple[str, str, int]:
+    """Return the prefix, the after and the limit of fs.list, the missing ones are the defaults."""
+    prefix, after, limit = [str(frame.bytes, 'utf8') for frame in argframes[:3]] + [""] * (3 - len(argframes[:3]))
+    return (prefix, after, min(max(int(limit), 1), MAX_LIST_PAGE) if limit else LIST_PAGE)
+
+def file_list_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
+    prefix, after, limit = list_arguments(argframes)
+    filenames, more = store.names.page(prefix, after, limit)
+    next_after = filenames[-1] if more else ""
+    file_list = [bytes(filename, 'utf8') for filename in filenames]
+    reply = [id_frame, Frame(), Frame(bytes([0])), bytes(str(store.names.count(prefix)), 'utf8'), bytes(next_after, 'utf8')] + wire.encode_list(file_list, encoding)
     sock.send_multipart(reply)
 
 def file_declare_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, changes_pub: Socket) -> None:
     device_name = str(argframes.pop(0).bytes, encoding='utf8')
     filename = str(argframes.pop(0).bytes, encoding='utf8')
-    new_file_flag = False
-    if filename not in store.files:
-        store.files[filename] = VirtualFile(filename, [], 0)
-        print("New file {} created".format(filename))
-        new_file_flag = True
-    vfile = store.files[filename]
-    device = store.devices.get(device_name, None)
-    if device and (device not in vfile.declared_devices):
-        vfile.declared_devices.append(device)
-        if not device_name.startswith("storage"): # In reality we may use another way to identify if we need to count reference for the device
-            vfile.refcount += 1
+    if argframes and (filename in store.files) and int(argframes[0].bytes) != store.files[filename].version:
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([2]))]) # the device has another version
+        return
+    new_file_flag, declared_flag = store.declare(device_name, filename)
     sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))])
     if new_file_flag:
-        changes_pub.send_multipart([Frame(b"fs.new_file"), Frame(bytes(filename, 'utf8'))])
-        print("fs.new_file is sent")
+        logger.debug("New file %s created", filename)
+        changes_pub.send_multipart([b"fs.new_file", bytes(filename, 'utf8'), *store.owners(filename)])
+    if declared_flag:
+        changes_pub.send_multipart([b"fs.declare_file", bytes(filename, 'utf8'), bytes(device_name, 'utf8')])
 
 def file_disown_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, changes_pub: Socket) -> None:
     device_name = str(argframes.pop(0).bytes, encoding='utf8')
     filename = str(argframes.pop(0).bytes, encoding='utf8')
-    if (filename in store.files) and (device_name in store.devices):
-        vfile = store.files[filename]
-        device = store.devices[device_name]
-        if device in vfile.declared_devices:
-            vfile.declared_devices.remove(device)
-            if not device_name.startswith("storage"):
-                vfile.refcount -= 1
-        if vfile.refcount == 0:
-            store.files.pop(filename)
-            print("File {} is deleted".format(filename))
+    result = store.disown(device_name, filename)
+    if result:
+        disowned_flag, deleted_flag = result
+        if disowned_flag:
+            changes_pub.send_multipart([b"fs.disown_file", bytes(filename, 'utf8'), bytes(device_name, 'utf8')])
+        if deleted_flag:
+            logger.debug("File %s is deleted", filename)
             changes_pub.send_multipart([b"fs.delete_file", bytes(filename, 'utf8')])
-            print("fs.delete_file is sent")
         sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))])
     else:
         sock.send_multipart([id_frame, Frame(), Frame(bytes([1]))])
 
-def file_get_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+def file_update_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, changes_pub: Socket) -> None:
+    device_name = str(argframes.pop(0).bytes, encoding='utf8')
+    filename = str(argframes.pop(0).bytes, encoding='utf8')
+    size = argframes.pop(0).bytes if argframes else b""
+    digest = argframes.pop(0).bytes if argframes else b""
+    result = store.update(device_name, filename)
+    if result is None:
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([1]))])
+        return
+    version, disowned, deleted_flag = result
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([0])), Frame(bytes(str(version), 'utf8'))])
+    filename_bytes = bytes(filename, 'utf8')
+    for holder in disowned:
+        changes_pub.send_multipart([b"fs.disown_file", filename_bytes, bytes(holder, 'utf8')])
+    if deleted_flag:
+        changes_pub.send_multipart([b"fs.delete_file", filename_bytes])
+    else:
+        changes_pub.send_multipart([b"fs.update", filename_bytes, bytes(str(version), 'utf8'), bytes(device_name, 'utf8'), size, digest, *store.owners(filename)])
+        logger.debug("File %s is updated to version %d by %s", filename, version, device_name)
+
+def file_get_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
     filename = str(argframes.pop(0).bytes, encoding='utf8')
     if filename in store.files:
         vfile = store.files[filename]
-        device_names = list(map(lambda d: d.name, vfile.declared_devices))
-        sock.send_multipart([id_frame, Frame(), Frame(bytes([0])), Frame(bytes(json.dumps(device_names), 'utf8'))])
+        device_names = [device.name_bytes for device in vfile.declared_devices.values()]
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))] + wire.encode_list(device_names, encoding))
     else:
         sock.send_multipart([id_frame, Frame(), Frame(bytes([1]))])
 
+def file_owners_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
+    filename = str(argframes.pop(0).bytes, encoding='utf8')
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))] + wire.encode_list(list(store.owners(filename)), encoding))
+
+def file_placed_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
+    device_name = str(argframes.pop(0).bytes, encoding='utf8')
+    file_list = [bytes(filename, 'utf8') for filename in store.placed_files(device_name)]
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))] + wire.encode_list(file_list, encoding))
+
+def file_locations(vfile: VirtualFile) -> wire.EncodedLocations:
+    return [(device.name_bytes, device.cast_address_frames) for device in vfile.declared_devices.values()]
+
+def file_locate_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
+    filename = str(argframes.pop(0).bytes, encoding='utf8')
+    if filename in store.files:
+        playload = wire.encode_locations(file_locations(store.files[filename]), encoding)
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))] + playload)
+    else:
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([1]))])
+
+def file_locate_many_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, encoding: str) -> None:
+    result: List[Tuple[bytes, Optional[wire.EncodedLocations]]] = []
+    for filename_frame in argframes:
+        vfile = store.files.get(str(filename_frame.bytes, encoding='utf8'), None)
+        result.append((filename_frame.bytes, file_locations(vfile) if vfile else None))
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))] + wire.encode_locations_many(result, encoding))
+
+def device_drop_handler(store: DirectoryServerStore, sock: Socket, argframes: List[Frame], id_frame: Frame, changes_pub: Socket) -> None:
+    device_name = str(argframes.pop(0).bytes, encoding='utf8')
+    disowned, deleted = store.drop_device(device_name)
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([0]))])
+    device_name_bytes = bytes(device_name, 'utf8')
+    for filename in disowned:
+        changes_pub.send_multipart([b"fs.disown_file", bytes(filename, 'utf8'), device_name_bytes])
+    for filename in deleted:
+        changes_pub.send_multipart([b"fs.delete_file", bytes(filename, 'utf8')])
+    logger.info("Device %s is dropped, %d files disowned and %d files deleted", device_name, len(disowned), len(deleted))
+    publish_moves(store, changes_pub)
+
+def changes_since_handler(feed: "ChangeFeed", sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+    epoch = argframes.pop(0).bytes
+    seq = int(argframes.pop(0).bytes)
+    events = feed.since(seq) if epoch == feed.epoch else None
+    if events is None:
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([1])), feed.epoch, bytes(str(feed.last_seq), 'utf8')])
+    else:
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([0])), feed.epoch, bytes(str(seq + 1), 'utf8'), *events])
+
+MAX_ENCODINGS = 4096
+
+class Encodings(object):
+    """The encodings chosen by proto.hello, by connection identity. ROUTER does not tell when a client is gone,
+    so the least recently used connection is forgotten past MAX_ENCODINGS, its replies are JSON again."""
+    def __init__(self, capacity: int = MAX_ENCODINGS) -> None:
+        self.capacity = capacity
+        self.chosen: "OrderedDict[bytes, str]" = OrderedDict()
+
+    def choose(self, identity: bytes, encoding: str) -> None:
+        self.chosen[identity] = encoding
+        self.chosen.move_to_end(identity)
+        if len(self.chosen) > self.capacity:
+            self.chosen.popitem(last=False)
+
+    def of(self, identity: bytes) -> str:
+        encoding = self.chosen.get(identity, None)
+        if encoding is None:
+            return wire.JSON
+        self.chosen.move_to_end(identity)
+        return encoding
+
+def proto_hello_handler(encodings: Encodings, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+    encoding = wire.choose_encoding(str(argframes.pop(0).bytes, encoding='utf8'))
+    if encoding:
+        encodings.choose(id_frame.bytes, encoding)
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([0])), Frame(bytes(encoding, 'utf8'))])
+    else:
+        sock.send_multipart([id_frame, Frame(), Frame(bytes([1]))])
+
+def stats_handler(report: Dict, sock: Socket, argframes: List[Frame], id_frame: Frame) -> None:
+    sock.send_multipart([id_frame, Frame(), Frame(bytes([0])), bytes(json.dumps(report), 'utf8')])
+
+Handler = Callable[[List[Frame], Frame], None]
+
+def command_table(store: DirectoryServerStore, sock: Socket, changes_pub: Socket, encodings: Encodings) -> Dict[bytes, Handler]:
+    def encoding_of(id_frame: Frame) -> str:
+        return encodings.of(id_frame.bytes)
+
+    return {
+        b'proto.hello': lambda frames, id_frame: proto_hello_handler(encodings, sock, frames, id_frame),
+        b'ping': lambda frames, id_frame: ping_handler(store, sock, frames, id_frame, changes_pub),
+        b'ping.forwarded': lambda frames, id_frame: ping_handler(store, sock, frames[1:], id_frame, changes_pub, str(frames[0].bytes, 'utf8')),
+        b'device.cast_address': lambda frames, id_frame: casting_address_handler(store, sock, frames, id_frame, changes_pub),
+        b'device.heartbeat': lambda frames, id_frame: heartbeat_handler(store, sock, frames, id_frame),
+        b'device.get_addresses': lambda frames, id_frame: get_addresses_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+        b'device.drop': lambda frames, id_frame: device_drop_handler(store, sock, frames, id_frame, changes_pub),
+        b'fs.list': lambda frames, id_frame: file_list_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+        b'fs.declare': lambda frames, id_frame: file_declare_handler(store, sock, frames, id_frame, changes_pub),
+        b'fs.disown': lambda frames, id_frame: file_disown_handler(store, sock, frames, id_frame, changes_pub),
+        b'fs.update': lambda frames, id_frame: file_update_handler(store, sock, frames, id_frame, changes_pub),
+        b'fs.get': lambda frames, id_frame: file_get_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+        b'fs.locate': lambda frames, id_frame: file_locate_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+        b'fs.locate_many': lambda frames, id_frame: file_locate_many_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+        b'fs.owners': lambda frames, id_frame: file_owners_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+        b'fs.placed': lambda frames, id_frame: file_placed_handler(store, sock, frames, id_frame, encoding_of(id_frame)),
+    }
+
+class Outbox(object):
+    """Hold the messages sent by the handlers of a batch, they are sent after the mutations of the batch are durable."""
+    def __init__(self, sock) -> None:
+        self.sock = sock
+        self.messages: List[List] = []
+
+    def send_multipart(self, frames: List) -> None:
+        self.messages.append(frames)
+
+    def flush(self) -> None:
+        for frames in self.messages:
+            self.sock.send_multipart(frames, copy=False)
+        self.messages.clear()
+
+class ChangeFeed(object):
+    """Number the events and keep the last ones for fs.changes_since. Like Outbox, the events are held until flush(),
+    which publishes them in batches of up to MAX_BATCH events (see common/changes.py)."""
+    def __init__(self, sock, capacity: int = changes.RING_CAPACITY) -> None:
+        self.sock = sock
+        self.epoch = os.urandom(8)
+        self.events: Deque[bytes] = deque(maxlen=capacity)
+        self.last_seq = 0
+        self.pending: List[bytes] = []
+
+    def send_multipart(self, frames: List, copy: bool = True) -> None:
+        packed = changes.pack_event(frames)
+        self.events.append(packed)
+        self.pending.append(packed)
+        self.last_seq += 1
+
+    def since(self, seq: int) -> Optional[List[bytes]]:
+        """Return the events after `seq`, or None if some of them are not kept anymore."""
+        first_kept = self.last_seq - len(self.events) + 1
+        if seq + 1 < first_kept or seq > self.last_seq:
+            return None
+        return list(islice(self.events, seq + 1 - first_kept, None))
+
+    def flush(self) -> None:
+        first_seq = self.last_seq - len(self.pending) + 1
+        for start in range(0, len(self.pending), changes.MAX_BATCH):
+            batch = self.pending[start:start+changes.MAX_BATCH]
+            self.sock.send_multipart([changes.TOPIC, self.epoch, bytes(str(first_seq + start), 'utf8'), *batch], copy=False)
+        self.pending.clear()
+
+BATCH_SIZE = 256 # the commands handled before one sync of the journal (group commit)
+
+def server_stats(store: DirectoryServerStore, metrics: Metrics, events, batch: int) -> Dict:
+    report = metrics.report()
+    if isinstance(events, ChangeFeed):
+        queues = {"events": len(events.pending), "ring": len(events.events), "last_seq": events.last_seq}
+    else:
+        queues = {"events": len(events.messages)}
+    queues["batch"] = batch # the commands of the last batch, BATCH_SIZE means more were waiting
+    report["queues"] = queues
+    report["store"] = store.stats()
+    return report
+
+def serve(store: DirectoryServerStore, entrypoint: Socket, events) -> None:
+    """Serve the commands on `entrypoint`, the events go to `events` (a ChangeFeed, or an Outbox in a shard)."""
+    poller = Poller()
+    poller.register(entrypoint, flags=zmq.POLLIN)
+    encodings = Encodings()
+    replies = Outbox(entrypoint)
+    metrics = Metrics()
+    batch = 0
+    commands = command_table(store, replies, events, encodings)
+    commands[b'stats'] = lambda frames, id_frame: stats_handler(server_stats(store, metrics, events, batch), replies, frames, id_frame)
+    if isinstance(events, ChangeFeed):
+        commands[b'fs.changes_since'] = lambda frames, id_frame: changes_since_handler(events, replies, frames, id_frame)
+    expire_at = time.monotonic() + EXPIRE_INTERVAL
+    while True:
+        poller.poll(EXPIRE_INTERVAL * 1000)
+        if time.monotonic() >= expire_at:
+            expire_at = time.monotonic() + EXPIRE_INTERVAL
+            expire_addresses(store, events)
+        handled = 0
+        for _ in range(BATCH_SIZE):
+            try:
+                frames: List[Frame] = entrypoint.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            id_frame: Frame = frames.pop(0)
+            empty_frame: Frame = frames.pop(0)
+            assert(len(empty_frame.bytes) == 0)
+            command_frame: Frame = frames.pop(0)
+            handler = commands.get(command_frame.bytes, None)
+            start = time.perf_counter()
+            bytes_in = frames_size(frames)
+            replied = len(replies.messages)
+            if handler:
+                handler(frames, id_frame)
+            else:
+                replies.send_multipart([id_frame, Frame(), Frame(bytes([1]))])
+            bytes_out = sum(frames_size(message) for message in replies.messages[replied:])
+            metrics.observe(command_frame.bytes if handler else b"(unknown)", time.perf_counter() - start, bytes_in, bytes_out)
+            handled += 1
+        start = time.perf_counter()
+        store.sync()
+        replies.flush()
+        events.flush()
+        if handled:
+            batch = handled
+            metrics.observe(b"(sync)", time.perf_counter() - start) # the group commit and the sending of the batch
+
 def directory_server(store: DirectoryServerStore, zmq_context: Context):
     # pylint: disable=no-member # These zmq.ROUTER and zmq.PUB must be actually exists
-    print("Starting on libzmq {} with PyZMQ {}".format(zmq.zmq_version(), zmq.pyzmq_version()))
+    logger.info("Starting on libzmq %s with PyZMQ %s", zmq.zmq_version(), zmq.pyzmq_version())
     entrypoint: Socket = zmq_context.socket(zmq.ROUTER)
     entrypoint.bind("tcp://127.0.0.1:5350") # This is just a PROTOTYPE!
     pub_file_changes: Socket = zmq_context.socket(zmq.PUB)
     pub_file_changes.bind("tcp://127.0.0.1:5351")
+    logger.info("Directory server is started on 127.0.0.1:5350 (commands) and 127.0.0.1:5351 (file_changes_push)")
+    serve(store, entrypoint, ChangeFeed(pub_file_changes))
+
+class ShardEvents(object):
+    """Push the events of a shard to the front-end, which publishes them on the PUB port."""
+    def __init__(self, sock: Socket, shard_index: int) -> None:
+        self.sock = sock
+        self.shard_frame = bytes([shard_index])
+
+    def send_multipart(self, frames: List, copy: bool = True) -> None:
+        self.sock.send_multipart([self.shard_frame] + frames, copy=copy)
+
+def directory_shard(shard_index: int, commands_address: str, events_address: str, data_path: Optional[str], replicas: int, log_level: Optional[str] = None) -> None:
+    """Entry of a worker process: serve one shard for the front-end."""
+    log.setup(log_level)
+    context = Context()
+    store = DirectoryServerStore(replicas)
+    if data_path:
+        store.open_journal(Journal(os.path.join(data_path, "shard.{}".format(shard_index))))
+    try:
+        entrypoint: Socket = context.socket(zmq.DEALER) # the frames from the front-end are the same as from the clients, envelope included
+        entrypoint.connect(commands_address)
+        events_push: Socket = context.socket(zmq.PUSH)
+        events_push.connect(events_address)
+        logger.info("Shard %d is started", shard_index)
+        serve(store, entrypoint, Outbox(ShardEvents(events_push, shard_index)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store.journal:
+            store.journal.close()
+        context.destroy(linger=0)
+
+FILE_COMMANDS = {b'fs.declare': 1, b'fs.disown': 1, b'fs.update': 1, b'fs.get': 0, b'fs.locate': 0, b'fs.owners': 0} # command -> index of the filename argument
+BROADCAST_COMMANDS = {b'proto.hello', b'ping', b'device.cast_address', b'device.drop', b'device.heartbeat'}
+
+def shard_of(filename: bytes, shard_count: int) -> int:
+    return zlib.crc32(filename) % shard_count
+
+def payload_of(reply: List[Frame], start: int) -> List[bytes]:
+    return [frame.bytes for frame in reply[start:]]
+
+# The replies of the shards are merged in the encoding of the first one. The shards see the same proto.hello,
+# but each one forgets the connections by itself, so the others are decoded whatever their encoding.
+
+def merge_list_replies(replies: List[List[Frame]]) -> List:
+    payloads = [payload_of(reply, 1) for reply in replies]
+    items: List[bytes] = []
+    for payload in payloads:
+        items += payload[1:] if wire.encoding_of(payload) == wire.BINARY else [bytes(item, 'utf8') for item in wire.decode_list(payload)]
+    return [bytes([0])] + wire.encode_list(items, wire.encoding_of(payloads[0]))
+
+def merge_list_page_replies(replies: List[List[Frame]], limit: int) -> List:
+    """Merge the pages of the shards: each one has its first `limit` filenames, so the first `limit` of all are there."""
+    filenames: List[str] = []
+    more = False
+    for reply in replies:
+        filenames += wire.decode_list(payload_of(reply, 3))
+        more = more or bool(reply[2].bytes)
+    filenames.sort()
+    more = more or len(filenames) > limit
+    page = filenames[:limit]
+    count = sum(int(reply[1].bytes) for reply in replies)
+    next_after = page[-1] if more else ""
+    encoding = wire.encoding_of(payload_of(replies[0], 3))
+    return [bytes([0]), bytes(str(count), 'utf8'), bytes(next_after, 'utf8')] + wire.encode_list([bytes(filename, 'utf8') for filename in page], encoding)
+
+def merge_locations_many_replies(replies: List[List[Frame]]) -> List:
+    payloads = [payload_of(reply, 1) for reply in replies]
+    if all(wire.encoding_of(payload) == wire.BINARY for payload in payloads):
+        frames = [bytes([0]), wire.BINARY_MARKER]
+        for payload in payloads:
+            frames += payload[1:]
+        return frames
+    merged = {}
+    for payload in payloads:
+        merged.update(wire.decode_locations_many(payload))
+    return [bytes([0]), bytes(json.dumps(merged), 'utf8')]
+
+def merge_stats_replies(replies: List[List[Frame]], report: Dict) -> List:
+    """Add the stores of the shards, their commands merged and their own reports to the report of the front-end."""
+    shards = [json.loads(reply[1].bytes) for reply in replies]
+    store = dict(shards[0]["store"]) # every shard keeps all the devices
+    store["files"] = sum(shard["store"]["files"] for shard in shards)
+    store["journal_records"] = sum(shard["store"]["journal_records"] for shard in shards)
+    report["store"] = store
+    report["shard_commands"] = merge_commands(shard["commands"] for shard in shards)
+    report["shards"] = shards
+    return [bytes([0]), bytes(json.dumps(report), 'utf8')]
+
+def sharded_directory_server(zmq_context: Context, shard_count: int, data_path: Optional[str] = None, replicas: int = placement.REPLICAS, log_level: Optional[str] = None) -> None:
+    # pylint: disable=no-member
+    logger.info("Starting on libzmq %s with PyZMQ %s and %d shards", zmq.zmq_version(), zmq.pyzmq_version(), shard_count)
+    entrypoint: Socket = zmq_context.socket(zmq.ROUTER)
+    entrypoint.bind("tcp://127.0.0.1:5350")
+    pub_file_changes: Socket = zmq_context.socket(zmq.PUB)
+    pub_file_changes.bind("tcp://127.0.0.1:5351")
+    events_pull: Socket = zmq_context.socket(zmq.PULL)
+    events_port = events_pull.bind_to_random_port("tcp://127.0.0.1")
+    backends: List[Socket] = []
+    workers = []
+    for shard_index in range(shard_count):
+        backend: Socket = zmq_context.socket(zmq.DEALER)
+        port = backend.bind_to_random_port("tcp://127.0.0.1")
+        backends.append(backend)
+        worker = multiprocessing.Process(target=directory_shard, args=(shard_index, "tcp://127.0.0.1:{}".format(port), "tcp://127.0.0.1:{}".format(events_port), data_path, replicas, log_level), daemon=True)
+        worker.start()
+        workers.append(worker)
     poller = Poller()
-    poller.register(entrypoint, flags=zmq.POLLIN)
-    print("Directory server is started on 127.0.0.1:5350 (commands) and 127.0.0.1:5351 (file_changes_push)")
+    poller.register(entrypoint, zmq.POLLIN)
+    poller.register(events_pull, zmq.POLLIN)
+    for backend in backends:
+        poller.register(backend, zmq.POLLIN)
+    # client identity -> [replies left, replies, merge], for the commands sent to more than one shard.
+    # A REQ client has one request at a time, so the identity is enough to match the replies.
+    gathers: Dict[bytes, list] = {}
+    feed = ChangeFeed(pub_file_changes)
+    # The front-end measures the commands as the clients see them, from the request to the reply, the shards included.
+    metrics = Metrics()
+    started: Dict[bytes, Tuple[bytes, float, int]] = {} # client identity -> command, start time, bytes received
+
+    def replied(frames: List) -> None:
+        request = started.pop(frames[0].bytes, None)
+        if request:
+            metrics.observe(request[0], time.perf_counter() - request[1], request[2], frames_size(frames[2:]))
+
+    def front_stats() -> Dict:
+        report = metrics.report()
+        report["queues"] = {"events": len(feed.pending), "ring": len(feed.events), "last_seq": feed.last_seq, "gathers": len(gathers), "in_flight": len(started)}
+        return report
+
+    logger.info("Directory server is started on 127.0.0.1:5350 (commands) and 127.0.0.1:5351 (file_changes_push)")
     while True:
         events: List[Tuple[Socket, int]] = poller.poll()
         for socket, _ in events:
             frames: List[Frame] = socket.recv_multipart(copy=False)
-            id_frame: Frame = frames.pop(0)
-            empty_frame: Frame = frames.pop(0)
-            assert(len(empty_frame.bytes) == 0)
-            command_frame: Frame = frames.pop(0)
-            command = str(command_frame.bytes, encoding='utf8')
-            if command == 'ping':
-                ping_handler(store, socket, frames, id_frame)
-            elif command == 'device.cast_address':
-                casting_address_handler(store, socket, frames, id_frame)
-            elif command == 'device.get_addresses':
-                get_addresses_handler(store, socket, frames, id_frame)
-            elif command == 'fs.list':
-                file_list_handler(store, socket, id_frame)
-            elif command == 'fs.declare':
-                file_declare_handler(store, socket, frames, id_frame, pub_file_changes)
-            elif command == 'fs.disown':
-                file_disown_handler(store, socket, frames, id_frame, pub_file_changes)
-            elif command == 'fs.get':
-                file_get_handler(store, socket, frames, id_frame)
+            if socket == entrypoint:
+                id_frame = frames[0]
+                command = frames[2].bytes
+                started[id_frame.bytes] = (command, time.perf_counter(), frames_size(frames[3:]))
+                if command in FILE_COMMANDS:
+                    backends[shard_of(frames[3 + FILE_COMMANDS[command]].bytes, shard_count)].send_multipart(frames, copy=False)
+                elif command in BROADCAST_COMMANDS:
+                    if command == b'ping': # the shards could not see the address of the client
+                        frames = frames[:2] + [Frame(b'ping.forwarded'), Frame(bytes(frames[3].get("Peer-Address"), 'utf8'))] + frames[3:]
+                    gathers[id_frame.bytes] = [shard_count, [], lambda replies: replies[0]]
+                    for backend in backends:
+                        backend.send_multipart(frames, copy=False)
+                elif command == b'fs.list':
+                    limit = list_arguments(frames[3:])[2]
+                    gathers[id_frame.bytes] = [shard_count, [], lambda replies, limit=limit: merge_list_page_replies(replies, limit)]
+                    for backend in backends:
+                        backend.send_multipart(frames, copy=False)
+                elif command == b'fs.placed':
+                    gathers[id_frame.bytes] = [shard_count, [], merge_list_replies]
+                    for backend in backends:
+                        backend.send_multipart(frames, copy=False)
+                elif command == b'stats':
+                    gathers[id_frame.bytes] = [shard_count, [], lambda replies: merge_stats_replies(replies, front_stats())]
+                    for backend in backends:
+                        backend.send_multipart(frames, copy=False)
+                elif command == b'fs.changes_since':
+                    outbox = Outbox(entrypoint)
+                    changes_since_handler(feed, outbox, frames[3:], id_frame)
+                    replied(outbox.messages[0])
+                    outbox.flush()
+                elif command == b'fs.locate_many' and len(frames) > 3:
+                    subsets: Dict[int, List[Frame]] = {}
+                    for filename_frame in frames[3:]:
+                        subsets.setdefault(shard_of(filename_frame.bytes, shard_count), []).append(filename_frame)
+                    gathers[id_frame.bytes] = [len(subsets), [], merge_locations_many_replies]
+                    for shard_index, filename_frames in subsets.items():
+                        backends[shard_index].send_multipart(frames[:3] + filename_frames, copy=False)
+                else:
+                    backends[0].send_multipart(frames, copy=False)
+            elif socket == events_pull:
+                # take the events waiting, up to a batch, so a burst is published in a few messages
+                while True:
+                    if not (frames[1].bytes.startswith(b"device.") and frames[0].bytes[0] != 0):
+                        feed.send_multipart(frames[1:]) # every shard publishes the events about devices, keep the ones of shard 0
+                    if len(feed.pending) >= changes.MAX_BATCH:
+                        break
+                    try:
+                        frames = events_pull.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+            else:
+                id_frame = frames[0]
+                gather = gathers.get(id_frame.bytes, None)
+                if gather is None:
+                    replied(frames)
+                    entrypoint.send_multipart(frames, copy=False)
+                    continue
+                gather[0] -= 1
+                gather[1].append(frames[2:])
+                if gather[0] == 0:
+                    gathers.pop(id_frame.bytes)
+                    reply = [id_frame, Frame()] + gather[2](gather[1])
+                    replied(reply)
+                    entrypoint.send_multipart(reply, copy=False)
+        feed.flush()
+
+def option(name: str) -> Optional[str]:
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
 
 def main():
-    store = DirectoryServerStore()
+    log_level = option(log.LEVEL_OPTION)
+    log.setup(log_level)
+    replicas = int(option("--replicas") or placement.REPLICAS)
+    store = DirectoryServerStore(replicas)
     context = Context.instance()
+    workers = option("--workers")
+    data_path = option("--data")
     try:
-        directory_server(store, context)
+        if workers:
+            sharded_directory_server(context, int(workers), data_path, replicas, log_level)
+        else:
+            if data_path:
+                store.open_journal(Journal(data_path))
+            directory_server(store, context)
     except KeyboardInterrupt:
         context.destroy()
         print('')
     except BaseException as e:
         context.destroy()
         raise e
+    finally:
+        if store.journal:
+            store.journal.close()
 
 if __name__ == "__main__":
     main()
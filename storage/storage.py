@@ -24,30 +24,162 @@ All at all it's just a prototype. ;)
 In the complete implementation, other clients should be verified to get the files. I will not cover that in this prototype.
 This implementation use zeromq, too.
 Opened Port(s):
-* ROUTER 5354 (command port)
+* ROUTER 5354 (command port, or the one given by --port, to run more storage servers on one host)
+Usage: `python storage.py <name> [data directory] [--workers N] [--port N] [--budget SIZE] [--log-level LEVEL]`
+Without the data directory, the contents are kept in memory. With it, the contents are kept as files under the directory
+and served from memory maps, and the files found there are declared again when the storage server is started.
+Either way the contents are split into content-addressed chunks, so the chunks shared by files are kept
+and downloaded once (see common/chunks.py).
+The storage server pings the directory server with the "storage" role, each file is placed on a few of the storage
+servers (see server/server.py), and this one only downloads the files placed on it: the new files owned by it,
+the files moved to it by fs.place, and on startup the files placed on it while it was away.
+A file moved away is kept until its new owners declared it, then it is released and disowned.
+When it stops, the storage server drops its device (device.drop), so its files are placed on the others at once
+instead of after its address expired. It declares its files again when it is started.
+On fs.update, an owner having the previous version sends the signatures of its blocks to the updating device and
+gets back the changed blocks only (fs.delta, see common/delta.py), then declares the new version. Without the
+previous version, or if the versions differ too much, the new version is downloaded in full. Either way the content
+must have the size and the digest told by fs.update, the peers still having the previous version are skipped.
+The events are numbered (see common/changes.py): the events missed, while starting or under a burst, are asked again by
+fs.changes_since, and if the directory server does not keep them anymore the placement is synced again as on startup.
+The new files are replicated in the background by N workers (REPLICATION_WORKERS by default), the commands are served
+meanwhile. The events for a file already queued or downloading are ignored, a deleted file is dropped from the queue or
+its download is cancelled. When REPLICATION_QUEUE files are waiting, the events are not read until a worker takes one.
+With --budget (bytes, or with a K, M or G suffix), the chunks kept are limited to that size: when a new chunk takes the
+store over it, the contents of the least recently read files are released until it fits again (the chunks shared with
+other files or being served are kept). The compression cache is counted in the budget too, it takes a share of it
+(see COMPRESSION_SHARE) and the chunks the rest. An evicted file placed here stays declared and is downloaded again from the
+other devices when it is read, meanwhile the other commands are served. Its manifest is kept, flagged evicted, so
+after a restart it is still an evicted file and not downloaded again by the placement sync. An evicted file not placed
+here anymore is disowned. storage.stats reports the hits, misses (reads of evicted files) and evictions.
+Without the data directory the budget bounds the memory used by the contents, with it the disk space.
+stats reports the count, the bytes received and sent and the latency histogram of each file command (see
+common/metrics.py), the files waiting for replication, downloading and waiting for their owners to be handed off,
+the reads waiting for an evicted file, and the round trip time and throughput measured for each peer (see common/pool.py).
+The storage server logs to stderr at the level given by --log-level (see common/log.py), each event is logged at DEBUG only.
 Command(s):
-* fs.read_file | filename: str -> 0 | content: bytes
+* fs.read_file | filename: str | codecs: str (optional) -> 0 | content: bytes... | codec: str (if codecs are offered)
+  (the content is sent as its chunks, one frame each, or as one frame when it is compressed)
+* fs.stat | filename: str -> 0 | size: str
+* fs.read_chunk | filename: str | offset: str | length: str | codecs: str (optional) -> 0 | content: bytes | codec: str (if codecs are offered)
+* fs.read_stream | filename: str | offset: str | credit: str | chunk_size: str -> (0 | offset: str | size: str | content: bytes) * credit
+* fs.manifest | filename: str -> 0 | size: str | chunk_size: str | digests: bytes
+* fs.read_range | filename: str | (offset: str | length: str)... -> 0 | size: str | content: bytes (one frame for each range)
+* fs.delta | filename: str | block_size: str | signatures: bytes | codecs: str (optional) -> 0 | size: str | digest: bytes | delta: bytes | codec: str
+* storage.stats -> 0 | stats: JSON object (files, resident, bytes, budget, hits, misses, evictions, compression counters)
+* stats -> 0 | stats: JSON object (the counters of the commands, the queues, storage.stats as "store", and the peers)
+The codecs offered are like "zlib:6,lzma", the content is sent compressed if it is worth it (see common/compression.py).
 """
 import asyncio
-import zmq
 import json
+import logging
+import os
+import sys
+import zmq
+from collections import OrderedDict
 from dataclasses import dataclass
 from zmq import Frame
-from zmq.asyncio import Socket, Context, Poller
-from typing import List, Iterable, Dict, Tuple
+from zmq.asyncio import Socket, Context
+from typing import List, Iterable, Dict, Tuple, Optional, Set, Awaitable, TypeVar, Callable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import peer, chunks, wire, changes, log
+from common.backend import MemoryBackend, DiskBackend
+from common.chunks import ChunkStore, ChunkedContent
+from common.compression import CompressionCache, CACHE_CAPACITY
+from common.location_cache import LocationCache, EVENT_TOPICS
+from common.metrics import Metrics, CountingSocket, frames_size
+from common.pool import PeerPool
+
+logger = logging.getLogger("storage")
+
+REPLICATION_WORKERS = 4
+REPLICATION_QUEUE = 64
+HEARTBEAT_INTERVAL = 10.0 # seconds, the directory server expires an address without heartbeats
+DROP_TIMEOUT = 2.0 # seconds for the directory server to answer device.drop when stopping
+COMPRESSION_SHARE = 8 # with a budget, the compression cache takes 1/8 of it (CACHE_CAPACITY at most), the chunks the rest
 
 @dataclass
 class VirtualFile(object):
     name: str
-    content: bytes
+    content: bytes # None while it is downloading or after it is evicted
     declared_device_names: List[str]
+    evicted: bool = False
 
 class StorageServerStore(object):
-    def __init__(self) -> None:
+    def __init__(self, backend=None, budget: Optional[int] = None) -> None:
         self.files: Dict[str, VirtualFile] = {}
+        self.backend = backend if backend else MemoryBackend()
+        self.budget = budget
+        cache_capacity = CACHE_CAPACITY if budget is None else min(CACHE_CAPACITY, budget // COMPRESSION_SHARE)
+        self.chunks = ChunkStore(self.backend, None if budget is None else budget - cache_capacity) # files are kept as deduplicated chunks
+        self.chunks.reclaim = self.evict
+        self.compressed = CompressionCache(cache_capacity) # the compressed chunks sent to the readers
+        self.recent: "OrderedDict[str, None]" = OrderedDict() # the files having their content, least recently used first
+        self.on_evicted: Callable[[str], None] = lambda filename: None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self) -> None:
+        for filename, content in self.chunks.load():
+            self.files[filename] = VirtualFile(filename, content, [], evicted=content is None)
+            if content is not None:
+                self.recent[filename] = None
+        if (self.chunks.budget is not None) and self.chunks.stored_bytes > self.chunks.budget:
+            self.evict(self.chunks.stored_bytes - self.chunks.budget)
+
+    def set_content(self, filename: str, content: ChunkedContent) -> None:
+        vfile = self.files[filename]
+        vfile.content = content
+        vfile.evicted = False
+        self.recent[filename] = None
+        self.recent.move_to_end(filename)
+
+    def touch(self, filename: str) -> None:
+        if filename in self.recent:
+            self.recent.move_to_end(filename)
+            self.hits += 1
+
+    def forget(self, filename: str) -> Optional[VirtualFile]:
+        """Remove the file and release its content."""
+        vfile = self.files.pop(filename, None)
+        self.recent.pop(filename, None)
+        if vfile and (vfile.content is not None):
+            self.chunks.release(filename, vfile.content)
+        elif vfile and vfile.evicted:
+            self.chunks.forget(filename)
+        return vfile
+
+    def evict(self, excess: int) -> None:
+        """Release the contents of the least recently used files until `excess` bytes are freed.
+        The files are kept as evicted, their contents are downloaded again when they are read."""
+        target = self.chunks.stored_bytes - excess
+        while self.chunks.stored_bytes > target and self.recent:
+            filename, _ = self.recent.popitem(last=False)
+            vfile = self.files[filename]
+            self.chunks.evict(filename, vfile.content) # the chunks shared with other files or pinned are kept
+            vfile.content = None
+            vfile.evicted = True
+            self.evictions += 1
+            self.on_evicted(filename)
 
-async def ping(sock: Socket, device_name: str) -> str:
-    await sock.send_multipart([Frame(b"ping"), Frame(bytes(device_name, encoding='utf8'))])
+    def stats(self) -> Dict[str, Optional[int]]:
+        return {
+            "files": len(self.files),
+            "resident": len(self.recent),
+            "bytes": self.chunks.stored_bytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "compression_hits": self.compressed.hits,
+            "compression_misses": self.compressed.misses,
+            "compression_skipped": self.compressed.skipped,
+            "compression_bytes": self.compressed.size,
+        }
+
+async def ping(sock: Socket, device_name: str, role: str = "storage") -> str:
+    await sock.send_multipart([Frame(b"ping"), Frame(bytes(device_name, encoding='utf8')), Frame(bytes(role, encoding='utf8'))])
     frames: List[Frame] = await sock.recv_multipart(copy=False)
     command_frame = frames.pop(0)
     assert(command_frame.bytes == b"pong")
@@ -59,119 +191,542 @@ async def cast_address(sock: Socket, device_name: str, addr: str) -> None:
     result: bytes = await sock.recv()
     assert result[0] == 0
 
-async def get_file_declared_devices(sock: Socket, filename: str) -> List[str]:
-    await sock.send_multipart([b"fs.get", bytes(filename, 'utf8')])
+async def send_heartbeat(sock: Socket, device_name: str, addr: str) -> bool:
+    """Return False if the address is not casted anymore."""
+    await sock.send_multipart([b"device.heartbeat", bytes(device_name, 'utf8'), bytes(addr, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    return frames[0][0] == 0
+
+async def drop_device(sock: Socket, device_name: str) -> None:
+    await sock.send_multipart([b"device.drop", bytes(device_name, 'utf8')])
+    await sock.recv_multipart()
+
+async def leave(context: Context, device_name: str) -> None:
+    """Tell the directory server this storage server is stopping, its files are placed on the others.
+    A socket of its own is used, the stopped tasks may have left a request unanswered on the other one."""
+    sock = context.socket(zmq.REQ)
+    sock.connect("tcp://127.0.0.1:5350")
+    try:
+        await asyncio.wait_for(drop_device(sock, device_name), DROP_TIMEOUT)
+        logger.info("Device %s is dropped from directory server", device_name)
+    except asyncio.TimeoutError:
+        logger.warning("Directory server did not answer device.drop")
+    finally:
+        sock.close(linger=0)
+
+async def negotiate_encoding(sock: Socket) -> str:
+    await sock.send_multipart([b"proto.hello", bytes(",".join(wire.ENCODINGS), 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    if frames[0][0] == 0:
+        return str(frames[1], 'utf8')
+    else:
+        return wire.JSON # the server does not know proto.hello
+
+async def locate_file(sock: Socket, filename: str) -> Dict[str, List[str]]:
+    await sock.send_multipart([b"fs.locate", bytes(filename, 'utf8')])
+    frames: List[bytes] = await sock.recv_multipart()
+    assert(frames.pop(0)[0] == 0)
+    return wire.decode_locations(frames)
+
+async def get_file_owners(sock: Socket, filename: str) -> List[str]:
+    await sock.send_multipart([b"fs.owners", bytes(filename, 'utf8')])
     frames: List[bytes] = await sock.recv_multipart()
     assert(frames.pop(0)[0] == 0)
-    device_list_frame = frames.pop(0)
-    result = json.loads(device_list_frame)
-    assert(isinstance(result, list))
-    return result
+    return wire.decode_list(frames)
 
-async def get_devices_declared_addresses(sock: Socket, device_name: str) -> List[str]:
-    await sock.send_multipart([b"device.get_addresses", bytes(device_name, 'utf8')])
+async def get_placed_files(sock: Socket, device_name: str) -> List[str]:
+    await sock.send_multipart([b"fs.placed", bytes(device_name, 'utf8')])
     frames: List[bytes] = await sock.recv_multipart()
     assert(frames.pop(0)[0] == 0)
-    device_addresses_frame = frames.pop(0)
-    result = json.loads(device_addresses_frame)
-    assert(isinstance(result, list))
-    return result
+    return wire.decode_list(frames)
 
-async def download_file(context: Context, dirserv_sock: Socket, filename: str) -> bytes:
-    devices = await get_file_declared_devices(dirserv_sock, filename)
+def flatten_locations(locations: Dict[str, List[str]]) -> List[str]:
     all_declared_addresses = []
-    for dev_name in devices:
-        addresses = await get_devices_declared_addresses(dirserv_sock, dev_name)
+    for addresses in locations.values():
         all_declared_addresses += addresses
-    used_address = all_declared_addresses[0] # we use only one connection to 'download' files here,
-    # but a complete implementation must download them from different devices to speed up the process
-    download_sock: Socket = context.socket(zmq.REQ)
-    download_sock.connect(used_address)
-    await download_sock.send_multipart([b"fs.read_file", bytes(filename, 'utf8')])
-    frames: List[bytes] = await download_sock.recv_multipart()
-    # This is just a sample protocol, and it does not need complex functions to deal with big contents
-    download_sock.close()
-    if frames[0][0] == 0:
-        return frames.pop(1)
-    else:
-        return None
+    return all_declared_addresses
+
+T = TypeVar('T')
 
-async def declare_file(sock: Socket, filename: str, device_name: str) -> None:
-    await sock.send_multipart([b"fs.declare", bytes(device_name, 'utf8'), bytes(filename, 'utf8')])
+async def locked_request(lock: asyncio.Lock, request: Awaitable[T]) -> T:
+    """Run `request` on the REQ socket to the directory server shared by the tasks, one at a time.
+    It is not cancelled with the caller: a REQ socket left between a request and its reply could not be used anymore.
+    """
+    async def run() -> T:
+        async with lock:
+            return await request
+    return await asyncio.shield(run())
+
+async def get_file_addresses(dirserv_sock: Socket, dirserv_lock: asyncio.Lock, filename: str, cache: LocationCache, exclude: Optional[str] = None) -> List[str]:
+    # devices and their addresses in one round trip, or none if they are cached
+    all_declared_addresses = flatten_locations(await cache.locate(filename, lambda: locked_request(dirserv_lock, locate_file(dirserv_sock, filename))))
+    return [address for address in all_declared_addresses if address != exclude]
+
+async def download_file(pool: PeerPool, dirserv_sock: Socket, dirserv_lock: asyncio.Lock, filename: str, chunk_store: ChunkStore, cache: LocationCache, exclude: Optional[str] = None, digest: Optional[bytes] = None) -> Optional[Tuple[int, int, List[bytes]]]:
+    all_declared_addresses = await get_file_addresses(dirserv_sock, dirserv_lock, filename, cache, exclude)
+    # chunks are pulled from all the devices at once, and only the chunks we do not have yet. See common/peer.py
+    return await peer.download_chunks(pool, all_declared_addresses, filename, chunk_store, digest=digest)
+
+async def declare_file(sock: Socket, filename: str, device_name: str, version: Optional[int] = None) -> bool:
+    """Declare the file, return False if `version` is given and the file has another version now."""
+    request = [b"fs.declare", bytes(device_name, 'utf8'), bytes(filename, 'utf8')]
+    if version is not None:
+        request.append(bytes(str(version), 'utf8'))
+    await sock.send_multipart(request)
     frames: List[bytes] = await sock.recv_multipart()
-    assert(frames[0][0] == 0)
+    assert(frames[0][0] in (0, 2))
+    return frames[0][0] == 0
+
+async def get_changes_since(sock: Socket, epoch: bytes, seq: int) -> List[bytes]:
+    await sock.send_multipart([b"fs.changes_since", epoch, bytes(str(seq), 'utf8')])
+    return await sock.recv_multipart()
 
 async def disown_file(sock: Socket, filename: str, device_name: str) -> None:
     await sock.send_multipart([b"fs.disown", bytes(device_name, 'utf8'), bytes(filename, 'utf8')])
     await sock.recv_multipart() # Eat result sliently
 
-async def new_file_event_callback(store: StorageServerStore, argframes: List[Frame], dirserv_sock: Socket, context: Context, device_name: str) -> None:
-    filename = str(argframes.pop(0).bytes, 'utf8')
-    store.files[filename] = VirtualFile(filename, None, [])
-    print("New virtual file '{}' added".format(filename))
-    store.files[filename].content = await download_file(context, dirserv_sock, filename)
-    await declare_file(dirserv_sock, filename, device_name)
+class Replicator(object):
+    """Download the new files with a few workers, then declare them on the directory server.
+    A new version of a file kept here is pulled as a delta from the previous one, the evicted files are downloaded again
+    by `refetch()` when they are read."""
+    def __init__(self, store: StorageServerStore, pool: PeerPool, dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str, self_address: str, cache: LocationCache, workers: int = REPLICATION_WORKERS, capacity: int = REPLICATION_QUEUE) -> None:
+        self.store = store
+        self.pool = pool
+        self.dirserv_sock = dirserv_sock
+        self.dirserv_lock = dirserv_lock
+        self.device_name = device_name
+        self.self_address = self_address # the downloads skip this address, the content here is not there
+        self.cache = cache
+        self.refetching: Dict[str, asyncio.Future] = {}
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(capacity)
+        self.queued: Set[str] = set() # the filenames in the queue, a filename removed from it is skipped by the workers
+        self.running: Dict[str, asyncio.Task] = {}
+        self.cancelled: Set[asyncio.Task] = set()
+        self.versions: Dict[str, int] = {} # the version to declare after the download, if it is known
+        self.expected: Dict[str, Tuple[Optional[int], Optional[bytes]]] = {} # the size and digest of an update
+        self.workers = [asyncio.ensure_future(self._work()) for _ in range(workers)]
 
-async def delete_file_event_callback(store: StorageServerStore, argframes: List[Frame], dirserv_sock: Socket, device_name: str) -> None:
-    filename = str(argframes.pop(0).bytes, 'utf8')
-    store.files.pop(filename)
-    await disown_file(dirserv_sock, filename, device_name)
+    async def submit(self, filename: str, version: Optional[int] = None) -> None:
+        """Queue `filename`, wait while the queue is full."""
+        if (filename in self.queued) or (filename in self.running) or (filename in self.store.files):
+            return
+        self.store.files[filename] = VirtualFile(filename, None, []) # no content until it is downloaded
+        if version is not None:
+            self.versions[filename] = version
+        self.queued.add(filename)
+        logger.debug("New virtual file '%s' added", filename)
+        await self.queue.put(filename)
+
+    async def update(self, filename: str, version: int, size: Optional[int] = None, digest: Optional[bytes] = None) -> None:
+        """Queue the new version of `filename`, the previous version kept here is the base of a delta.
+        A content not having `size` and `digest` (if they are given) is another version, it is not taken."""
+        self.cancel(filename) # the download of the previous version
+        if filename not in self.store.files:
+            self.store.files[filename] = VirtualFile(filename, None, [])
+        self.versions[filename] = version
+        self.expected[filename] = (size, digest)
+        self.queued.add(filename)
+        await self.queue.put(filename)
+
+    def cancel(self, filename: str) -> bool:
+        """Drop `filename` from the queue or cancel its download, return if it was queued or downloading."""
+        self.expected.pop(filename, None)
+        if filename in self.queued:
+            self.queued.discard(filename)
+            return True
+        task = self.running.get(filename, None)
+        if task:
+            self.cancelled.add(task)
+            task.cancel()
+            return True
+        return False
 
-async def read_file_handler(store: StorageServerStore, argframes: List[Frame], sock: Socket, id_frame: Frame):
+    async def _work(self) -> None:
+        while True:
+            filename = await self.queue.get()
+            if filename not in self.queued:
+                continue # cancelled while waiting
+            self.queued.discard(filename)
+            task = self.running[filename] = asyncio.ensure_future(self._replicate(filename))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if task not in self.cancelled:
+                    raise # the worker itself is cancelled
+                logger.debug("Download of '%s' is cancelled", filename)
+            except Exception as e:
+                self.store.forget(filename)
+                logger.warning("Could not replicate '%s': %r", filename, e)
+            finally:
+                if self.running.get(filename, None) is task: # a new version may be downloading already
+                    self.running.pop(filename)
+                self.cancelled.discard(task)
+
+    async def _replicate(self, filename: str) -> None:
+        store = self.store
+        version = self.versions.pop(filename, None)
+        size, digest = self.expected.pop(filename, (None, None))
+        previous = store.files[filename].content
+        content: Optional[ChunkedContent] = None
+        if previous is not None:
+            store.recent.pop(filename, None) # the previous version is not evicted meanwhile
+        if (previous is not None) and len(previous) <= peer.MAX_DELTA_SIZE: # a new version: pull the changed blocks only
+            addresses = await get_file_addresses(self.dirserv_sock, self.dirserv_lock, filename, self.cache, self.self_address)
+            new_content = await peer.find_delta(self.pool, addresses, filename, bytes(chunks.as_buffer(previous)), digest=digest)
+            if (new_content is not None) and ((size is None) or len(new_content) == size):
+                content = store.chunks.put(filename, new_content)
+                logger.debug("'%s' is updated by a delta", filename)
+        if content is None:
+            manifest = await download_file(self.pool, self.dirserv_sock, self.dirserv_lock, filename, store.chunks, self.cache, self.self_address, digest)
+            if (manifest is not None) and (size is not None) and manifest[0] != size:
+                store.chunks.collect(manifest[2])
+                manifest = None
+            if manifest is None:
+                store.forget(filename)
+                logger.warning("Could not download '%s'", filename)
+                return
+            content = store.chunks.add(filename, *manifest)
+        if previous is not None:
+            store.chunks.unreference(previous)
+        store.set_content(filename, content)
+        if not await locked_request(self.dirserv_lock, declare_file(self.dirserv_sock, filename, self.device_name, version)):
+            logger.debug("'%s' has a newer version already", filename) # its fs.update event queues it again
+
+    async def refetch(self, filename: str) -> bool:
+        """Download the content of an evicted file again, return if it is here now. The readers of one file share the download."""
+        future = self.refetching.get(filename, None)
+        if future is None:
+            future = self.refetching[filename] = asyncio.ensure_future(self._refetch(filename))
+            future.add_done_callback(lambda _: self.refetching.pop(filename, None))
+        return await asyncio.shield(future)
+
+    async def _refetch(self, filename: str) -> bool:
+        store = self.store
+        try:
+            manifest = await download_file(self.pool, self.dirserv_sock, self.dirserv_lock, filename, store.chunks, self.cache, self.self_address)
+        except AssertionError: # the file is deleted
+            manifest = None
+        vfile = store.files.get(filename, None)
+        if (vfile is None) or (not vfile.evicted): # deleted, or downloaded by another way meanwhile
+            if manifest:
+                store.chunks.collect(manifest[2])
+            return (vfile is not None) and (vfile.content is not None)
+        if manifest is None:
+            logger.warning("Could not download evicted '%s' again", filename)
+            return False
+        store.set_content(filename, store.chunks.add(filename, *manifest))
+        return True
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        for task in self.running.values():
+            task.cancel()
+        for future in self.refetching.values():
+            future.cancel()
+
+async def release_file(store: StorageServerStore, filename: str, dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str) -> None:
+    if store.forget(filename) is None:
+        return
+    await locked_request(dirserv_lock, disown_file(dirserv_sock, filename, device_name))
+
+class Handoff(object):
+    """The files kept here but placed on other storage servers. Each one is released after all its owners declared it,
+    so a file is not lost while it moves."""
+    def __init__(self, store: StorageServerStore, dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str, cache: LocationCache) -> None:
+        self.store = store
+        self.dirserv_sock = dirserv_sock
+        self.dirserv_lock = dirserv_lock
+        self.device_name = device_name
+        self.cache = cache
+        self.waiting: Dict[str, Set[str]] = {} # filename -> the owners not declaring it yet
+        self.releasing: Set[asyncio.Task] = set()
+
+    def evicted(self, filename: str) -> None:
+        """An evicted file is not downloaded again if it is not placed here, it is released at once."""
+        if filename in self.waiting:
+            self.waiting.pop(filename)
+            task = asyncio.ensure_future(self.release(filename))
+            self.releasing.add(task)
+            task.add_done_callback(self.releasing.discard)
+
+    async def hand_off(self, filename: str, owners: Iterable[str]) -> None:
+        try:
+            locations = await self.cache.locate(filename, lambda: locked_request(self.dirserv_lock, locate_file(self.dirserv_sock, filename)))
+        except AssertionError: # the file is deleted already
+            self.waiting.pop(filename, None)
+            return
+        waiting = set(owners) - set(locations)
+        if waiting:
+            self.waiting[filename] = waiting
+        else:
+            await self.release(filename)
+
+    async def declared(self, filename: str, device_name: str) -> None:
+        waiting = self.waiting.get(filename, None)
+        if waiting is None:
+            return
+        waiting.discard(device_name)
+        if not waiting:
+            await self.release(filename)
+
+    def forget(self, filename: str) -> None:
+        self.waiting.pop(filename, None)
+
+    async def release(self, filename: str) -> None:
+        self.waiting.pop(filename, None)
+        await release_file(self.store, filename, self.dirserv_sock, self.dirserv_lock, self.device_name)
+        logger.debug("File '%s' is handed off", filename)
+
+async def new_file_event_callback(replicator: Replicator, argframes: List[bytes], device_name: str) -> None:
+    filename = str(argframes.pop(0), 'utf8')
+    owners = [str(frame, 'utf8') for frame in argframes]
+    if owners and (device_name not in owners):
+        return # placed on the other storage servers
+    await replicator.submit(filename, 1)
+
+async def update_event_callback(store: StorageServerStore, argframes: List[bytes], device_name: str, replicator: Replicator, handoff: Handoff) -> None:
+    filename = str(argframes.pop(0), 'utf8')
+    version = int(argframes.pop(0))
+    argframes.pop(0) # the updating device, the only one declaring the file now
+    size = int(argframes.pop(0) or b"-1")
+    digest = argframes.pop(0) or None
+    owners = [str(frame, 'utf8') for frame in argframes]
+    handoff.forget(filename)
+    if owners and (device_name not in owners):
+        replicator.cancel(filename)
+        store.forget(filename) # the directory server disowned the previous version here already
+        return
+    await replicator.update(filename, version, size if size >= 0 else None, digest)
+
+async def place_event_callback(store: StorageServerStore, argframes: List[bytes], dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str, replicator: Replicator, handoff: Handoff) -> None:
+    filename = str(argframes.pop(0), 'utf8')
+    owners = [str(frame, 'utf8') for frame in argframes]
+    if device_name in owners:
+        handoff.forget(filename)
+        await replicator.submit(filename)
+    elif replicator.cancel(filename):
+        await release_file(store, filename, dirserv_sock, dirserv_lock, device_name)
+    elif filename in store.files:
+        await handoff.hand_off(filename, owners)
+
+async def delete_file_event_callback(store: StorageServerStore, argframes: List[bytes], dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str, replicator: Replicator, handoff: Handoff) -> None:
+    filename = str(argframes.pop(0), 'utf8')
+    replicator.cancel(filename)
+    handoff.forget(filename)
+    await release_file(store, filename, dirserv_sock, dirserv_lock, device_name)
+
+async def sync_placement(store: StorageServerStore, dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str, replicator: Replicator, handoff: Handoff) -> None:
+    """Download the files placed here while this storage server was away, and hand off the files it does not own anymore."""
+    placed = set(await locked_request(dirserv_lock, get_placed_files(dirserv_sock, device_name)))
+    for filename in list(store.files.keys()):
+        if filename not in placed:
+            owners = await locked_request(dirserv_lock, get_file_owners(dirserv_sock, filename))
+            await handoff.hand_off(filename, owners)
+    for filename in placed:
+        await replicator.submit(filename)
+    logger.info("Placement synced, %d files placed here", len(placed))
+
+async def read_file_handler(store: StorageServerStore, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
     filename = str(argframes.pop(0).bytes, 'utf8')
+    offered = argframes.pop(0).bytes if argframes else None
     vfile = store.files.get(filename, None)
-    if vfile:
-        sock.send_multipart([id_frame, Frame(), bytes([0]), vfile.content])
+    if vfile and (vfile.content is not None):
+        # the chunks are sent as they are kept, only a compressed content is made in one piece
+        content = await peer.encode_content(store, vfile.content, offered, lambda: peer.content_digest(vfile))
+        await sock.send_multipart([*envelope, Frame(), bytes([0]), *chunks.pieces(content[0]), *content[1:]], copy=False)
     else:
-        sock.send(bytes([0]))
+        await sock.send_multipart([*envelope, Frame(), bytes([1])])
+
+async def stats_handler(report: Dict, argframes: List[Frame], sock: Socket, envelope: List[Frame]):
+    await sock.send_multipart([*envelope, Frame(), bytes([0]), bytes(json.dumps(report), 'utf8')])
+
+def storage_stats(store: StorageServerStore, metrics: Metrics, replicator: Replicator, handoff: Handoff, pool: PeerPool, refetching: Set[asyncio.Task], background: peer.BackgroundCommands) -> Dict:
+    report = metrics.report()
+    report["queues"] = {
+        "replication": len(replicator.queued),
+        "downloading": len(replicator.running),
+        "refetching": len(replicator.refetching),
+        "waiting_readers": len(refetching), # the reads of evicted files, waiting for their download
+        "background": len(background.running), # the commands served in their own tasks (see peer.BackgroundCommands)
+        "handoff": len(handoff.waiting),
+    }
+    report["store"] = store.stats()
+    report["peers"] = pool.stats()
+    return report
+
+FILE_HANDLERS = {
+    'fs.read_file': read_file_handler,
+    'fs.stat': peer.stat_handler,
+    'fs.read_chunk': peer.read_chunk_handler,
+    'fs.read_stream': peer.read_stream_handler,
+    'fs.manifest': peer.manifest_handler,
+    'fs.read_range': peer.read_range_handler,
+    'fs.delta': peer.delta_handler,
+}
+
+async def serve_file_command(store: StorageServerStore, handler, frames: List[Frame], sock: Socket, envelope: List[Frame], filename: str) -> None:
+    # the chunks of the file are pinned while it is served, so an eviction in the meantime does not remove them under the handler
+    vfile = store.files.get(filename, None)
+    digests = vfile.content.digests if vfile and isinstance(vfile.content, ChunkedContent) else []
+    store.chunks.pin(digests)
+    try:
+        await handler(store, frames, sock, envelope)
+    finally:
+        store.chunks.unpin(digests)
+        store.chunks.collect(digests)
+
+async def serve_evicted(store: StorageServerStore, replicator: Replicator, handler, frames: List[Frame], sock: Socket, envelope: List[Frame], filename: str) -> None:
+    await replicator.refetch(filename) # the handler replies 1 if it could not be downloaded
+    await serve_file_command(store, handler, frames, sock, envelope, filename)
 
+async def serve_commands(store: StorageServerStore, command_port: Socket, replicator: Replicator, handoff: Handoff, pool: PeerPool) -> None:
+    refetching: Set[asyncio.Task] = set()
+    background = peer.BackgroundCommands()
+    metrics = Metrics()
+    while True:
+        frames: List[Frame] = await command_port.recv_multipart(copy=False)
+        envelope, frames = peer.split_envelope(frames)
+        command_frame = frames.pop(0)
+        command = str(command_frame.bytes, 'utf8', 'replace')
+        if command == 'storage.stats':
+            await stats_handler(store.stats(), frames, command_port, envelope)
+            continue
+        if command == 'stats':
+            await stats_handler(storage_stats(store, metrics, replicator, handoff, pool, refetching, background), frames, command_port, envelope)
+            continue
+        handler = FILE_HANDLERS.get(command, None)
+        if (handler is None) or (not frames):
+            continue
+        filename = str(frames[0].bytes, 'utf8', 'replace') # no file here has it if it is not UTF-8
+        vfile = store.files.get(filename, None)
+        reply = CountingSocket(command_port) # counts the bytes sent for the stats
+        if vfile and vfile.evicted:
+            # the other commands are served while it is downloaded again
+            store.misses += 1
+            task = asyncio.ensure_future(peer.guarded(command, metrics.measure(command, frames_size(frames), reply, serve_evicted(store, replicator, handler, frames, reply, envelope, filename))))
+            refetching.add(task)
+            task.add_done_callback(refetching.discard)
+        else:
+            store.touch(filename)
+            serving = peer.guarded(command, metrics.measure(command, frames_size(frames), reply, serve_file_command(store, handler, frames, reply, envelope, filename)))
+            if command in peer.BACKGROUND_COMMANDS:
+                await background.start(serving)
+            else:
+                await serving
+
+async def keep_alive(dirserv_sock: Socket, dirserv_lock: asyncio.Lock, device_name: str, addr: str) -> None:
+    """Send a heartbeat for the address every HEARTBEAT_INTERVAL seconds, cast it again if it is expired."""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        if not await locked_request(dirserv_lock, send_heartbeat(dirserv_sock, device_name, addr)):
+            await locked_request(dirserv_lock, cast_address(dirserv_sock, device_name, addr))
+            logger.warning("Address %s is casted again", addr)
+
+async def follow_changes(store: StorageServerStore, file_changes_sub: Socket, dirserv_sock: Socket, dirserv_lock: asyncio.Lock, name: str, location_cache: LocationCache, replicator: Replicator, handoff: Handoff, cursor: changes.ChangeCursor) -> None:
+    fetch = lambda epoch, seq: locked_request(dirserv_lock, get_changes_since(dirserv_sock, epoch, seq))
+    while True:
+        events = await cursor.receive(await file_changes_sub.recv_multipart(), fetch)
+        if events is None:
+            logger.warning("File changes are missed and not kept on the directory server, syncing placement")
+            location_cache.clear()
+            # the directory server could be another run, which does not know the encoding chosen by this connection
+            await locked_request(dirserv_lock, negotiate_encoding(dirserv_sock))
+            await sync_placement(store, dirserv_sock, dirserv_lock, name, replicator, handoff)
+            continue
+        for frames in events:
+            location_cache.handle_event(frames)
+            command = str(frames.pop(0), 'utf8')
+            logger.debug("File change received: %s", command)
+            if command == 'fs.delete_file':
+                await delete_file_event_callback(store, frames, dirserv_sock, dirserv_lock, name, replicator, handoff)
+            elif command == 'fs.new_file':
+                await new_file_event_callback(replicator, frames, name) # waits here while the replication queue is full
+            elif command == 'fs.update':
+                await update_event_callback(store, frames, name, replicator, handoff)
+            elif command == 'fs.place':
+                await place_event_callback(store, frames, dirserv_sock, dirserv_lock, name, replicator, handoff)
+            elif command == 'fs.declare_file':
+                await handoff.declared(str(frames[0], 'utf8'), str(frames[1], 'utf8'))
 
-async def storage_server(store: StorageServerStore, context: Context, name: str):
-    print("Starting...")
+async def storage_server(store: StorageServerStore, context: Context, name: str, workers: int = REPLICATION_WORKERS, port: int = 5354):
+    logger.info("Starting...")
     dirserv_commands = context.socket(zmq.REQ)
     dirserv_commands.connect("tcp://127.0.0.1:5350")
+    encoding = await asyncio.wait_for(negotiate_encoding(dirserv_commands), 5)
+    logger.debug("Directory server replies in %s", encoding)
     self_addr = await asyncio.wait_for(ping(dirserv_commands, name), 5)
-    print("Directory server report this client is run on {}".format(self_addr))
-    self_entrypoint_addr = "tcp://{}:{}".format(self_addr, 5354)
+    logger.info("Directory server report this client is run on %s", self_addr)
+    self_entrypoint_addr = "tcp://{}:{}".format(self_addr, port)
     command_port = context.socket(zmq.ROUTER)
-    command_port.bind("tcp://127.0.0.1:5354")
+    command_port.bind("tcp://127.0.0.1:{}".format(port))
     await asyncio.wait_for(cast_address(dirserv_commands, name, self_entrypoint_addr), 5)
-    print("Address {} casted on directory server".format(self_entrypoint_addr))
+    logger.info("Address %s casted on directory server", self_entrypoint_addr)
+    for filename in list(store.files.keys()): # files kept by the backend before restart
+        await declare_file(dirserv_commands, filename, name)
+        logger.debug("File %s is re-declared", filename)
     file_changes_sub = context.socket(zmq.SUB)
     file_changes_sub.connect("tcp://127.0.0.1:5351")
-    file_changes_sub.setsockopt(zmq.SUBSCRIBE, b"fs")
-    poller = Poller()
-    poller.register(file_changes_sub, zmq.POLLIN)
-    poller.register(command_port, zmq.POLLIN)
-    print("Storage server is started")
-    while True:
-        events: List[Tuple[Socket, int]] = await poller.poll()
-        for socket, mark in events:
-            frames: List[Frame] = await socket.recv_multipart(copy=False)
-            if socket == command_port:
-                id_frame = frames.pop(0)
-                frames.pop(0)
-                command_frame = frames.pop(0)
-                command = str(command_frame.bytes, 'utf8')
-                if command == 'fs.read_file':
-                    await read_file_handler(store, frames, socket, id_frame)
-            elif socket == file_changes_sub:
-                command_frame = frames.pop(0)
-                command = str(command_frame.bytes, 'utf8')
-                print("File change received: {}".format(command))
-                if command == 'fs.delete_file':
-                    await delete_file_event_callback(store, frames, dirserv_commands, name)
-                elif command == 'fs.new_file':
-                    await new_file_event_callback(store, frames, dirserv_commands, context, name)
+    for topic in EVENT_TOPICS:
+        file_changes_sub.setsockopt(zmq.SUBSCRIBE, topic)
+    location_cache = LocationCache()
+    peer_pool = PeerPool(context) # connections to the other peers, kept across downloads
+    dirserv_lock = asyncio.Lock()
+    replicator = Replicator(store, peer_pool, dirserv_commands, dirserv_lock, name, self_entrypoint_addr, location_cache, workers)
+    handoff = Handoff(store, dirserv_commands, dirserv_lock, name, location_cache)
+    store.on_evicted = handoff.evicted
+    cursor = changes.ChangeCursor()
+    # the position is taken before the placement is synced, so the changes after the sync are not missed
+    await cursor.start(lambda epoch, seq: locked_request(dirserv_lock, get_changes_since(dirserv_commands, epoch, seq)))
+    logger.info("Storage server is started")
+    try:
+        # the commands and the events are handled by their own tasks, a full replication queue does not hold up the commands
+        await asyncio.gather(
+            serve_commands(store, command_port, replicator, handoff, peer_pool),
+            follow_changes(store, file_changes_sub, dirserv_commands, dirserv_lock, name, location_cache, replicator, handoff, cursor),
+            sync_placement(store, dirserv_commands, dirserv_lock, name, replicator, handoff),
+            keep_alive(dirserv_commands, dirserv_lock, name, self_entrypoint_addr),
+        )
+    finally:
+        replicator.close()
+        peer_pool.close()
+        await leave(context, name)
 
+def parse_size(text: str) -> int:
+    """Parse a number of bytes, with an optional K, M or G suffix."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
 
 def main():
     import sys
-    name = sys.argv[1]
-    store = StorageServerStore()
+    args = sys.argv[1:]
+    log.setup(log.pop_level(args))
+    workers = REPLICATION_WORKERS
+    if "--workers" in args:
+        index = args.index("--workers")
+        workers = int(args[index + 1])
+        del args[index:index+2]
+    port = 5354
+    if "--port" in args:
+        index = args.index("--port")
+        port = int(args[index + 1])
+        del args[index:index+2]
+    budget = None
+    if "--budget" in args:
+        index = args.index("--budget")
+        budget = parse_size(args[index + 1])
+        del args[index:index+2]
+    name = args[0]
+    if len(args) > 1:
+        store = StorageServerStore(DiskBackend(args[1]), budget)
+    else:
+        store = StorageServerStore(budget=budget)
+    store.load()
     context = Context()
     try:
-        asyncio.run(storage_server(store, context, "storage+" + name))
+        asyncio.run(storage_server(store, context, "storage+" + name, workers, port))
     except KeyboardInterrupt:
         context.destroy()
         print('')